@@ -4,4 +4,17 @@ from __future__ import absolute_import
 from beiwedata.basic import *
 from beiwedata.audio import *
 from beiwedata.download import *
+from beiwedata.gps import *
+from beiwedata.power import *
+from beiwedata.comm import *
+from beiwedata.places import *
+from beiwedata.cohort import *
+from beiwedata.encounters import *
+from beiwedata.network import *
+from beiwedata.coverage import *
+from beiwedata.align import *
+from beiwedata.cache import *
+from beiwedata.logsearch import *
+from beiwedata.pipeline import *
+from beiwedata.survey import *
 # from beiwedata.download_creds import *
\ No newline at end of file
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""`python -m beiwedata`: see beiwedata.cli"""
+
+import sys
+from beiwedata.cli import main
+
+sys.exit(main())
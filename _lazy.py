@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+    Lazy module loading so `import beiwedata` stays cheap.
+
+    matplotlib, scipy and pandas together take seconds to import and most
+    scripts (downloading, counting rows) never touch them. Modules in this
+    package refer to them through lazy_import(), which only does the real
+    import the first time an attribute is used.
+"""
+
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module that is imported on first attribute access
+
+    Usage
+    -----
+    ```
+    pd = LazyModule('pandas')   # nothing imported yet
+    pd.DataFrame()              # pandas is imported here
+    ```
+
+    """
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is None:
+            return "<lazy module '%s' (not loaded)>" % self.__name__
+        return repr(self.__dict__['_lazy_module'])
+
+
+def lazy_import(name):
+    """Returns the module if it is already imported, else a LazyModule"""
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    Figure set up shared by the plotting functions.
+
+    Every plot_*() function takes `headless`. With headless=True the figure
+    is a bare matplotlib Figure with an Agg canvas: pyplot's global state
+    (current figure, figure manager, GUI backend) is never touched, so it's
+    safe in worker processes and the figure is freed as soon as it goes out
+    of scope (see beiwedata.report).
+"""
+
+import numpy as np
+from beiwedata._lazy import lazy_import
+
+plt = lazy_import('matplotlib.pyplot')
+
+
+def new_figure(nrows=1, ncols=1, sharex=False, figsize=None, headless=False):
+    """Returns (fig, axes) like plt.subplots()
+
+    Parameters
+    ----------
+    nrows : number of rows of axes
+    ncols : number of columns of axes
+    sharex : if True, all axes share the x-axis
+    figsize : (width, height) in inches (default is matplotlib's)
+    headless : if True, makes a bare Figure with an Agg canvas instead of
+        going through pyplot
+
+    """
+    if headless is not True:
+        return plt.subplots(nrows, ncols, sharex=sharex, figsize=figsize)
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    axes = np.empty(nrows * ncols, dtype=object)
+    for i in range(nrows * ncols):
+        share = axes[0] if (sharex and i > 0) else None
+        axes[i] = fig.add_subplot(nrows, ncols, i + 1, sharex=share)
+    if nrows * ncols == 1:
+        return fig, axes[0]
+    ## Same shapes as plt.subplots(squeeze=True)
+    return fig, axes.reshape(nrows, ncols).squeeze()
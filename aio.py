@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+    Asynchronous Beiwe API client (Python 3.6+, asyncio).
+
+    The same requests as beiwedata.download -- make_request(),
+    get_users_request() and get_studies_request() have the same arguments
+    and results -- as coroutines, for programs that already run an asyncio
+    event loop. Nothing blocks the loop: requests go over asyncio streams,
+    the zip is streamed to a file next to the data instead of being held in
+    memory, and only unpacking it runs in the loop's executor. Requests can
+    share an asyncio.Semaphore (`limit`) to bound how many are in flight,
+    and cancelling one while it downloads leaves the folder as it was.
+
+    Unlike the blocking make_request(), which works in the current directory
+    (see cd()), nothing here changes directory and the `registry` of each
+    answer is merged into master_registry under a lock, so several requests
+    can download into the same folder at once. sync_users() does that with
+    one request per user.
+
+    Not imported by `from beiwedata import *` (it needs Python 3); import
+    beiwedata.aio.
+
+    Usage
+    -----
+    ```
+    import asyncio
+    from beiwedata import aio
+
+    new = asyncio.run(aio.sync_users(study_id, access_key, secret_key,
+                                     folder='./study', concurrency=4))
+    ```
+"""
+
+import asyncio
+import http.client
+import io
+import json
+import os
+import ssl
+import tempfile
+import threading
+import zipfile
+from datetime import datetime
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlsplit
+from beiwedata import download
+from beiwedata.download import api_url, mkdir_p
+from beiwedata.store import extract_member, extract_zip
+
+API_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+## Bytes read from the socket (and written to disk) at a time
+CHUNK_SIZE = 1 << 16
+
+## One lock per download folder, held while master_registry is merged
+_REGISTRY_LOCKS = {}
+_LOCKS_LOCK = threading.Lock()
+
+
+def _registry_lock(folder):
+    with _LOCKS_LOCK:
+        return _REGISTRY_LOCKS.setdefault(folder, threading.Lock())
+
+
+def _wait(coro, timeout):
+    return asyncio.wait_for(coro, timeout) if timeout else coro
+
+
+async def _read_body(reader, headers, write, timeout):
+    """Copies a response body to write(), in chunks. Returns its size."""
+    size = 0
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        while True:
+            line = await _wait(reader.readline(), timeout)
+            n = int(line.split(b';')[0].strip() or b'0', 16)
+            if n == 0:
+                await _wait(reader.readuntil(b'\r\n'), timeout)
+                return size
+            while n:
+                chunk = await _wait(reader.read(min(n, CHUNK_SIZE)), timeout)
+                if not chunk:
+                    raise IOError("Connection closed in a chunk")
+                write(chunk)
+                size += len(chunk)
+                n -= len(chunk)
+            await _wait(reader.readexactly(2), timeout)
+
+    length = headers.get('Content-Length')
+    remaining = int(length) if length is not None else None
+    while remaining is None or remaining > 0:
+        n = CHUNK_SIZE if remaining is None else min(remaining, CHUNK_SIZE)
+        chunk = await _wait(reader.read(n), timeout)
+        if not chunk:
+            if remaining is not None:
+                raise IOError("Connection closed after %d of %s bytes" %
+                              (size, length))
+            break
+        write(chunk)
+        size += len(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+    return size
+
+
+async def _post(url, values, write, timeout=None):
+    """POSTs a form and streams a 200 response's body to write()
+
+    Raises urllib's HTTPError for other statuses, like urlopen() does.
+    Returns the number of bytes written.
+    """
+    parts = urlsplit(url)
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    body = urlencode(values).encode('ascii')
+    head = ('POST %s HTTP/1.1\r\nHost: %s\r\n'
+            'Content-Type: application/x-www-form-urlencoded\r\n'
+            'Content-Length: %d\r\nConnection: close\r\n\r\n' %
+            (path, parts.netloc, len(body))).encode('latin-1')
+
+    reader, writer = await _wait(asyncio.open_connection(
+        parts.hostname, port,
+        ssl=ssl.create_default_context() if https else None), timeout)
+    try:
+        writer.write(head + body)
+        await _wait(writer.drain(), timeout)
+        response = await _wait(reader.readuntil(b'\r\n\r\n'), timeout)
+        status_line, _, rest = response.partition(b'\r\n')
+        fields = status_line.decode('latin-1').split(None, 2)
+        status = int(fields[1])
+        reason = fields[2] if len(fields) > 2 else ''
+        headers = http.client.parse_headers(io.BytesIO(rest))
+        if status != 200:
+            error = io.BytesIO()
+            await _read_body(reader, headers, error.write, timeout)
+            error.seek(0)
+            raise HTTPError(url, status, reason, headers, error)
+        return await _read_body(reader, headers, write, timeout)
+    finally:
+        writer.close()
+
+
+async def _post_json(url, values, limit, timeout):
+    body = io.BytesIO()
+    if limit is None:
+        await _post(url, values, body.write, timeout)
+    else:
+        async with limit:
+            await _post(url, values, body.write, timeout)
+    return json.loads(body.getvalue().decode('utf-8'))
+
+
+def _unpack(part, folder, store):
+    """Extracts a downloaded zip and merges its registry. Runs in a thread.
+
+    Returns the names of the extracted files. Removes the zip.
+    """
+    try:
+        with zipfile.ZipFile(part) as z:
+            members = [name for name in z.namelist()
+                       if name != 'registry' and not name.endswith('/')]
+            new_registry = json.loads(z.read('registry').decode('utf-8'))
+            if store:
+                extract_zip(z, store, folder, members=members)
+            else:
+                ## Files may be links to a store object: replace, don't
+                ## write through (see extract_member())
+                for name in members:
+                    extract_member(z, z.getinfo(name), folder)
+    finally:
+        os.remove(part)
+
+    ## Re-read under the lock: other requests may have merged theirs since
+    ## this one started
+    registry = os.path.join(folder, 'master_registry')
+    with _registry_lock(folder):
+        merged = {}
+        if os.path.exists(registry):
+            with open(registry) as f:
+                merged = json.load(f)
+        merged.update(new_registry)
+        with open(registry + '.tmp', 'w') as f:
+            json.dump(merged, f)
+        os.replace(registry + '.tmp', registry)
+    return members
+
+
+async def make_request(study_id, access_key, secret_key, user_ids=None,
+                       data_streams=None, time_start=None, time_end=None,
+                       folder='.', return_new=False, verbose=True,
+                       base_url=None, store=None, limit=None, timeout=None):
+    """Submit a download request to the studies.beiwe.org server (coroutine)
+
+    Parameters
+    ----------
+    study_id / access_key / secret_key / user_ids / data_streams /
+    time_start / time_end / folder / return_new / verbose / base_url /
+    store : see beiwedata.download.make_request()
+    limit : an asyncio.Semaphore shared by requests to bound how many are
+        in flight (default is no bound)
+    timeout : seconds to wait for the connection and for each read (default
+        is no timeout)
+
+    Notes
+    -----
+    The answer is written to a temporary file in `folder` as it arrives and
+    unpacked in the event loop's default executor. If the request is
+    cancelled (or fails) while downloading, the partial file is removed and
+    nothing else changes. Once the whole answer is in, unpacking finishes
+    even if the request is cancelled, so files and master_registry stay in
+    step.
+
+    Requests into the same folder may run at the same time: each sends the
+    master_registry it finds when it starts and merges its own registry
+    when it ends.
+
+    """
+    folder = os.path.abspath(folder)
+    mkdir_p(folder)
+    store = store or download.DATA_STORE
+    if store:
+        store = os.path.abspath(store)
+
+    values = {'access_key': access_key,
+              'secret_key': secret_key,
+              'study_id': study_id}
+    if user_ids:
+        values['user_ids'] = json.dumps(user_ids)
+    if data_streams:
+        values['data_streams'] = json.dumps(data_streams)
+    if time_start:
+        if isinstance(time_start, datetime):
+            time_start = time_start.strftime(API_TIME_FORMAT)
+        values['time_start'] = time_start
+    if time_end:
+        if isinstance(time_end, datetime):
+            time_end = time_end.strftime(API_TIME_FORMAT)
+        values['time_end'] = time_end
+    registry = os.path.join(folder, 'master_registry')
+    if os.path.exists(registry):
+        with open(registry) as f:
+            values['registry'] = f.read()
+
+    fd, part = tempfile.mkstemp(prefix='.download-', suffix='.zip',
+                                dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if verbose:
+                print("Sending request, this could take some time.")
+            url = api_url('get-data/v1', base_url)
+            if limit is None:
+                await _post(url, values, f.write, timeout)
+            else:
+                async with limit:
+                    await _post(url, values, f.write, timeout)
+    except BaseException:
+        os.remove(part)
+        raise
+    if verbose:
+        print("Data received.")
+        print("Unpacking files:", folder)
+
+    loop = asyncio.get_event_loop()
+    new_files = await asyncio.shield(
+        loop.run_in_executor(None, _unpack, part, folder, store))
+    if verbose:
+        print("Completed: " + str(len(new_files)) + " new files")
+    if return_new:
+        return new_files
+
+
+async def get_users_request(study_id, access_key, secret_key, base_url=None,
+                            limit=None, timeout=None):
+    """Provides a list of user ids enrolled in the given study (coroutine)"""
+    values = {'access_key': access_key,
+              'secret_key': secret_key,
+              'study_id': study_id}
+    return await _post_json(api_url('get-users/v1', base_url), values, limit,
+                            timeout)
+
+
+async def get_studies_request(access_key, secret_key, base_url=None,
+                              limit=None, timeout=None):
+    """Provides a dictionary of the form {study_key: study_name} for studies
+    accessible to the provided user credentials (coroutine)"""
+    values = {'access_key': access_key,
+              'secret_key': secret_key}
+    return await _post_json(api_url('get-studies/v1', base_url), values,
+                            limit, timeout)
+
+
+async def sync_users(study_id, access_key, secret_key, user_ids=None,
+                     folder='.', concurrency=4, **kwargs):
+    """Downloads new data of every user, several users at a time (coroutine)
+
+    Parameters
+    ----------
+    study_id / access_key / secret_key / folder : see make_request()
+    user_ids : users to download (default is every user of the study)
+    concurrency : requests in flight at the same time
+    kwargs : passed to make_request() (data_streams, time_start, time_end,
+        base_url, store, timeout)
+
+    Notes
+    -----
+    Sends one request per user into the same folder and returns {user_id:
+    list of new files}. If a request fails, the others are cancelled and
+    the error is raised; users that finished keep their files.
+
+    """
+    base_url = kwargs.get('base_url')
+    if user_ids is None:
+        user_ids = await get_users_request(study_id, access_key, secret_key,
+                                           base_url=base_url,
+                                           timeout=kwargs.get('timeout'))
+    limit = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.ensure_future(make_request(
+        study_id, access_key, secret_key, user_ids=[user], folder=folder,
+        return_new=True, verbose=False, limit=limit, **kwargs))
+        for user in user_ids]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return dict(zip(user_ids, results))
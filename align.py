@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    Several data streams of one user on one time grid.
+
+    Models usually want accelerometer activity, GPS, power state and
+    Bluetooth counts side by side, one row per minute. Each stream has its
+    own timestamp column (see TIMESTAMP_COLUMNS), so this usually means a
+    chain of import_df(), resample() and merge_asof() calls. align_streams()
+    does it in one go: the streams are read at the same time (threads),
+    only files that can overlap the window are opened and only the needed
+    columns are parsed, every row gets its grid bin with integer arithmetic,
+    and each stream is aggregated per bin straight into the shared grid.
+
+    Usage
+    -----
+    ```
+    grid = align_streams('./study/user1',
+                         {'accel': {'x': ['mean', 'std'], 'z': 'mean'},
+                          'gps': {'latitude': 'mean', 'longitude': 'mean'},
+                          'power': {'event': 'size'},
+                          'blue': {'MAC': 'nunique'}},
+                         make_timestamp(2015, 5, 5),
+                         make_timestamp(2015, 5, 6), freq='1Min')
+    ```
+"""
+
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from beiwedata._lazy import lazy_import
+from beiwedata.basic import (list_data_files, files_in_window,
+                             file_timestamp, TIMESTAMP_COLUMNS)
+from beiwedata.cohort import aggregation_specs, read_columns
+from beiwedata.power import freq_ms
+
+__all__ = ['ALIGN_AGGREGATIONS', 'align_streams']
+
+pd = lazy_import('pandas')
+
+## Aggregations of align_streams(). Counts are 0 (not missing) in empty bins.
+ALIGN_AGGREGATIONS = ['sum', 'count', 'mean', 'std', 'min', 'max', 'first',
+                      'last', 'median', 'nunique', 'size']
+_COUNTS = ('count', 'nunique', 'size')
+
+
+def _load(args):
+    """Rows of one stream in [start_ts, end_ts) with the time in '_ts', in
+    time order (so 'first' and 'last' are right across files)"""
+    flist, stream, tstamp, columns, start_ts, end_ts = args
+    frames = []
+    for fname in sorted(flist, key=file_timestamp):
+        frame = read_columns(fname, tstamp, columns)
+        ts = frame['_ts'].values
+        frames.append(frame[(ts >= start_ts) & (ts < end_ts)])
+    if not frames:
+        return pd.DataFrame(columns=['_ts'] + list(columns))
+    frame = pd.concat(frames, ignore_index=True)
+    ts = frame['_ts'].values
+    if len(ts) and (np.diff(ts) < 0).any():  # files that overlap in time
+        frame = frame.iloc[np.argsort(ts, kind='mergesort')]
+    return frame
+
+
+def align_streams(upath, streams, start_ts, end_ts, freq='1Min',
+                  tstamps=None, workers=None):
+    """Aggregates several data streams onto one time grid
+
+    Parameters
+    ----------
+    upath : directory of user_id
+    streams : {stream: {column: aggregation or list of aggregations}}.
+        Streams are those of list_data_files() ('accel', 'gps', ...).
+        Aggregations are ALIGN_AGGREGATIONS; 'size' counts rows (its column
+        is ignored).
+    start_ts : start of the grid (Java time, see make_timestamp())
+    end_ts : end of the grid (not included)
+    freq : grid resolution as a pandas frequency ('1Min', '5Min', 'h')
+    tstamps : {stream: timestamp column} for streams whose column isn't the
+        one in TIMESTAMP_COLUMNS (e.g., older call logs with 'date')
+    workers : number of threads reading streams (default is one per stream)
+
+    Notes
+    -----
+    Returns a DataFrame indexed by the start of every bin (UTC) from
+    start_ts to end_ts, with one column per aggregation named
+    stream_column_aggregation (stream_size for 'size'). Bins are aligned to
+    start_ts. Counts are 0 in bins without data, everything else is NaN.
+
+    Streams are read in threads rather than processes: most of the time is
+    spent parsing CSVs, which doesn't hold the GIL, and the frames don't
+    have to be pickled back. Files that can't overlap the window are never
+    opened (see files_in_window()).
+
+    """
+    width = freq_ms(freq)
+    start_ts = int(start_ts)
+    n_bins = max(0, -(-(int(end_ts) - start_ts) // width))
+    end_ts = start_ts + n_bins * width
+    tstamps = tstamps or {}
+
+    specs = dict((stream, aggregation_specs(aggs, ALIGN_AGGREGATIONS))
+                 for stream, aggs in streams.items())
+    names = sorted(streams)
+    jobs = []
+    for stream in names:
+        columns = sorted(set(col for col, func in specs[stream]
+                             if func != 'size'))
+        tstamp = tstamps.get(stream, TIMESTAMP_COLUMNS.get(stream))
+        ## Listed here: Python 2's strptime isn't safe to import in threads
+        flist = files_in_window(list_data_files(upath, stream), start_ts,
+                                end_ts)
+        jobs.append((flist, stream, tstamp, columns, start_ts, end_ts))
+
+    pool = ThreadPool(workers or max(len(jobs), 1))
+    try:
+        frames = pool.map(_load, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    grid = np.arange(n_bins)
+    out = {}
+    order = []
+    for stream, frame in zip(names, frames):
+        bins = (frame['_ts'].values.astype(np.int64) - start_ts) // width
+        grouped = frame.groupby(bins)
+        for col, func in specs[stream]:
+            if func == 'size':
+                name = stream + '_size'
+                values = grouped.size()
+            else:
+                name = '_'.join([stream, col, func])
+                values = getattr(grouped[col], func)()
+            if func in _COUNTS:
+                values = values.reindex(grid, fill_value=0).astype(np.int64)
+            else:
+                values = values.reindex(grid)
+            out[name] = values.values
+            order.append(name)
+
+    index = pd.to_datetime(start_ts + grid * width, unit='ms')
+    return pd.DataFrame(out, index=pd.Index(index, name='dt'),
+                        columns=order)
@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+"""
+    Compressed archives of raw data files (.bwz), read transparently.
+
+    archive_user() replaces the CSV files of each user / stream / day with
+    one archive next to them (e.g., `accelerometer/2015-05-05.bwz`, or
+    `accel_2015-05-05.bwz` for flat downloads). Files of a day with the same
+    columns are stored together, column by column: integers (timestamps) as
+    deltas in the smallest integer type that holds them, decimals as scaled
+    integers, other floats byte-shuffled, and text (hashed MACs, phone
+    numbers, ...) as one dictionary of distinct values plus codes. Every
+    column is a separate zlib block and an index at the end of the archive
+    records where each block and each file's rows are, so readers only
+    decompress the columns they need. Files that don't fit (quoted values,
+    ragged rows, ...) are stored whole. Decoding always gives back the
+    original bytes; archive_user() checks this before removing anything.
+
+    The original paths keep working: list_data_files() lists the files
+    inside archives under their original paths, and row_count(),
+    return_file(), import_df() and the readers of cohort, coverage, survey
+    and arrow read them from the archive (see open_data() and
+    read_data_csv()). A plain file with the same path (e.g., downloaded
+    again) takes precedence over the archived one.
+
+    Usage
+    -----
+    ```
+    archive_user('./study/abcd1234', before=make_timestamp(2015, 6, 1))
+    df = import_df(list_data_files('./study/abcd1234', 'accel'))
+    ```
+"""
+
+import calendar
+import datetime
+import io
+import json
+import os
+import struct
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+import numpy as np
+from beiwedata._lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+ARCHIVE_EXT = '.bwz'
+
+_MAGIC = b'BWZ1'
+## Index offset, index length, magic -- the last bytes of every archive
+_FOOTER = struct.Struct('<QQ4s')
+
+## Parsed archive indexes: {path: (size, mtime, index)}
+_indexes = {}
+
+## Recently decoded columns, so reading the files of one day one by one
+## decompresses each column once
+_DECODED_BYTES = 64 << 20
+_decoded = OrderedDict()
+
+
+def _name_parts(name):
+    """(prefix, day) of a data file name, e.g. ('', '2015-05-05') for
+    `2015-05-05 14_00_00.csv` or ('accel', '2015-05-05') for
+    `accel_1430834400000.csv`"""
+    stem = name.rsplit('.', 1)[0]
+    try:
+        datetime.datetime.strptime(stem, '%Y-%m-%d %H_%M_%S')
+        return '', stem[:10]
+    except ValueError:
+        prefix, stamp = stem.rsplit('_', 1)
+        day = datetime.datetime.utcfromtimestamp(int(stamp) / 1000.)
+        return prefix, day.strftime('%Y-%m-%d')
+
+
+def archive_path(fname):
+    """The archive that would hold a data file"""
+    folder, name = os.path.split(fname)
+    prefix, day = _name_parts(name)
+    return os.path.join(folder, (prefix + '_' if prefix else '') + day +
+                        ARCHIVE_EXT)
+
+
+def is_archived(fname):
+    """True if fname isn't on disk but is inside its archive"""
+    if os.path.exists(fname) or not fname.endswith('.csv'):
+        return False
+    try:
+        path = archive_path(fname)
+    except ValueError:
+        return False
+    return (os.path.exists(path) and
+            os.path.basename(fname) in read_index(path)['members'])
+
+
+## Reading ##
+def _load(path):
+    """(cache key, index) of an archive"""
+    st = os.stat(path)
+    cached = _indexes.get(path)
+    if cached is None or cached[:2] != (st.st_size, st.st_mtime):
+        with open(path, 'rb') as f:
+            f.seek(-_FOOTER.size, os.SEEK_END)
+            offset, length, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+            if magic != _MAGIC:
+                raise ValueError("Not a beiwedata archive: %s" % path)
+            f.seek(offset)
+            index = json.loads(zlib.decompress(f.read(length)).decode(
+                'utf-8'))
+        cached = _indexes[path] = (st.st_size, st.st_mtime, index)
+    return (path,) + cached[:2], cached[2]
+
+
+def read_index(path):
+    """The index of an archive: {'version', 'codec', 'groups', 'members'}"""
+    return _load(path)[1]
+
+
+def archive_members(path):
+    """Original paths of the files inside an archive, in time order"""
+    folder = os.path.dirname(path)
+    return [os.path.join(folder, name)
+            for name in sorted(read_index(path)['members'])]
+
+
+def member_info(fname):
+    """(archive, index entry) of an archived file (rows, size, mtime, ...)"""
+    path = archive_path(fname)
+    return path, read_index(path)['members'][os.path.basename(fname)]
+
+
+def _read_blocks(path, spans):
+    with open(path, 'rb') as f:
+        out = []
+        for offset, length in spans:
+            f.seek(offset)
+            out.append(zlib.decompress(f.read(length)))
+    return out
+
+
+def _decode_column(column, blocks):
+    """Values of a column (int64, float64 or object array)"""
+    kind = column['kind']
+    if kind in ('int', 'decimal'):
+        values = np.frombuffer(blocks[0], column['dtype']).astype(np.int64)
+        if column['delta']:
+            values = np.cumsum(values)
+        if kind == 'decimal':
+            return values / 10.0 ** column['scale']
+        return values
+    if kind == 'float':
+        shuffled = np.frombuffer(blocks[0], np.uint8).reshape(8, -1)
+        return shuffled.T.copy().view('<f8').ravel().astype(np.float64)
+    values = json.loads(blocks[0].decode('utf-8'))
+    lookup = np.empty(len(values), dtype=object)
+    lookup[:] = values
+    return lookup[np.frombuffer(blocks[1], column['dtype'])]
+
+
+def _native(name):
+    """A column name as read_csv() gives it (str on Python 2 and 3)"""
+    return name if isinstance(name, str) else name.encode('utf-8')
+
+
+def _parse_floats(column, values):
+    """Floats of a decoded column as read_csv() parses their text"""
+    if column['kind'] not in ('float', 'decimal') or not len(values):
+        return values
+    text = u'\n'.join(_text(column, values)).encode('ascii')
+    parsed = pd.read_csv(io.BytesIO(text), header=None, names=['v'],
+                         dtype={'v': np.float64}, skip_blank_lines=False)
+    return parsed['v'].values
+
+
+def _group_column(path, g, c, parsed=False):
+    """Decoded column c of group g of an archive (cached). With parsed=True,
+    floats are those of read_csv() (see _parse_floats())."""
+    key, index = _load(path)
+    key += (g, c, parsed)
+    if key in _decoded:
+        values = _decoded.pop(key)
+    else:
+        column = index['groups'][g]['columns'][c]
+        values = _decode_column(column, _read_blocks(path, column['blocks']))
+        if parsed:
+            values = _parse_floats(column, values)
+        while _decoded and sum(v.nbytes for v in _decoded.values()) + \
+                values.nbytes > _DECODED_BYTES:
+            _decoded.popitem(last=False)
+    _decoded[key] = values
+    return values
+
+
+def _text(column, values):
+    """Values of a decoded column as they were written in the file"""
+    if column['kind'] == 'int':
+        return [str(v) for v in values.tolist()]
+    if column['kind'] == 'decimal' and column['fixed']:
+        return ['%.*f' % (column['scale'], v) for v in values.tolist()]
+    if column['kind'] in ('float', 'decimal'):
+        return [repr(v) for v in values.tolist()]
+    return list(values)
+
+
+def _join(header, trailing, columns):
+    """Bytes of a file from its header and its columns as text"""
+    lines = [header]
+    lines.extend(u','.join(row) for row in zip(*columns))
+    text = u'\n'.join(lines) + (u'\n' if trailing else u'')
+    return text.encode('utf-8')
+
+
+def read_member(fname):
+    """Original bytes of an archived file"""
+    path, entry = member_info(fname)
+    if 'blocks' in entry:
+        return _read_blocks(path, entry['blocks'])[0]
+    group = read_index(path)['groups'][entry['group']]
+    rows = slice(entry['start'], entry['start'] + entry['rows'])
+    columns = [_text(column, _group_column(path, entry['group'], c)[rows])
+               for c, column in enumerate(group['columns'])]
+    return _join(group['header'], entry['trailing'], columns)
+
+
+def open_data(fname, mode='rb'):
+    """Opens a data file, plain or archived, for reading
+
+    Parameters
+    ----------
+    fname : a data file (see list_data_files())
+    mode : 'rb' for bytes, 'r' for text (as open() gives it, for csv.reader)
+
+    """
+    if not is_archived(fname):
+        return open(fname, mode)
+    data = read_member(fname)
+    if 'b' in mode or str is bytes:  # Python 2 text is bytes
+        return io.BytesIO(data)
+    return io.StringIO(data.decode('utf-8'))
+
+
+def data_stat(fname):
+    """(size, mtime) of a data file -- of the original for archived files"""
+    if is_archived(fname):
+        entry = member_info(fname)[1]
+        return entry['size'], entry['mtime']
+    st = os.stat(fname)
+    return st.st_size, int(st.st_mtime)
+
+
+def read_data_csv(fname, **kwargs):
+    """pandas.read_csv() for plain and archived data files
+
+    Notes
+    -----
+    Archived files checked at archiving to give the same frame as read_csv()
+    are built straight from their columns, decoding only the ones selected
+    by `usecols` (a list or a callable). Anything else is decoded to its
+    original bytes and parsed as usual.
+
+    Either way the frame is the one read_csv() gives for the original file.
+    Float columns are decoded exactly (as float() of their text), but the
+    default float parser of read_csv() can be a unit in the last place off
+    (pandas < 1.2 often is), so they are parsed from their text again with
+    it, once per archive group and column.
+
+    """
+    if not is_archived(fname):
+        return pd.read_csv(fname, **kwargs)
+    path, entry = member_info(fname)
+    if not entry.get('frame') or set(kwargs) - set(['usecols']):
+        return pd.read_csv(io.BytesIO(read_member(fname)), **kwargs)
+    columns = read_index(path)['groups'][entry['group']]['columns']
+    usecols = kwargs.get('usecols')
+    if callable(usecols):
+        wanted = [c for c, col in enumerate(columns) if usecols(col['name'])]
+    elif usecols is not None:
+        wanted = [c for c, col in enumerate(columns) if col['name'] in usecols]
+    else:
+        wanted = range(len(columns))
+    rows = slice(entry['start'], entry['start'] + entry['rows'])
+    ## Python 2's read_csv() names columns with str, not unicode
+    names = [_native(columns[c]['name']) for c in wanted]
+    data = [_group_column(path, entry['group'], c, True)[rows]
+            for c in wanted]
+    return pd.DataFrame(dict(zip(names, data)), columns=names)
+
+
+## Writing ##
+def _smallest_int(values, unsigned=False):
+    """Smallest little-endian integer dtype that holds values"""
+    lo, hi = (int(values.min()), int(values.max())) if len(values) else (0, 0)
+    for size in (1, 2, 4, 8):
+        dtype = np.dtype(('<u%d' if unsigned else '<i%d') % size)
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return np.dtype('<i8')
+
+
+def _split(data):
+    """(header, trailing newline, columns as lists of text) of a CSV file,
+    or None if it can't be stored by column"""
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    if u'"' in text or u'\r' in text:
+        return None
+    lines = text.split(u'\n')
+    trailing = len(lines) > 1 and lines[-1] == u''
+    if trailing:
+        lines = lines[:-1]
+    names = lines[0].split(u',')
+    rows = [line.split(u',') for line in lines[1:]]
+    if any(len(row) != len(names) for row in rows):
+        return None
+    columns = [list(c) for c in zip(*rows)] if rows else [[] for _ in names]
+    return lines[0], trailing, columns
+
+
+def _kind(text):
+    """How a column's text can be stored exactly: ('int', None), ('float',
+    None), ('fixed', digits after the point) or ('str', None)"""
+    values = np.array(text, dtype=object)
+    for kind, dtype, fmt in (('int', np.int64, str),
+                             ('float', np.float64, repr)):
+        try:
+            if [fmt(v) for v in values.astype(dtype).tolist()] == text:
+                return kind, None
+        except (ValueError, TypeError, OverflowError):
+            pass
+    ## Written with a fixed number of decimals (e.g. 8.888210)
+    point = text[0].find(u'.')
+    if point >= 0:
+        scale = len(text[0]) - point - 1
+        try:
+            floats = values.astype(np.float64).tolist()
+            if ['%.*f' % (scale, v) for v in floats] == text:
+                return 'fixed', scale
+        except (ValueError, TypeError, OverflowError):
+            pass
+    return 'str', None
+
+
+def _decimals(text):
+    """Most digits after the point, or None if not all plain decimals"""
+    scale = 0
+    for t in text:
+        if u'e' in t or u'E' in t or u'n' in t:  # 1e-05, nan, inf
+            return None
+        point = t.find(u'.')
+        if point >= 0:
+            scale = max(scale, len(t) - point - 1)
+    return scale if scale <= 15 else None
+
+
+def _int_block(ints, level):
+    """(column fields, compressed block): deltas if they're smaller"""
+    deltas = np.empty(len(ints), dtype=np.int64)
+    deltas[:1] = ints[:1]
+    deltas[1:] = np.diff(ints)
+    plain, delta = _smallest_int(ints), _smallest_int(deltas)
+    if delta.itemsize < plain.itemsize:
+        return ({'dtype': delta.str, 'delta': True},
+                zlib.compress(deltas.astype(delta).tobytes(), level))
+    return ({'dtype': plain.str, 'delta': False},
+            zlib.compress(ints.astype(plain).tobytes(), level))
+
+
+def _scaled(floats, scale):
+    """floats * 10**scale as int64 if that's exact, else None"""
+    if scale is None or scale > 15:
+        return None
+    scaled = np.round(floats * 10.0 ** scale)
+    back = scaled / 10.0 ** scale
+    if (len(scaled) and np.abs(scaled).max() >= 2 ** 53) or \
+            not np.array_equal(back, floats) or \
+            not np.array_equal(np.signbit(back), np.signbit(floats)):
+        return None
+    return scaled.astype(np.int64)
+
+
+def _encode_column(name, kind, text, level):
+    """(column entry, compressed blocks) of a column of text"""
+    kind, scale = kind
+    column = {'name': name, 'kind': kind}
+    if kind == 'int':
+        fields, block = _int_block(np.array(text, dtype=object).astype(
+            np.int64), level)
+        column.update(fields)
+        return column, [block]
+    if kind in ('float', 'fixed'):
+        floats = np.array(text, dtype=object).astype(np.float64)
+        fixed = kind == 'fixed'
+        ints = _scaled(floats, scale if fixed else _decimals(text))
+        if ints is not None:
+            fields, block = _int_block(ints, level)
+            column.update(fields, kind='decimal', fixed=fixed,
+                          scale=scale if fixed else _decimals(text))
+            return column, [block]
+        if not fixed:
+            shuffled = floats.astype('<f8').view(np.uint8).reshape(-1, 8).T
+            column['dtype'] = '<f8'
+            return column, [zlib.compress(shuffled.tobytes(), level)]
+        column['kind'] = 'str'
+    codes, values = [], {}
+    for v in text:
+        codes.append(values.setdefault(v, len(values)))
+    codes = np.array(codes, dtype=np.int64)
+    dtype = _smallest_int(codes, unsigned=True)
+    column['dtype'] = dtype.str
+    ordered = sorted(values, key=values.get)
+    return column, [zlib.compress(json.dumps(ordered).encode('utf-8'), level),
+                    zlib.compress(codes.astype(dtype).tobytes(), level)]
+
+
+def _encode(datas, level):
+    """Index and blocks of an archive holding {name: (bytes, mtime)}
+
+    Returns (groups, members, blocks). Spans in the index are block numbers
+    until _write() knows the offsets.
+    """
+    members, blocks, groups = {}, [], []
+    keyed = OrderedDict()
+    empty = []
+    for name in sorted(datas):
+        data, mtime = datas[name]
+        ## Rows counted like row_count() does
+        members[name] = {'size': len(data), 'mtime': mtime,
+                         'rows': max(0, len(data.splitlines()) - 1)}
+        split = _split(data)
+        if split is None:
+            members[name]['blocks'] = [len(blocks)]
+            blocks.append(zlib.compress(data, level))
+            continue
+        header, trailing, columns = split
+        members[name]['trailing'] = trailing
+        if not columns[0]:
+            empty.append((name, header, columns))
+            continue
+        key = (header, tuple(_kind(text) for text in columns))
+        keyed.setdefault(key, []).append((name, columns))
+    ## Header-only files join any group with their header
+    for name, header, columns in empty:
+        key = next((k for k in keyed if k[0] == header),
+                   (header, tuple(('str', None) for _ in columns)))
+        keyed.setdefault(key, []).append((name, columns))
+
+    for (header, kinds), files in keyed.items():
+        g = len(groups)
+        group = {'header': header, 'rows': 0, 'columns': []}
+        for name, columns in files:
+            members[name].update(group=g, start=group['rows'],
+                                 rows=len(columns[0]))
+            group['rows'] += len(columns[0])
+        for c, (name, kind) in enumerate(zip(header.split(u','), kinds)):
+            text = [v for _, columns in files for v in columns[c]]
+            column, col_blocks = _encode_column(name, kind, text, level)
+            column['blocks'] = list(range(len(blocks),
+                                          len(blocks) + len(col_blocks)))
+            blocks.extend(col_blocks)
+            group['columns'].append(column)
+        groups.append(group)
+    return groups, members, blocks
+
+
+def _check(groups, members, datas, blocks):
+    """Checks every file decodes to its bytes, and marks the ones whose
+    columns give exactly what read_csv() gives"""
+    decoded = {}
+    for name, entry in members.items():
+        if 'group' not in entry:
+            continue
+        g = entry['group']
+        group = groups[g]
+        for c, column in enumerate(group['columns']):
+            if (g, c) not in decoded:
+                decoded[g, c] = _decode_column(column, [
+                    zlib.decompress(blocks[b]) for b in column['blocks']])
+        rows = slice(entry['start'], entry['start'] + entry['rows'])
+        names = [column['name'] for column in group['columns']]
+        values = [decoded[g, c][rows] for c in range(len(names))]
+        data = datas[name][0]
+        text = [_text(col, v) for col, v in zip(group['columns'], values)]
+        if _join(group['header'], entry['trailing'], text) != data:
+            raise ValueError("Archiving would change %s" % name)
+        ## float() of the text, which the default (fast) parser of
+        ## read_csv() can miss by a unit in the last place
+        expected = pd.read_csv(io.BytesIO(data), float_precision='round_trip')
+        built = pd.DataFrame(dict(zip(names, values)), columns=names)
+        entry['frame'] = (list(expected.columns) == names and
+                          built.equals(expected))
+
+
+def _write(path, groups, members, blocks, level):
+    """Writes an archive (atomically)"""
+    folder = os.path.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.tmp', suffix=ARCHIVE_EXT)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_MAGIC)
+            spans = []
+            for block in blocks:
+                spans.append([f.tell(), len(block)])
+                f.write(block)
+            for item in [m for m in members.values() if 'blocks' in m] + \
+                    [c for g in groups for c in g['columns']]:
+                item['blocks'] = [spans[b] for b in item['blocks']]
+            body = zlib.compress(json.dumps(
+                {'version': 1, 'codec': 'zlib', 'groups': groups,
+                 'members': members}).encode('utf-8'), level)
+            offset = f.tell()
+            f.write(body)
+            f.write(_FOOTER.pack(offset, len(body), _MAGIC))
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    _indexes.pop(path, None)
+
+
+def write_archive(path, files, level=6):
+    """Adds data files to an archive (creating it if needed)
+
+    Parameters
+    ----------
+    path : the archive (see archive_path())
+    files : list of CSV files. A file already in the archive is replaced.
+    level : zlib compression level (1 is fastest, 9 is smallest)
+
+    Notes
+    -----
+    The archive is rewritten with the files it already holds, so files
+    added later share dictionaries and blocks with them. Every file is
+    checked to decode to its original bytes; the plain files are left
+    alone. Returns the index of the new archive.
+
+    """
+    datas = {}
+    if os.path.exists(path):
+        for fname in archive_members(path):
+            datas[os.path.basename(fname)] = (read_member(fname),
+                                              member_info(fname)[1]['mtime'])
+    for fname in files:
+        with open(fname, 'rb') as f:
+            datas[os.path.basename(fname)] = (f.read(),
+                                              int(os.path.getmtime(fname)))
+    groups, members, blocks = _encode(datas, level)
+    _check(groups, members, datas, blocks)
+    _write(path, groups, members, blocks, level)
+    return read_index(path)
+
+
+def archive_user(upath, before=None, level=6, remove=True, verbose=False):
+    """Archives a user's CSV files, one archive per folder, stream and day
+
+    Parameters
+    ----------
+    upath : user directory
+    before : only archive days before this Java time (e.g., leave today,
+        which may still be downloading). Default is every day.
+    level : zlib compression level
+    remove : if True, removes each plain file once it is archived (and
+        read back identically)
+    verbose : if True, prints sizes before and after
+
+    Notes
+    -----
+    Archiving again later adds new files to the existing archives. Returns
+    (files archived, bytes before, bytes after).
+
+    """
+    groups = {}
+    for path, subdirs, names in os.walk(upath):
+        subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+        for name in names:
+            if not name.endswith('.csv') or name.startswith('.'):
+                continue
+            try:
+                prefix, day = _name_parts(name)
+            except ValueError:
+                continue
+            if before is not None:
+                start = calendar.timegm(time.strptime(day, '%Y-%m-%d'))
+                if (start + 86400) * 1000 > before:
+                    continue
+            fname = os.path.join(path, name)
+            groups.setdefault(archive_path(fname), []).append(fname)
+
+    n_files = size_in = size_out = 0
+    for path in sorted(groups):
+        files = sorted(groups[path])
+        old = os.path.getsize(path) if os.path.exists(path) else 0
+        write_archive(path, files, level)
+        size_out += os.path.getsize(path) - old
+        for fname in files:
+            size_in += os.path.getsize(fname)
+            if remove:
+                with open(fname, 'rb') as f:
+                    data = f.read()
+                os.remove(fname)
+                if read_member(fname) != data:  # never lose data
+                    with open(fname, 'wb') as f:
+                        f.write(data)
+                    raise ValueError("Archived copy of %s differs" % fname)
+        n_files += len(files)
+    if verbose:
+        print("%d files: %.1f MB -> %.1f MB" % (n_files, size_in / 1e6,
+                                                 size_out / 1e6))
+    return n_files, size_in, size_out
+
+
+def extract_archive(path, remove=True):
+    """Writes the files of an archive back as plain files
+
+    Parameters
+    ----------
+    path : an archive
+    remove : if True, removes the archive afterwards
+
+    Notes
+    -----
+    Plain files that already exist are left alone. Returns the files
+    written.
+
+    """
+    written = []
+    for fname in archive_members(path):
+        if os.path.exists(fname):
+            continue
+        data = read_member(fname)
+        with open(fname, 'wb') as f:
+            f.write(data)
+        written.append(fname)
+    if remove:
+        os.remove(path)
+        _indexes.pop(path, None)
+    return written
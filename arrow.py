@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+    Arrow-backed stream data (needs `pyarrow`, `pip install pyarrow`).
+
+    import_df() builds a pandas.DataFrame per file, concatenates them (a
+    copy), sets the index (another copy) and every slice after that is one
+    more. import_arrow() reads each file into an Arrow table instead -- only
+    the columns you ask for are parsed -- and concatenates them as chunks,
+    which copies nothing. Time slices (slice_time()) and column selections
+    (table.select()) are views too, so peak memory stays close to the size of
+    the data. Convert to pandas at the very end with to_pandas(), optionally
+    keeping the Arrow memory (arrow_dtypes=True).
+
+    Usage
+    -----
+    ```
+    table = import_arrow(list_data_files(upath, 'accel'), columns=['x', 'y'])
+    day = slice_time(table, make_timestamp(2015, 5, 5),
+                     make_timestamp(2015, 5, 6))
+    df = to_pandas(day.select(['timestamp', 'x']))
+    ```
+"""
+
+import numpy as np
+from beiwedata._lazy import lazy_import
+from beiwedata.archive import is_archived, open_data
+from beiwedata.basic import file_timestamp, files_in_window
+
+pd = lazy_import('pandas')
+pa = lazy_import('pyarrow')
+pacsv = lazy_import('pyarrow.csv')
+
+
+def _header(fname):
+    """Column names of a file, whitespace stripped"""
+    with open_data(fname) as f:
+        header = f.readline().decode('utf-8', 'replace')
+    return [c.strip() for c in header.strip().split(',')]
+
+
+def _time_bounds(times, start_ts, end_ts):
+    """(first, last + 1) rows in [start_ts, end_ts] of sorted times"""
+    lo = 0 if start_ts is None else np.searchsorted(times, start_ts, 'left')
+    hi = len(times) if end_ts is None else np.searchsorted(times, end_ts,
+                                                           'right')
+    return int(lo), int(max(lo, hi))
+
+
+def _filter_time(table, tstamp, start_ts, end_ts):
+    """Rows of table in [start_ts, end_ts] -- a view if times are sorted"""
+    if start_ts is None and end_ts is None:
+        return table
+    times = table.column(tstamp).to_numpy()
+    if len(times) < 2 or np.all(times[1:] >= times[:-1]):
+        lo, hi = _time_bounds(times, start_ts, end_ts)
+        return table.slice(lo, hi - lo)
+    mask = np.ones(len(times), dtype=bool)
+    if start_ts is not None:
+        mask &= times >= start_ts
+    if end_ts is not None:
+        mask &= times <= end_ts
+    return table.filter(pa.array(mask))
+
+
+def read_arrow_file(fname, tstamp='timestamp', columns=None):
+    """Reads one data file into a pyarrow.Table
+
+    Parameters
+    ----------
+    fname : a data file (see list_data_files())
+    tstamp : name of the timestamp column. Files without it (e.g., WiFi)
+        get the file creation time (see file_timestamp()).
+    columns : list of columns to parse (default is all). The timestamp
+        column is always kept.
+
+    """
+    names = _header(fname)
+    include = None
+    if columns is not None:
+        wanted = set(columns) | set([tstamp])
+        include = [c for c in names if c in wanted]
+    read_options = pacsv.ReadOptions(column_names=names, skip_rows=1)
+    convert_options = pacsv.ConvertOptions(include_columns=include)
+    if is_archived(fname):
+        ## Archived files (see beiwedata.archive) are parsed from memory
+        with open_data(fname) as source:
+            table = pacsv.read_csv(source, read_options=read_options,
+                                   convert_options=convert_options)
+    else:
+        table = pacsv.read_csv(fname, read_options=read_options,
+                               convert_options=convert_options)
+    if tstamp not in table.column_names:
+        stamp = np.repeat(np.int64(file_timestamp(fname)), table.num_rows)
+        table = table.append_column(tstamp, pa.array(stamp))
+    return table
+
+
+def _unify(tables):
+    """Same columns, order and types for every table (casts only if needed)"""
+    names = []
+    for t in tables:
+        names.extend(c for c in t.column_names if c not in names)
+    try:
+        schema = pa.unify_schemas([t.schema for t in tables],
+                                  promote_options='permissive')
+    except TypeError:  # pyarrow < 14 can't promote types
+        schema = pa.unify_schemas([t.schema for t in tables])
+    schema = pa.schema([schema.field(c) for c in names])
+    out = []
+    for t in tables:
+        for c in names:
+            if c not in t.column_names:
+                t = t.append_column(c, pa.nulls(t.num_rows,
+                                                schema.field(c).type))
+        t = t.select(names)
+        if not t.schema.equals(schema):
+            t = t.cast(schema)
+        out.append(t)
+    return out
+
+
+def import_arrow(flist, tstamp='timestamp', columns=None, start_ts=None,
+                 end_ts=None):
+    """Reads files into one chunked pyarrow.Table without copying
+
+    Parameters
+    ----------
+    flist : list of files (usually generated from list_data_files())
+    tstamp : name of the timestamp column
+    columns : list of columns to parse (default is all)
+    start_ts : only keep rows at or after this Java time (see make_timestamp())
+    end_ts : only keep rows at or before this Java time
+
+    Notes
+    -----
+    Same arguments as import_df(). Files are read in time order and each
+    becomes one chunk of the table, so nothing is copied to put them
+    together. Files outside the time window are never opened (see
+    files_in_window()); within a file, sorted rows are trimmed with a
+    zero-copy slice. Header-only files are left out. If files disagree on a
+    column's type (e.g., a file whose values all look like integers), that
+    file's column is cast to the common type.
+
+    """
+    flist = sorted(files_in_window(flist, start_ts, end_ts),
+                   key=file_timestamp)
+    tables = []
+    for fname in flist:
+        table = read_arrow_file(fname, tstamp, columns)
+        if table.num_rows == 0:
+            continue
+        table = _filter_time(table, tstamp, start_ts, end_ts)
+        if table.num_rows:
+            tables.append(table)
+    if not tables:
+        names = [c for c in (columns or []) if c != tstamp] + [tstamp]
+        return pa.table([pa.array([], pa.int64() if c == tstamp else
+                                  pa.null()) for c in names], names=names)
+    return pa.concat_tables(_unify(tables))
+
+
+def slice_time(table, start_ts=None, end_ts=None, tstamp='timestamp'):
+    """Rows of an import_arrow() table in [start_ts, end_ts]
+
+    Notes
+    -----
+    import_arrow() tables are in time order, so this is a binary search and
+    a zero-copy slice (only the timestamp column is read). If the table is
+    not sorted, falls back to a (copying) filter.
+
+    """
+    return _filter_time(table, tstamp, start_ts, end_ts)
+
+
+def to_pandas(table, tstamp='timestamp', setindex=True, arrow_dtypes=False):
+    """Converts an Arrow table to a DataFrame like the one import_df() makes
+
+    Parameters
+    ----------
+    table : a pyarrow.Table (see import_arrow())
+    tstamp : name of the timestamp column
+    setindex : sets 'dt' (UTC, to the second) as the index, like import_df()
+    arrow_dtypes : if True, columns stay in Arrow memory (pandas.ArrowDtype,
+        needs pandas >= 1.5), so nothing is copied. Otherwise columns are
+        converted to numpy dtypes, one column at a time.
+
+    """
+    if arrow_dtypes is True:
+        df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    else:
+        df = table.to_pandas(split_blocks=True)
+    times = table.column(tstamp).to_numpy().astype(np.int64)
+    dt = (times // 1000).astype('datetime64[s]')
+    if setindex is True:
+        df.index = pd.DatetimeIndex(dt, name='dt')
+    else:
+        df['dt'] = dt
+    return df
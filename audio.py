@@ -3,17 +3,20 @@
     `beiwedata` scripts for audio data stream.
 """
 
+import os
 import subprocess
-from scipy.io import wavfile
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-import matplotlib
+from beiwedata._lazy import lazy_import
+from beiwedata.profiling import profiled
+from beiwedata._plotting import new_figure
 
-## Plot settings -- otherwise font changes at export
-pd.set_option('display.mpl_style', 'default')
-font = {'family': 'normal'}
-matplotlib.rc('font', **font)
+## scipy and matplotlib are slow to import so they are loaded on first use
+wavfile = lazy_import('scipy.io.wavfile')
+mpl = lazy_import('matplotlib')
+
+## Plot settings -- otherwise font changes at export. Only applied inside
+## plot_wav() so importing beiwedata doesn't change anybody else's plots.
+PLOT_RC = {'font.family': 'normal'}
 
 def convert_mp4(fname, outname=None):
     """Uses FFmpeg to convert .mp4 file to .wav file for analysis.
@@ -42,9 +45,13 @@ def convert_mp4(fname, outname=None):
     else:
         command = command + outname
 
-    subprocess.call(command, shell=True)
+    with profiled('convert_mp4', files=1) as p:
+        if p:
+            p.add(bytes=os.path.getsize(fname))
+        subprocess.call(command, shell=True)
 
-def plot_wav(fname, channel=0, psave=False, savename=None, fext='.pdf'):
+def plot_wav(fname, channel=0, psave=False, savename=None, fext='.pdf',
+             ax=None, headless=False):
     """Takes a .wav file and plots amplitude over time -- returns as fig
 
     Parameters
@@ -54,6 +61,8 @@ def plot_wav(fname, channel=0, psave=False, savename=None, fext='.pdf'):
     psave : save the plot as a file {True, False}
     savename : file will be saved with same name as fname unless you override
     fext : extension of file type (.pdf by default)
+    ax : draw on this axes instead of making a new figure
+    headless : if True, never touches pyplot (see new_figure())
 
     Notes
     -----
@@ -76,14 +85,18 @@ def plot_wav(fname, channel=0, psave=False, savename=None, fext='.pdf'):
     timearray = timearray / sampfreq  # convert from points to seconds
     timearray *= 1000  # convert to milliseconds
 
-    plt.plot(timearray, s1, color='k')
-    plt.ylabel('Amplitude')
-    plt.xlabel('Time (ms)')
-    fig = plt.gcf()
-    if psave is True:
-        fig.set_size_inches(12, 6)
-        if savename is None:
-            plt.savefig(fname[:-4] + fext, bbox_inches='tight')
+    with mpl.rc_context(PLOT_RC):
+        if ax is None:
+            fig, ax = new_figure(headless=headless)
         else:
-            plt.savefig(savename + fext, bbox_inches='tight')
+            fig = ax.figure
+        ax.plot(timearray, s1, color='k')
+        ax.set_ylabel('Amplitude')
+        ax.set_xlabel('Time (ms)')
+        if psave is True:
+            fig.set_size_inches(12, 6)
+            if savename is None:
+                fig.savefig(fname[:-4] + fext, bbox_inches='tight')
+            else:
+                fig.savefig(savename + fext, bbox_inches='tight')
     return fig
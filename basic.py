@@ -12,40 +12,42 @@
     this does not adhere to PEP8.
 """
 
+from __future__ import print_function
+
 import os
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 import calendar
 import datetime
 import csv
-from matplotlib.dates import HourLocator
-from mpl_toolkits.basemap import Basemap
-
-# Internal helper functions
-def _sms_sort(row, yval=1, spacer=.05):
-    if row['sent vs received'] == 'sent SMS':
-        return yval+spacer
-    if row['sent vs received'] == 'received SMS':
-        return yval-spacer
-
-
-def _call_end(row):
-    start_t = datetime.datetime.utcfromtimestamp(int(row['timestamp'] / 1000))
-    end_t = start_t + datetime.timedelta(0, row['duration in seconds'])
-    return end_t
-
-
-def _call_sort(row, yval=1.5, spacer=.05):
-    if row['call type'] == "Incoming Call":
-        return yval-spacer
-    ## keep missed calls separate for now in case we change this later
-    elif row['call type'] == "Missed Call":
-        return yval-spacer
-    elif row['call type'] == "Outgoing Call":
-        return yval+spacer
-    else:
-        return None
+from beiwedata._lazy import lazy_import
+from beiwedata.profiling import profiled
+from beiwedata._plotting import new_figure
+from beiwedata.store import cached_parse
+from beiwedata.places import time_buckets
+from beiwedata.power import freq_ms
+from beiwedata.archive import (ARCHIVE_EXT, archive_members, is_archived,
+                               member_info, open_data, data_stat,
+                               read_data_csv)
+from beiwedata.comm import (suppress_duplicates, call_type_codes,
+                            text_type_codes, call_end_times)
+
+## pandas and matplotlib are slow to import so they are loaded on first use
+pd = lazy_import('pandas')
+plt = lazy_import('matplotlib.pyplot')
+mdates = lazy_import('matplotlib.dates')
+
+## Name of the timestamp column of each stream (see list_data_files()). None
+## means the file has no timestamp and the file creation time is used. WiFi
+## files get their timestamp from the file name (see import_df()).
+TIMESTAMP_COLUMNS = {'accel': 'timestamp', 'app': None, 'blue': 'timestamp',
+                     'call': 'timestamp', 'gps': 'time', 'id': None,
+                     'power': 'time', 'survey_a': None,
+                     'survey_t': 'timestamp', 'text': 'timestamp',
+                     'wifi': None}
+
+## File prefix of "flat" downloads, where it doesn't start with the stream
+FLAT_PREFIXES = {'app': 'logFile', 'survey_a': 'surveyAnswers',
+                 'survey_t': 'surveyTimings'}
 
 
 def row_count(fpath):
@@ -59,16 +61,19 @@ def row_count(fpath):
     -----
     Only counts data rows. Does *not* count the header as a row. Thus,
     a return value of 0 indicates a file with only the header and no data. New
-    data processing procedures should eliminate empty files.
+    data processing procedures should eliminate empty files. Archived files
+    (see beiwedata.archive) are counted from the archive's index.
 
     """
+    if is_archived(fpath):
+        return member_info(fpath)[1]['rows']
     with open(fpath) as f:
         for i, _ in enumerate(f):
             pass
     return i
 
 
-def list_data_files(upath, stream='all', start_t=None, end_t=None):
+def list_data_files(upath, stream='all', start_t=None, end_t=None, nonempty=True):
     """Return a list of data files by user and data stream (no audio files)
 
     Parameters
@@ -89,6 +94,7 @@ def list_data_files(upath, stream='all', start_t=None, end_t=None):
     upath : directory of user_id
     start_t : datetime object of starting time (data is always in UTC)
     end_t : datetime object of ending time (data is always in UTC)
+    nonempty : if True, leaves out files with no data (header only)
 
     Usage
     -----
@@ -103,40 +109,71 @@ def list_data_files(upath, stream='all', start_t=None, end_t=None):
     
     Note that **voice recordings will not work** and have their own function.
 
+    Files are sorted by path, so the order is the same before and after
+    archiving (see beiwedata.archive).
+
     """
 
-    ## Walk the user path and get all .csv files
-    flist = []
-    for path, subdirs, files in os.walk(upath):
-        for name in files:
-            if name.endswith('.csv'):
-                flist.append(os.path.join(path, name))
-    
-    ## Subset out stream if necessary
-    ## Note nested surveys require indexing at -3, the rest at -2.
-    if stream != 'all':
-        flist = [f for f in flist if (f.split('/')[-2].startswith(stream)) or 
-                    (f.split('/')[-3].startswith(stream))]
-    
-    ## Filter out empty files
-    ## NOTE: This should **not** be necessary with new processing code
-    flist = [f for f in flist if row_count(f) > 0]
-    
-    ## Subset by time if end or start time specified
-    if (start_t is not None) or (end_t is not None):
-        times = [f.split('/')[-1].split('.')[-2] for f in flist]
-        times = [datetime.datetime.strptime(t, '%Y-%m-%d %H_%M_%S') 
-                    for t in times]
-        
-        ## Note the one hour buffer
-        if start_t is None:
-            start_t = min(times) - datetime.timedelta(hours=1)
-        if end_t is None:
-            end_t = max(times) + datetime.timedelta(hours=1)
-        
-        bools = np.array([t >= start_t and t <= end_t for t in times])
-        flist = list(np.array(flist)[bools])
-        
+    with profiled('list_data_files') as prof:
+        ## Walk the user path and get all .csv files
+        with profiled('list_data_files.walk') as p:
+            flist = []
+            archives = []
+            for path, subdirs, files in os.walk(upath):
+                for name in files:
+                    if name.endswith('.csv'):
+                        flist.append(os.path.join(path, name))
+                    elif name.endswith(ARCHIVE_EXT):
+                        archives.append(os.path.join(path, name))
+            ## Files inside archives, unless also on disk (see
+            ## beiwedata.archive)
+            if archives:
+                plain = set(flist)
+                flist.extend(f for a in archives for f in archive_members(a)
+                             if f not in plain)
+            ## Same order whether or not files are archived (os.walk order
+            ## isn't any order at all)
+            flist.sort()
+            if p:
+                p.add(files=len(flist))
+
+        ## Subset out stream if necessary
+        ## Note nested surveys require indexing at -3, the rest at -2. Older
+        ## "flat" downloads have the stream as a file prefix instead (see
+        ## describe_user())
+        if stream != 'all':
+            prefix = FLAT_PREFIXES.get(stream, stream)
+            flist = [f for f in flist if (f.split('/')[-2].startswith(stream)) or
+                        (f.split('/')[-3].startswith(stream)) or
+                        (f.split('/')[-1].split('_')[0].startswith(prefix) and
+                         f.split('/')[-1].count('_') == 1)]
+
+        ## Filter out empty files
+        ## NOTE: This should **not** be necessary with new processing code
+        if nonempty is True:
+            with profiled('list_data_files.nonempty', files=len(flist)) as p:
+                if p:
+                    p.add(bytes=sum(data_stat(f)[0] for f in flist))
+                flist = [f for f in flist if row_count(f) > 0]
+
+        ## Subset by time if end or start time specified
+        if (start_t is not None) or (end_t is not None):
+            times = [f.split('/')[-1].split('.')[-2] for f in flist]
+            times = [datetime.datetime.strptime(t, '%Y-%m-%d %H_%M_%S')
+                        for t in times]
+
+            ## Note the one hour buffer
+            if start_t is None:
+                start_t = min(times) - datetime.timedelta(hours=1)
+            if end_t is None:
+                end_t = max(times) + datetime.timedelta(hours=1)
+
+            bools = np.array([t >= start_t and t <= end_t for t in times])
+            flist = list(np.array(flist)[bools])
+
+        if prof:
+            prof.add(files=len(flist))
+
     return flist
 
 
@@ -189,13 +226,154 @@ def return_file(fname):
     Notes
     -----
     Returns the entire file so the first line will always be the header. Mostly
-    just a helper function for other functions.
+    just a helper function for other functions. Works on archived files too
+    (see beiwedata.archive). To scan big files, iter_rows() yields one row
+    at a time instead.
+
+    """
+    with open_data(fname, 'r') as f:
+        return [line for line in csv.reader(f)]
+
+
+def iter_rows(fname, columns=None, header=False):
+    """Yields the rows of a data file one at a time (lazy return_file())
+
+    Parameters
+    ----------
+    fname : path of a data file (plain or archived)
+    columns : list of column names to keep, in that order (default is all)
+    header : if True, the first row yielded is the header (stripped)
+
+    Usage
+    -----
+    ## Every log line of a study without holding any of them
+    for upath in list_users('./study'):
+        for fname in list_data_files(upath, 'app'):
+            for line, in iter_rows(fname, columns=['message']):
+                ...
+
+    Notes
+    -----
+    The header is parsed once and the file is read through a buffer, so
+    memory doesn't grow with the size of the file. The file is closed as
+    soon as the last row is read. To stop early and still close it right
+    away, use `with contextlib.closing(iter_rows(fname)) as rows:`.
 
     """
-    lines = []
-    for line in csv.reader(open(fname)):
-        lines.append(line)
-    return lines
+    with open_data(fname, 'r') as f:
+        reader = csv.reader(f)
+        names = [c.strip() for c in next(reader, [])]
+        if columns is None:
+            if header is True:
+                yield names
+            for row in reader:
+                yield row
+            return
+        missing = [c for c in columns if c not in names]
+        if missing:
+            raise ValueError("%s has no column(s) %s" % (fname,
+                                                        ', '.join(missing)))
+        picks = [names.index(c) for c in columns]
+        if header is True:
+            yield list(columns)
+        for row in reader:
+            yield [row[i] for i in picks]
+
+
+def iter_blocks(fname, rows=100000, columns=None):
+    """Yields a data file as DataFrames of at most `rows` rows
+
+    Parameters
+    ----------
+    fname : path of a data file (plain or archived)
+    rows : most rows per block
+    columns : list of columns to parse (default is all)
+
+    Notes
+    -----
+    Plain files are memory-mapped and parsed one block at a time; the file
+    is closed when the last block is read (or the generator is closed).
+    Headers are stripped like in import_df().
+
+    """
+    usecols = None
+    if columns is not None:
+        wanted = set(columns)
+        usecols = lambda c: c.strip() in wanted
+    if is_archived(fname):
+        ## Already decoded in memory (see beiwedata.archive): slice it
+        frame = read_data_csv(fname, usecols=usecols)
+        frame.columns = [c.strip() for c in frame.columns]
+        for start in range(0, max(len(frame), 1), rows):
+            yield frame.iloc[start:start + rows]
+        return
+    reader = pd.read_csv(fname, usecols=usecols, chunksize=rows,
+                         memory_map=True)
+    try:
+        for block in reader:
+            block.columns = [c.strip() for c in block.columns]
+            yield block
+    finally:
+        reader.close()
+
+
+def read_array(fname, columns=None, dtype=None):
+    """Reads a numeric data file into a NumPy structured array
+
+    Parameters
+    ----------
+    fname : path of a data file (plain or archived)
+    columns : list of columns to read (default is all)
+    dtype : one dtype for every column (e.g., 'f8'). Default keeps each
+        column's own (int64 timestamps, float64 readings).
+
+    Usage
+    -----
+    accel = read_array(fname, columns=['timestamp', 'x', 'y', 'z'])
+    accel['x'].mean()
+
+    Notes
+    -----
+    One contiguous array with a field per column -- no DataFrame, index or
+    Python object per value. Text columns (e.g., MACs) raise ValueError;
+    use import_df() for those.
+
+    """
+    usecols = None
+    if columns is not None:
+        wanted = set(columns)
+        usecols = lambda c: c.strip() in wanted
+    frame = read_data_csv(fname, usecols=usecols)
+    frame.columns = [c.strip() for c in frame.columns]
+    names = list(columns) if columns is not None else list(frame.columns)
+    text = [c for c in names if getattr(frame[c].dtype, 'kind', 'O') not in
+            'biuf' and len(frame)]
+    if text:
+        raise ValueError("Not numeric: %s (use import_df())" %
+                         ', '.join(text))
+    out = np.empty(len(frame), dtype=[(str(c), dtype or frame[c].dtype)
+                                      for c in names])
+    for c in names:
+        out[str(c)] = frame[c].values
+    return out
+
+
+def file_timestamp(fname):
+    """Returns the time of file creation (from the file name) in Java time
+
+    Parameters
+    ----------
+    fname : path of a data file, either as downloaded
+        (`.../2015-05-07 14_00_00.csv`) or with the older naming
+        (`.../gps_1431007200000.csv`)
+
+    """
+    stem = os.path.basename(fname).rsplit('.', 1)[0]
+    try:
+        dt = datetime.datetime.strptime(stem, '%Y-%m-%d %H_%M_%S')
+    except ValueError:
+        return int(stem.split('_')[-1])
+    return calendar.timegm(dt.timetuple()) * 1000
 
 
 def make_timestamp(yr, mo, dy, hr=0, mi=0, java=True):
@@ -226,7 +404,52 @@ def make_timestamp(yr, mo, dy, hr=0, mi=0, java=True):
     return int(timestamp)
 
 
-def import_df(flist, tstamp='timestamp', setindex=True):
+def files_in_window(flist, start_ts=None, end_ts=None):
+    """Leaves out files that cannot hold data between start_ts and end_ts
+
+    Parameters
+    ----------
+    flist : list of files (usually generated from list_data_files())
+    start_ts : Java time (see make_timestamp())
+    end_ts : Java time
+
+    Notes
+    -----
+    Only uses file names (see file_timestamp()). A file can't hold data from
+    before it was created or from after the next file in the same folder
+    was created, so this is conservative: the last file of each folder is
+    kept whenever it starts before end_ts. Order of flist is preserved.
+
+    """
+    if start_ts is None and end_ts is None:
+        return list(flist)
+    stamps = dict((f, file_timestamp(f)) for f in flist)
+    folders = {}
+    for f in flist:
+        folders.setdefault(os.path.dirname(f), []).append(f)
+    keep = set()
+    for files in folders.values():
+        files = sorted(files, key=stamps.get)
+        for i, f in enumerate(files):
+            if end_ts is not None and stamps[f] > end_ts:
+                break
+            if (start_ts is not None and i + 1 < len(files) and
+                    stamps[files[i + 1]] <= start_ts):
+                continue
+            keep.add(f)
+    return [f for f in flist if f in keep]
+
+
+def _read_frame(fname, usecols):
+    """One parsed file of import_df(), before the time filter"""
+    frame = read_data_csv(fname, usecols=usecols)
+    ## Some headers randomly have whitespace in them. Strip
+    ## (before the concat or the columns won't line up).
+    frame.columns = [c.strip() for c in frame.columns]
+    return frame
+
+
+def import_df(flist, tstamp='timestamp', setindex=True, columns=None, start_ts=None, end_ts=None):
     """Merges files into a single pandas dataframe with UTC readable time
 
     Parameters
@@ -234,6 +457,17 @@ def import_df(flist, tstamp='timestamp', setindex=True):
     flist : list of files (usually generated from list_data_files())
     tstamp : name of the timestamp variable header (not all are the same)
     setindex : sets 'datetime' to the dataframe index.
+    columns : list of columns to read (default is all). The timestamp column
+        is always read.
+    start_ts : only keep rows at or after this Java time (see make_timestamp())
+    end_ts : only keep rows at or before this Java time
+
+    Usage
+    -----
+    ## One day of x-axis data without parsing the other columns
+    df = import_df(list_data_files(upath, 'accel'), columns=['x'],
+                   start_ts=make_timestamp(2015, 5, 5),
+                   end_ts=make_timestamp(2015, 5, 6))
 
     Notes
     -----
@@ -241,28 +475,63 @@ def import_df(flist, tstamp='timestamp', setindex=True):
     programmers to make all timestamp headers consistent, so we won't need
     the `tstamp` parameter.
 
-    """
-    ## Iterate through and append all the dataframes
-    slices = []
-    for f in flist:
-        frame = pd.read_csv(f)
-        if "wifiLog" in f:
-            frame[tstamp] = int(f.split('_')[-1].split('.')[0])
-        slices.append(frame)
+    Files that can't overlap [start_ts, end_ts] are never opened (see
+    files_in_window()) and rows outside it are dropped file by file, so
+    only the data you asked for is ever concatenated. Files without a
+    `tstamp` column (e.g., WiFi) get the file creation time. Files that are
+    hard links to each other (downloads through a store, see
+    beiwedata.store) are only parsed once.
 
-    ## Concatenate them into one large dataframe (ignore_index must be True)
-    whole = pd.concat(slices, ignore_index=True)
+    """
+    if columns is not None:
+        wanted = set(columns) | set([tstamp])
+        usecols = lambda c: c.strip() in wanted
+        options = tuple(sorted(wanted))
+    else:
+        usecols = options = None
+
+    with profiled('import_df', files=len(flist)) as prof:
+        flist = files_in_window(flist, start_ts, end_ts)
+
+        ## Iterate through and append all the dataframes
+        with profiled('import_df.read', files=len(flist)) as p:
+            slices = []
+            for f in flist:
+                ## Hard links to the same file (see beiwedata.store) are
+                ## parsed once
+                frame = cached_parse(f, lambda f: _read_frame(f, usecols),
+                                     (tstamp, options))
+                ## The file name's time differs between links to the same
+                ## bytes, so it's added after the cache, on a copy
+                if tstamp not in frame.columns:
+                    frame = frame.assign(**{tstamp: file_timestamp(f)})
+                if start_ts is not None:
+                    frame = frame[frame[tstamp] >= start_ts]
+                if end_ts is not None:
+                    frame = frame[frame[tstamp] <= end_ts]
+                slices.append(frame)
+                if p:
+                    p.add(bytes=data_stat(f)[0], rows=len(frame))
+
+        ## Concatenate them into one large dataframe (ignore_index must be True)
+        with profiled('import_df.concat'):
+            if slices:
+                whole = pd.concat(slices, ignore_index=True)
+            else:
+                whole = pd.DataFrame(columns=list(columns or []) + [tstamp])
 
-    ## Turn timestamps into human-readable time (Remember, it's in UTC)
-    whole['dt'] = [datetime.datetime.utcfromtimestamp(int(t / 1000))
-                   for t in whole[tstamp]]
+        ## Turn timestamps into human-readable time (Remember, it's in UTC)
+        with profiled('import_df.timestamps', rows=len(whole)):
+            whole['dt'] = [datetime.datetime.utcfromtimestamp(int(t / 1000))
+                           for t in whole[tstamp]]
 
-    ## Some headers randomly have whitespace in them. Strip.
-    whole = whole.rename(columns=lambda x: x.strip())
+        ## Set index to datetime for better x-axis labeling
+        if setindex is True:
+            with profiled('import_df.index'):
+                whole.set_index('dt', inplace=True)
 
-    ## Set index to datetime for better x-axis labeling
-    if setindex is True:
-        whole.set_index('dt', inplace=True)
+        if prof:
+            prof.add(rows=len(whole))
 
     return whole
 
@@ -309,7 +578,7 @@ def ts_to_utc(timestamp):
 
 
 def plot_accel(df, start_ts=None, end_ts=None, ts_col='timestamp',
-               psave=False, savename=None):
+               psave=False, savename=None, headless=False):
     """Plots accelerometer data.
 
     Parameters
@@ -320,6 +589,7 @@ def plot_accel(df, start_ts=None, end_ts=None, ts_col='timestamp',
     ts_col : specify name of the timestamp column in the pandas.DataFrame
     psave : If True, saves the plot
     savename : name of the saved plot
+    headless : if True, never touches pyplot (see new_figure())
 
     Notes
     -----
@@ -330,18 +600,18 @@ def plot_accel(df, start_ts=None, end_ts=None, ts_col='timestamp',
     """
     # If time slice not specified, just make a huge slice. Fix this later.
     if (start_ts is None) and (end_ts is None):
-        start_ts = make_timestamp(2000, 01, 01)
+        start_ts = make_timestamp(2000, 1, 1)
         end_ts = make_timestamp(2030, 12, 31)
 
     ## Verify timestamps
     if len(str(start_ts) + str(end_ts)) < 25:
-        print "\nInvalid timestamp(s). See make_timestamp().\n"
+        print("\nInvalid timestamp(s). See make_timestamp().\n")
     else:
         # slice out data
         subdf = df[(df[ts_col] >= start_ts) & (df[ts_col] <= end_ts)]
 
         # plot x y z
-        fig, axes = plt.subplots(nrows=3, ncols=1)
+        fig, axes = new_figure(nrows=3, ncols=1, headless=headless)
         fig.set_size_inches(8, 5)
         subdf['x'].plot(ax=axes[0], color='k', sharex=True)
         subdf['y'].plot(ax=axes[1], color='red', sharex=True)
@@ -364,21 +634,20 @@ def plot_accel(df, start_ts=None, end_ts=None, ts_col='timestamp',
         # x axis
         timeaxis = range(0, 25, 4)
         timelabs = ['0 h', '4 h', '8 h', '12 h', '16 h', '20 h', '0 h']
-        axes[0].xaxis.set_major_locator(HourLocator(byhour=timeaxis))
-        axes[1].xaxis.set_major_locator(HourLocator(byhour=timeaxis))
-        axes[2].xaxis.set_major_locator(HourLocator(byhour=timeaxis))
+        axes[0].xaxis.set_major_locator(mdates.HourLocator(byhour=timeaxis))
+        axes[1].xaxis.set_major_locator(mdates.HourLocator(byhour=timeaxis))
+        axes[2].xaxis.set_major_locator(mdates.HourLocator(byhour=timeaxis))
         axes[2].xaxis.set_ticklabels(timelabs)
         axes[2].xaxis.reset_ticks()
         axes[2].set_xlabel("")
 
         # save?
         if psave is True:
-            figure = plt.gcf()
-            figure.set_size_inches(12, 6)
+            fig.set_size_inches(12, 6)
             if savename is None:
-                plt.savefig('accel_plot.pdf', bbox_inches='tight')
+                fig.savefig('accel_plot.pdf', bbox_inches='tight')
             else:
-                plt.savefig(savename, bbox_inches='tight')
+                fig.savefig(savename, bbox_inches='tight')
 
         return fig, axes
 
@@ -402,16 +671,20 @@ def describe_user(fpath):
     ## Create a list of all the files, then split to get the type of data, then
     ## turn it into a set to get unique values, then turn it into a sorted list
     ## so we can import it into a pandas.DataFrame.
-    ftypes = [f.split('_')[-2] for f in os.listdir(fpath) if f.endswith('.csv')]
+    names = os.listdir(fpath)
+    names += [os.path.basename(f) for a in names if a.endswith(ARCHIVE_EXT)
+              for f in archive_members(os.path.join(fpath, a))]
+    ftypes = [f.split('_')[-2] for f in names if f.endswith('.csv')]
     ftypes = list(set(ftypes))
     ftypes.sort()
 
     ## Get a dictionary of all stream : files pairs. Makes getting timestamps
     ## easier later on.
-    flist_nonempty = {ftype: list_data_files(stream=ftype,
-                                             fpath=fpath) for ftype in ftypes}
+    flist_nonempty = {ftype: sorted(list_data_files(stream=ftype,
+                                                    upath=fpath))
+                      for ftype in ftypes}
     flist_all = {ftype: list_data_files(stream=ftype,
-                                        fpath=fpath, nonempty=False) for
+                                        upath=fpath, nonempty=False) for
                  ftype in ftypes}
 
     ## make the columns
@@ -430,7 +703,7 @@ def describe_user(fpath):
     ## nonempty data file will have to suffice.
     ## first split will get the timestamp. Second split removes extension.
     ## Ternary operator checks for empty list and returns None if empty.
-    first = [flist_nonempty[f][-1].split('_')[-1].split('.csv')[0] if
+    first = [flist_nonempty[f][0].split('_')[-1].split('.csv')[0] if
              flist_nonempty[f] else None for f in ftypes]
     last = [flist_nonempty[f][-1].split('_')[-1].split('.csv')[0] if
             flist_nonempty[f] else None for f in ftypes]
@@ -453,11 +726,9 @@ def plot_gps(df, start_ts, end_ts, bounds=None, spacer=.001,
              res='c', proj='merc',
              dcoast=False, dbound=False,
              dscale=False, sspacer=None, slength=1,
-             psave=False, savename=None):
+             psave=False, savename=None, ax=None, headless=False):
     """Plots users GPS points
 
-    ***NOTE***: NEED TO ADD psave function later.
-
     Parameters
     ----------
     df : a pandas.DataFrame containing GPS data (via import_df())
@@ -482,19 +753,24 @@ def plot_gps(df, start_ts, end_ts, bounds=None, spacer=.001,
     slength : length (in km) of scale
     psave : if true, save the plot
     savename : name of the plot to be saved
+    ax : draw on this axes instead of making a new figure
+    headless : if True, never touches pyplot (see new_figure())
 
     Notes
     -----
-    Assumes you have `basemap` installed. So install it.
+    Assumes you have `basemap` installed. So install it. See plot_gps_density()
+    for a much faster version that does not need basemap.
 
     """
+    from mpl_toolkits.basemap import Basemap
+
     ## Data stuff
     ## If time slice not specified, just make a huge slice. Fix this later.
     if (start_ts is None) and (end_ts is None):
-        start_ts = make_timestamp(2000, 01, 01)
+        start_ts = make_timestamp(2000, 1, 1)
         end_ts = make_timestamp(2030, 12, 31)
 
-    sub = df[(df[ts_col] >= start_ts) & (df[ts_col] <= end_ts)].copy()
+    sub = df[(df[ts_col] >= start_ts) & (df[ts_col] <= end_ts)]
 
     ## Set up map
     if bounds is None:
@@ -507,9 +783,13 @@ def plot_gps(df, start_ts, end_ts, bounds=None, spacer=.001,
         lllon = bounds[1]
         urlat = bounds[2]
         urlon = bounds[3]
+    if ax is None:
+        fig, ax = new_figure(headless=headless)
+    else:
+        fig = ax.figure
     m = Basemap(llcrnrlat=lllat, llcrnrlon=lllon,
                 urcrnrlat=urlat, urcrnrlon=urlon,
-                resolution=res, projection=proj)
+                resolution=res, projection=proj, ax=ax)
     if dcoast is True:
         m.drawcoastlines()
     if dbound is True:
@@ -532,9 +812,12 @@ def plot_gps(df, start_ts, end_ts, bounds=None, spacer=.001,
     x, y = m(sub.longitude.values, sub.latitude.values)
 
     ## Plotting
-    plt.plot(x, y, '.', color='red', alpha=.75, ms=2)
+    ax.plot(x, y, '.', color='red', alpha=.75, ms=2)
 
-    fig = plt.gcf()
+    if psave is True:
+        if savename is None:
+            savename = 'gps_plot.pdf'
+        fig.savefig(savename, bbox_inches='tight')
 
     return fig
 
@@ -589,7 +872,7 @@ def duplicates(df, tbuffer=3000):
     return dupes
 
 
-def rank_mac(df, start_ts, end_ts, n=5, cname='MAC', merged=True, agg='15S'):
+def rank_mac(df, start_ts, end_ts, n=5, cname='MAC', merged=True, agg='15s'):
     """Takes a WiFi or Bluetooth dataframe and returns most frequent MACs
 
     Parameters
@@ -601,7 +884,7 @@ def rank_mac(df, start_ts, end_ts, n=5, cname='MAC', merged=True, agg='15S'):
     cname : Column name of MAC address -- programmers didn't keep it consistent
     merged : When True, will merge the ranking dataframe with the full df, else
                 just returns the rankings of MAC addresses
-    agg : Aggregation unit. See pandas resampling for more. E.g., '5Min', '1S'.
+    agg : Aggregation unit. See pandas resampling for more. E.g., '5Min', '1s'.
 
     Notes
     -----
@@ -611,16 +894,15 @@ def rank_mac(df, start_ts, end_ts, n=5, cname='MAC', merged=True, agg='15S'):
     have fewer markers. This is actually an artifact of temporal resolution.
 
     Thus, I aggregate into 15 second windows (can be specified by the user) and
-    count devices that occur in that window only once.
+    count devices that occur in that window only once (see time_buckets()).
     """
     ## subset by time
     sub = df[(df['timestamp'] >= start_ts) &
              (df['timestamp'] <= end_ts)].copy()
 
     if agg is not None:
-        temp = sub.groupby(pd.TimeGrouper('15S'),
-                           as_index=False).apply(lambda x: x[cname])
-        sub['period'] = temp.index.get_level_values(0)
+        sub['period'] = pd.to_datetime(time_buckets(sub['timestamp'], agg),
+                                       unit='ms')
 
     ## group by MAC IDs
     subgrouped = sub.groupby(cname)
@@ -628,9 +910,9 @@ def rank_mac(df, start_ts, end_ts, n=5, cname='MAC', merged=True, agg='15S'):
     ## Count the number of observations (timestamps), sort, take first N
     if agg is not None:
         most_df = sub.groupby(cname).agg({'period': lambda x:
-                          x.nunique()}).sort('period', ascending=False).head(n)
+                          x.nunique()}).sort_values('period', ascending=False).head(n)
     else:
-        most_df = subgrouped.count().sort('timestamp', ascending=False).head(n)
+        most_df = subgrouped.count().sort_values('timestamp', ascending=False).head(n)
 
     ## Add a new variable that will dictate y-axis placement
     most_df['yheight'] = np.arange(len(most_df))[::-1] + 1
@@ -650,7 +932,7 @@ def rank_mac(df, start_ts, end_ts, n=5, cname='MAC', merged=True, agg='15S'):
 def plot_most_macs(macdf, spacer=.25, m='|', ms=6,
                    plot_others=False, strength=None,
                    others_spacer=10, others_marker='|', others_color='k',
-                   others_ms=6):
+                   others_ms=6, ax=None, headless=False):
     """Takes a ranked/merged Bluetooth or WiFi df and plots it
 
     Parameters
@@ -662,60 +944,68 @@ def plot_most_macs(macdf, spacer=.25, m='|', ms=6,
     plot_others : Boolean -- should you plot all unranked MACs (on one line)?
     others_spacer : How much space to separate others line
     strength : plot colors based on strength quantile (e.g., 4 - quartiles)
+    ax : draw on this axes instead of making a new figure
+    headless : if True, never touches pyplot (see new_figure())
 
     """
-    df = macdf.copy()
+    ## Work on the two columns we need instead of copying the whole frame
+    dates = macdf.index
+    yheight = macdf['yheight'].values.astype(float)
 
     if plot_others is True:
-        naheight = int(df.yheight.min()) - others_spacer
-        df.yheight.fillna(naheight, inplace=True)
+        naheight = int(np.nanmin(yheight)) - others_spacer
+        yheight = np.where(np.isnan(yheight), naheight, yheight)
 
-    maxrank = int(df.yheight.max())
-    minrank = int(df.yheight.min())
+    maxrank = int(np.nanmax(yheight))
+    minrank = int(np.nanmin(yheight))
 
-    fig, ax = plt.subplots()
+    if ax is None:
+        fig, ax = new_figure(headless=headless)
+    else:
+        fig = ax.figure
 
     ## Plot colors based on signal strength quantile
     if strength is None:
         if plot_others is False:
-            ax.plot_date(x=df.index, y=df.yheight.values,
+            ax.plot_date(x=dates, y=yheight,
                          marker=m, markersize=ms)
         else:
-            NA_index = (df['yheight'] == naheight)
-            ax.plot_date(x=df.loc[~NA_index, ].index,
-                         y=df.loc[~NA_index, 'yheight'].values,
+            NA_index = (yheight == naheight)
+            ax.plot_date(x=dates[~NA_index],
+                         y=yheight[~NA_index],
                          marker=m, markersize=ms)
-            ax.plot_date(x=df.loc[NA_index, ].index,
-                         y=df.loc[NA_index, 'yheight'].values,
+            ax.plot_date(x=dates[NA_index],
+                         y=yheight[NA_index],
                          marker=others_marker, markersize=others_ms,
                          c=others_color)
     else:
         # gets a colormap from matplotlib -- evenly spaced according categories
         # note that we start at .3 because 0 is white and looks bad.
-        colormap = [plt.cm.Blues(i) for i in np.linspace(.3, 1, strength)]
+        from matplotlib import cm
+        colormap = [cm.Blues(i) for i in np.linspace(.3, 1, strength)]
         ax.set_color_cycle(colormap)
 
         # create quantile groupings -- note we do NOT drop unranked ones
-        df['strength'] = pd.cut(df.RSSI, strength, labels=False)
+        quantile = pd.cut(macdf.RSSI, strength, labels=False).values
 
         # loop it and plot. slight alpha for overlapping cases.
         for q in range(strength):
             # create a boolean array for indexing the dataframe
             if plot_others is True:
-                row_index = (df['strength'] == q) & (df['yheight'] > naheight)
+                row_index = (quantile == q) & (yheight > naheight)
             else:
-                row_index = df['strength'] == q
+                row_index = quantile == q
 
             # plot
-            ax.plot_date(x=df.loc[row_index, ].index,
-                         y=df.loc[row_index, 'yheight'].values,
+            ax.plot_date(x=dates[row_index],
+                         y=yheight[row_index],
                          marker=m, markersize=ms, alpha=.9)
 
         if plot_others is True:
             ax.set_color_cycle(None)
-            NA_index = (df['yheight'] == naheight)
-            ax.plot_date(x=df.loc[NA_index, ].index,
-                         y=df.loc[NA_index, 'yheight'].values,
+            NA_index = (yheight == naheight)
+            ax.plot_date(x=dates[NA_index],
+                         y=yheight[NA_index],
                          c=others_color, marker=others_marker, markersize=ms)
 
     # y-axis modifications
@@ -726,7 +1016,7 @@ def plot_most_macs(macdf, spacer=.25, m='|', ms=6,
     return fig, ax
 
 
-def plot_n_macs(df, start_ts, end_ts, cname='MAC', agg='5Min'):
+def plot_n_macs(df, start_ts, end_ts, cname='MAC', agg='5Min', headless=False):
     """Creates subplots of MAC address -- uniques and cumulative
 
     df : a Bluetooth or WiFi dataframe (see import_df())
@@ -734,13 +1024,21 @@ def plot_n_macs(df, start_ts, end_ts, cname='MAC', agg='5Min'):
     end_ts : ending time (see make_timestamp())
     cname : name of the MAC column
     agg : aggregation unit
+    headless : if True, never touches pyplot (see new_figure())
     """
     sub = df[(df['timestamp'] >= start_ts) &
-             (df['timestamp'] <= end_ts)].copy()
-    sub_grouped = sub.groupby(pd.TimeGrouper(agg))
-    sub_unique = sub_grouped[cname].nunique()
-
-    fig, axes = plt.subplots(2, sharex=True)
+             (df['timestamp'] <= end_ts)]
+    ## Every bucket from the first to the last, empty ones included
+    buckets = time_buckets(sub['timestamp'], agg)
+    sub_unique = sub.groupby(buckets)[cname].nunique()
+    if len(sub_unique):
+        width = freq_ms(agg)
+        sub_unique = sub_unique.reindex(
+            np.arange(buckets.min(), buckets.max() + width, width),
+            fill_value=0)
+    sub_unique.index = pd.to_datetime(sub_unique.index, unit='ms')
+
+    fig, axes = new_figure(2, sharex=True, headless=headless)
 
     ## Unique devices
     axes[0].plot_date(x=sub_unique.index,
@@ -757,7 +1055,7 @@ def plot_n_macs(df, start_ts, end_ts, cname='MAC', agg='5Min'):
     return fig, axes
 
 
-def plot_calls_texts(calldf, textdf, start_ts, end_ts, xbuffer = 5):
+def plot_calls_texts(calldf, textdf, start_ts, end_ts, xbuffer = 5, dedupe=False, ax=None, headless=False):
     """Takes a call dataframe **and** a text dataframe and returns a figure
 
     Parameters
@@ -767,45 +1065,52 @@ def plot_calls_texts(calldf, textdf, start_ts, end_ts, xbuffer = 5):
     start_ts : starting timestamp generated by make_timestamp()
     end_ts : ending timestamp generated by make_timestamp()
     xbuffer : buffer to put on the x-axis (in minutes)
+    dedupe : if True, leaves out suspected duplicates (see suppress_duplicates())
+    ax : draw on this axes instead of making a new figure
+    headless : if True, never touches pyplot (see new_figure())
 
     """
     ## Subset both datasets
     sub_call = calldf[(calldf['timestamp'] >= start_ts) &
-                      (calldf['timestamp'] <= end_ts)].copy()
+                      (calldf['timestamp'] <= end_ts)]
     sub_text = textdf[(textdf['timestamp'] >= start_ts) &
-                      (textdf['timestamp'] <= end_ts)].copy()
-
-    ## Extract incoming and outgoing texts
-    sub_text['sms'] = sub_text.apply(lambda row: _sms_sort(row), axis=1)
-    inctexts = sub_text.loc[sub_text['sent vs received'] == 'received SMS',
-                            'sms']
-    outtexts = sub_text.loc[sub_text['sent vs received'] == 'sent SMS',
-                            'sms']
-
-    ## Extract incoming and outgoing calls
-    sub_call['call'] = sub_call.apply(lambda row: _call_sort(row), axis=1)
-    sub_call['callend'] = sub_call.apply(lambda row: _call_end(row), axis=1)
-    inccalls = sub_call.loc[sub_call['call type'] == 'Incoming Call',
-                            ['call', 'callend']]
-    outcalls = sub_call.loc[sub_call['call type'] == 'Outgoing Call',
-                            ['call', 'callend']]
-    misscalls = sub_call.loc[sub_call['call type'] == 'Missed Call',
-                             ['call', 'callend']]
+                      (textdf['timestamp'] <= end_ts)]
+    if dedupe is True:
+        sub_call = sub_call[~suppress_duplicates(sub_call)]
+        sub_text = sub_text[~suppress_duplicates(sub_text)]
+
+    ## Extract incoming and outgoing texts (y: 1 -/+ spacer)
+    kind = text_type_codes(sub_text)
+    inctexts = pd.Series(1 - .05, index=sub_text.index[kind == 0])
+    outtexts = pd.Series(1 + .05, index=sub_text.index[kind == 1])
+
+    ## Extract incoming and outgoing calls (y: 1.5 -/+ spacer). Keep missed
+    ## calls separate for now in case we change this later.
+    kind = call_type_codes(sub_call)
+    callend = call_end_times(sub_call)
+    calls = {}
+    for code, y in [(0, 1.5 - .05), (1, 1.5 + .05), (2, 1.5 - .05)]:
+        calls[code] = pd.DataFrame({'call': y, 'callend': callend[kind == code]},
+                                   index=sub_call.index[kind == code])
+    inccalls, outcalls, misscalls = calls[0], calls[1], calls[2]
 
     ## Plot
-    fig, axes = plt.subplots()
+    if ax is None:
+        fig, axes = new_figure(headless=headless)
+    else:
+        fig, axes = ax.figure, ax
     axes.grid(False)
 
     ## Plot texts
-    plt.plot_date(x=inctexts.index, y=inctexts.values, marker='|', c='k', ms=7)
-    plt.plot_date(x=outtexts.index, y=outtexts.values, marker='|', c='k', ms=7)
+    axes.plot_date(x=inctexts.index, y=inctexts.values, marker='|', c='k', ms=7)
+    axes.plot_date(x=outtexts.index, y=outtexts.values, marker='|', c='k', ms=7)
 
     ## Plot calls
-    plt.plot_date(x=inccalls.index, y=inccalls.call.values, marker='|',
+    axes.plot_date(x=inccalls.index, y=inccalls.call.values, marker='|',
                   c='k', ms=9)
-    plt.plot_date(x=outcalls.index, y=outcalls.call.values, marker='|',
+    axes.plot_date(x=outcalls.index, y=outcalls.call.values, marker='|',
                   c='k', ms=9)
-    plt.plot_date(x=misscalls.index, y=misscalls.call.values, marker='x')
+    axes.plot_date(x=misscalls.index, y=misscalls.call.values, marker='x')
     axes.hlines(y=inccalls['call'],
                 xmin=inccalls.index,
                 xmax=inccalls.callend.values,
@@ -814,7 +1119,7 @@ def plot_calls_texts(calldf, textdf, start_ts, end_ts, xbuffer = 5):
                 xmin=outcalls.index,
                 xmax=outcalls.callend.values,
                 lw=4)
-    plt.plot_date(x=misscalls.index, y=misscalls.call.values, marker='x',
+    axes.plot_date(x=misscalls.index, y=misscalls.call.values, marker='x',
                   c='red', ms=6)
 
     ## Plot settings
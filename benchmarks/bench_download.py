@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+    Download throughput against the local mock Beiwe server.
+
+    Serves a synthetic study with beiwedata.mockserver and downloads it with
+    make_request(), one request per user, from 1, 2, 4, ... worker processes
+    (make_request() changes directory, so workers are processes, not
+    threads). Reports MB/s and files/s for every number of workers, then
+    checks that a second sync of the same folders sends nothing. Every user
+    gets a folder of its own, as concurrent requests can't share one
+    master_registry. Results are
+    recorded and compared like bench_functions.py.
+
+    Usage
+    -----
+    python benchmarks/bench_download.py
+    python benchmarks/bench_download.py --users 8 --workers 1 4 8
+    python benchmarks/bench_download.py --latency .2 --bandwidth 5e6
+
+    Notes
+    -----
+    `size` in the results is the number of workers. --latency (seconds per
+    response) and --bandwidth (bytes per second per response) make the
+    server behave more like studies.beiwe.org than a loopback socket does.
+
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+
+from beiwedata.download import make_request
+from beiwedata.mockserver import serve_mock
+
+
+def _download(args):
+    """Downloads one user. Runs in a worker process."""
+    server, user, folder = args
+    study_id, url, access_key, secret_key = server
+    ## One folder (and master_registry) per user: concurrent requests can't
+    ## share a registry file
+    return make_request(study_id, access_key, secret_key, user_ids=[user],
+                        folder=os.path.join(folder, user), return_new=True,
+                        verbose=False, base_url=url)
+
+
+def sync(server, users, folder, workers):
+    """Downloads every user into folder, returns the new files"""
+    key = (server.study_id, server.url, server.access_key, server.secret_key)
+    jobs = [(key, user, folder) for user in users]
+    if workers == 1:
+        results = [_download(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_download, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [f for new in results for f in new]
+
+
+def run(n_users, days, scale, workers, latency=0., bandwidth=None, seed=1):
+    results = []
+    server = serve_mock(n_users=n_users, days=days, scale=scale, seed=seed,
+                        latency=latency, bandwidth=bandwidth)
+    tmp = tempfile.mkdtemp(prefix='beiwedata_bench_')
+    try:
+        users = sorted(os.listdir(server.studies[server.study_id]['root']))
+        for n in workers:
+            folder = os.path.join(tmp, 'w%d' % n)
+            os.makedirs(folder)
+            sent = server.stats['bytes']
+            start = time.time()
+            new = sync(server, users, folder, n)
+            elapsed = time.time() - start
+            mb = (server.stats['bytes'] - sent) / 1e6
+            print('workers=%-3d files=%-6d %7.2f MB %.3fs  %7.2f MB/s '
+                  '%8.1f files/s' % (n, len(new), mb, elapsed, mb / elapsed,
+                                     len(new) / elapsed))
+            results.append({'name': 'download', 'size': n, 'days': days,
+                            'seconds': elapsed, 'rows': len(new),
+                            'mb': mb, 'error': None})
+
+            ## Same folder again: the registry should make this a no-op
+            start = time.time()
+            again = sync(server, users, folder, n)
+            elapsed = time.time() - start
+            print('workers=%-3d resync: %d new files, %.3fs' % (
+                n, len(again), elapsed))
+            results.append({'name': 'resync', 'size': n, 'days': days,
+                            'seconds': elapsed, 'rows': len(again),
+                            'error': None if not again else
+                            '%d files sent again' % len(again)})
+        print('most requests in flight: %d' % server.stats['max_active'])
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--scale', type=float, default=.5)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--latency', type=float, default=0.)
+    parser.add_argument('--bandwidth', type=float, default=None)
+    parser.add_argument('--output', default=common.DEFAULT_RESULTS)
+    parser.add_argument('--threshold', type=float, default=1.2)
+    parser.add_argument('--no-record', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = run(args.users, args.days, args.scale, args.workers,
+                  args.latency, args.bandwidth)
+    print('')
+    regressions = common.compare(results, args.output, args.threshold)
+    if not args.no_record:
+        common.record(results, args.output)
+    failed = [r for r in results if r['error']]
+    return 1 if regressions or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
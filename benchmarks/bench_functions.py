@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks for the main `beiwedata` functions on synthetic data.
+
+    For every size, writes a synthetic user (see beiwedata.synthetic) and times
+    list_data_files(), row_count(), import_df(), duplicates(), rank_mac(),
+    describe_user() and the plot functions. Results are appended to
+    benchmarks/results.jsonl together with the git revision, and compared
+    against the last run of a different revision.
+
+    Usage
+    -----
+    python benchmarks/bench_functions.py
+    python benchmarks/bench_functions.py --sizes .1 1 5 --days 3
+    python benchmarks/bench_functions.py --only import_df rank_mac
+
+    Notes
+    -----
+    `size` multiplies the number of rows per file (scale in make_user()).
+    A function that fails (e.g., plot_gps() without basemap) is recorded with
+    its error instead of a time. Exits with code 1 if anything got slower than
+    --threshold times the previous run.
+
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+import traceback
+
+import common
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from beiwedata.basic import (list_data_files, row_count, import_df,
+                             duplicates, rank_mac, describe_user, plot_accel,
+                             plot_gps, plot_most_macs, plot_n_macs,
+                             plot_calls_texts, make_timestamp)
+from beiwedata.audio import plot_wav
+from beiwedata.gps import plot_gps_density
+from beiwedata.basic import list_audio_files
+from beiwedata.synthetic import make_user
+
+
+def close_figures():
+    plt.close('all')
+
+
+def benchmarks(upath, flatpath, days):
+    """Returns a list of (name, setup, func, teardown)
+
+    setup() returns the number of input rows (or files) and is not timed.
+    """
+    start_ts = make_timestamp(2015, 5, 5)
+    end_ts = make_timestamp(2015, 5, 5 + days)
+    frames = {}
+
+    def frame(stream, tstamp='timestamp'):
+        if stream not in frames:
+            frames[stream] = import_df(list_data_files(upath, stream),
+                                       tstamp=tstamp)
+        return frames[stream]
+
+    def ranked():
+        if 'ranked' not in frames:
+            frames['ranked'] = rank_mac(frame('blue'), start_ts, end_ts, n=10)
+        return frames['ranked']
+
+    files = {'accel': list_data_files(upath, 'accel'),
+             'all': list_data_files(upath, nonempty=False)}
+    wav = list_audio_files(upath, mp4only=False)
+    wav = [f for f in wav if f.endswith('.wav')][:1]
+
+    return [
+        ('list_data_files', lambda: len(files['all']),
+         lambda: list_data_files(upath, 'accel'), None),
+        ('row_count', lambda: len(files['all']),
+         lambda: [row_count(f) for f in files['all']], None),
+        ('import_df', lambda: sum(row_count(f) for f in files['accel']),
+         lambda: import_df(files['accel']), None),
+        ('duplicates', lambda: len(frame('text')),
+         lambda: duplicates(frame('text')), None),
+        ('rank_mac', lambda: len(frame('blue')),
+         lambda: rank_mac(frame('blue'), start_ts, end_ts, n=10), None),
+        ('describe_user', lambda: len(list_data_files(flatpath,
+                                                      nonempty=False)),
+         lambda: describe_user(flatpath), None),
+        ('plot_accel', lambda: len(frame('accel')),
+         lambda: plot_accel(frame('accel'), start_ts, end_ts), close_figures),
+        ('plot_gps', lambda: len(frame('gps', 'time')),
+         lambda: plot_gps(frame('gps', 'time'), start_ts, end_ts),
+         close_figures),
+        ('plot_gps_density', lambda: len(frame('gps', 'time')),
+         lambda: plot_gps_density(frame('gps', 'time'), start_ts, end_ts,
+                                  headless=True), None),
+        ('plot_most_macs', lambda: len(ranked()),
+         lambda: plot_most_macs(ranked()), close_figures),
+        ('plot_n_macs', lambda: len(frame('blue')),
+         lambda: plot_n_macs(frame('blue'), start_ts, end_ts), close_figures),
+        ('plot_calls_texts', lambda: len(frame('call')) + len(frame('text')),
+         lambda: plot_calls_texts(frame('call'), frame('text'), start_ts,
+                                  end_ts), close_figures),
+        ('plot_wav', lambda: len(wav),
+         lambda: plot_wav(wav[0]), close_figures),
+    ]
+
+
+def run(sizes, days=2, repeat=3, only=None, seed=1):
+    results = []
+    for size in sizes:
+        tmp = tempfile.mkdtemp(prefix='beiwedata_bench_')
+        try:
+            upath = tmp + '/user'
+            flatpath = tmp + '/flat'
+            make_user(upath, days=days, scale=size, seed=seed)
+            make_user(flatpath, days=days, scale=size, seed=seed,
+                      layout='flat')
+            for name, setup, func, teardown in benchmarks(upath, flatpath,
+                                                          days):
+                if only and name not in only:
+                    continue
+                result = {'name': name, 'size': size, 'days': days,
+                          'seconds': None, 'rows': None, 'error': None}
+                try:
+                    result['rows'] = setup()
+                    result['seconds'] = common.measure(func, repeat, teardown)
+                except Exception as e:
+                    result['error'] = '%s: %s' % (type(e).__name__, e)
+                    close_figures()
+                    if only:
+                        traceback.print_exc()
+                if result['error']:
+                    print('%-20s size=%-6s FAILED %s' % (name, size,
+                                                         result['error']))
+                else:
+                    print('%-20s size=%-6s rows=%-9s %.4fs' % (
+                        name, size, result['rows'], result['seconds']))
+                results.append(result)
+        finally:
+            shutil.rmtree(tmp)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=float, nargs='+', default=[.1, 1.])
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', default=None)
+    parser.add_argument('--output', default=common.DEFAULT_RESULTS)
+    parser.add_argument('--threshold', type=float, default=1.2)
+    parser.add_argument('--no-record', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.days, args.repeat, args.only)
+    print('')
+    regressions = common.compare(results, args.output, args.threshold)
+    if not args.no_record:
+        common.record(results, args.output)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
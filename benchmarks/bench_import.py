@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+    Import-time benchmark for `beiwedata`.
+
+    Times `import beiwedata` in fresh interpreters and fails (exit code 1) if
+    the median is over budget or if any of the heavy plotting/audio
+    dependencies got imported along the way.
+
+    Usage
+    -----
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --budget 0.3 --repeat 20
+
+    Notes
+    -----
+    The directory *containing* the `beiwedata` checkout is put on the
+    PYTHONPATH, so the checkout must be called `beiwedata` (as cloned).
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+## Seconds. numpy is still imported eagerly; everything else should be lazy.
+DEFAULT_BUDGET = .25
+
+## Should never be imported by a bare `import beiwedata`
+HEAVY_MODULES = ['matplotlib', 'mpl_toolkits.basemap', 'scipy', 'pandas']
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+SNIPPET = """
+import json, sys, time
+t = time.time()
+import beiwedata
+elapsed = time.time() - t
+heavy = [m for m in %r if m in sys.modules]
+sys.stdout.write(json.dumps({'seconds': elapsed, 'heavy': heavy}))
+""" % (HEAVY_MODULES, )
+
+
+def time_import(python=sys.executable):
+    """Imports beiwedata in a fresh interpreter, returns (seconds, heavy)"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [PACKAGE_PARENT] + [p for p in [env.get('PYTHONPATH')] if p])
+    out = subprocess.check_output([python, '-c', SNIPPET], env=env)
+    result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    return result['seconds'], result['heavy']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                        help='maximum median import time in seconds')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--python', default=sys.executable)
+    args = parser.parse_args(argv)
+
+    times = []
+    heavy = set()
+    for _ in range(args.repeat):
+        seconds, loaded = time_import(args.python)
+        times.append(seconds)
+        heavy.update(loaded)
+    times.sort()
+    median = times[len(times) // 2]
+
+    print("import beiwedata: median %.3fs, min %.3fs, max %.3fs (budget %.3fs)"
+          % (median, times[0], times[-1], args.budget))
+    ok = True
+    if heavy:
+        print("FAIL: imported eagerly: " + ', '.join(sorted(heavy)))
+        ok = False
+    if median > args.budget:
+        print("FAIL: over budget")
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
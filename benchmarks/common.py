@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    Shared helpers for the `beiwedata` benchmarks: timing, recording results
+    and comparing them against earlier versions.
+"""
+
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+## Make `import beiwedata` work when running from a checkout
+if os.path.dirname(PACKAGE_DIR) not in sys.path:
+    sys.path.insert(0, os.path.dirname(PACKAGE_DIR))
+
+DEFAULT_RESULTS = os.path.join(PACKAGE_DIR, 'benchmarks', 'results.jsonl')
+
+
+def measure(func, repeat=3, teardown=None):
+    """Returns the best wall time (seconds) of `repeat` calls to func()
+
+    Parameters
+    ----------
+    func : callable with no arguments
+    repeat : number of calls -- the minimum is the least noisy estimate
+    teardown : optional callable run after every call (not timed), e.g.
+        closing figures
+
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if teardown is not None:
+            teardown()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def version():
+    """Git revision of the checkout (or 'unknown')"""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            out = subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'],
+                cwd=PACKAGE_DIR, stderr=devnull)
+        return out.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def environment():
+    """Version and machine information stored with every result"""
+    env = {'version': version(),
+           'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(),
+           'machine': platform.node()}
+    for name in ['numpy', 'pandas', 'matplotlib']:
+        module = sys.modules.get(name)
+        env[name] = getattr(module, '__version__', None)
+    return env
+
+
+def record(results, path=DEFAULT_RESULTS):
+    """Appends results (list of dicts) to a JSON lines file"""
+    env = environment()
+    with open(path, 'a') as f:
+        for result in results:
+            row = dict(env)
+            row.update(result)
+            f.write(json.dumps(row, sort_keys=True) + '\n')
+
+
+def load(path=DEFAULT_RESULTS):
+    """Reads every result recorded so far"""
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(results, path=DEFAULT_RESULTS, threshold=1.2):
+    """Compares results against the latest run of any *other* version
+
+    Notes
+    -----
+    Results are matched on (name, size). Prints one line per benchmark and
+    returns the list of (name, size, ratio) that got slower than `threshold`
+    times the previous time.
+
+    """
+    current = version()
+    previous = {}
+    for row in load(path):
+        if row.get('version') == current or row.get('seconds') is None:
+            continue
+        previous[(row['name'], row.get('size'))] = row
+
+    regressions = []
+    for result in results:
+        old = previous.get((result['name'], result.get('size')))
+        if old is None or result.get('seconds') is None:
+            continue
+        ratio = result['seconds'] / max(old['seconds'], 1e-9)
+        flag = ''
+        if ratio > threshold:
+            flag = '  <-- REGRESSION'
+            regressions.append((result['name'], result.get('size'), ratio))
+        print('%-24s size=%-6s %8.4fs vs %8.4fs (%s)  x%.2f%s' % (
+            result['name'], result.get('size'), result['seconds'],
+            old['seconds'], old['version'], ratio, flag))
+    return regressions
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    In-memory cache of loaded stream data.
+
+    Notebooks and dashboards ask for the same user, stream and window over
+    and over (trying plot_accel() or rank_mac() windows, redrawing a page).
+    load_stream() is list_data_files() + import_df() with an LRU cache in
+    front: frames are kept per (user, stream, timestamp column, columns,
+    window) up to FRAME_CACHE_BYTES, a request for a window (or columns)
+    inside a cached one is sliced from it without reading anything, and
+    the least recently used frames are dropped first.
+
+    Every call lists the stream's files and compares their names, sizes and
+    modification times (see data_stat()) with those seen when the frames
+    were loaded, so a download or archive that changes the files of a user
+    and stream drops that user and stream's frames.
+
+    Usage
+    -----
+    ```
+    df = load_stream(upath, 'accel', make_timestamp(2015, 5, 5),
+                     make_timestamp(2015, 5, 12))
+    day = load_stream(upath, 'accel', make_timestamp(2015, 5, 6),
+                      make_timestamp(2015, 5, 7), columns=['x'])  # sliced
+    frame_cache_info()
+    ```
+"""
+
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from beiwedata._lazy import lazy_import
+from beiwedata.archive import data_stat
+from beiwedata.basic import list_data_files, import_df, TIMESTAMP_COLUMNS
+
+__all__ = ['FRAME_CACHE_BYTES', 'load_stream', 'clear_frame_cache',
+           'frame_cache_info']
+
+pd = lazy_import('pandas')
+
+## Most memory (bytes, as counted by DataFrame.memory_usage()) of the frames
+## kept by load_stream(). Least recently used frames are dropped first.
+FRAME_CACHE_BYTES = 1 << 30
+
+## (upath, stream, tstamp, columns, start_ts, end_ts) -> (frame, bytes)
+_frames = OrderedDict()
+## (upath, stream) -> files and data_stat() when its frames were loaded
+_catalogs = {}
+_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+_lock = threading.Lock()
+
+
+def _covers(key, columns, start_ts, end_ts):
+    """Whether a cached frame holds the requested columns and window"""
+    cached, lo, hi = key[3], key[4], key[5]
+    if cached is not None and (columns is None or
+                               not set(columns) <= set(cached)):
+        return False
+    if lo is not None and (start_ts is None or start_ts < lo):
+        return False
+    if hi is not None and (end_ts is None or end_ts > hi):
+        return False
+    return True
+
+
+def _drop(key):
+    frame, size = _frames.pop(key)
+    _stats['bytes'] -= size
+
+
+def _forget(upath, stream):
+    for key in [k for k in _frames if k[:2] == (upath, stream)]:
+        _drop(key)
+    _catalogs.pop((upath, stream), None)
+
+
+def load_stream(upath, stream, start_ts=None, end_ts=None, columns=None,
+                tstamp=None, setindex=True):
+    """import_df() of a user's stream, through an in-memory LRU cache
+
+    Parameters
+    ----------
+    upath : directory of user_id
+    stream : data stream, as in list_data_files() ('accel', 'gps', ...)
+    start_ts : only keep rows at or after this Java time (see
+        make_timestamp())
+    end_ts : only keep rows at or before this Java time
+    columns : list of columns to read (default is all)
+    tstamp : timestamp column (default is the stream's, see
+        TIMESTAMP_COLUMNS)
+    setindex : sets 'dt' as the index, as import_df() does
+
+    Notes
+    -----
+    Returns the same frame as import_df(list_data_files(upath, stream),
+    tstamp, setindex, columns, start_ts, end_ts). Frames cached for a wider
+    window, or for more columns, are sliced instead of reading the files
+    again. Frames larger than FRAME_CACHE_BYTES aren't kept.
+
+    The result may share memory with the cached frame: add columns freely,
+    but don't change values in place.
+
+    """
+    upath = os.path.abspath(upath)
+    if tstamp is None:
+        tstamp = TIMESTAMP_COLUMNS.get(stream) or 'timestamp'
+    if columns is not None:
+        columns = tuple(sorted(set(columns) - set([tstamp])))
+    flist = list_data_files(upath, stream)
+    catalog = sorted((f, data_stat(f)) for f in flist)
+
+    found = None
+    with _lock:
+        if _catalogs.get((upath, stream)) != catalog:
+            _forget(upath, stream)
+            _catalogs[(upath, stream)] = catalog
+        for key in reversed(_frames):
+            if key[:3] == (upath, stream, tstamp) and \
+                    _covers(key, columns, start_ts, end_ts):
+                found = key
+                break
+        if found is not None:
+            _frames[found] = _frames.pop(found)
+            frame = _frames[found][0]
+            _stats['hits'] += 1
+        else:
+            _stats['misses'] += 1
+
+    if found is None:
+        frame = import_df(flist, tstamp, False, columns and list(columns),
+                          start_ts, end_ts)
+        size = int(frame.memory_usage(index=True, deep=True).sum())
+        key = (upath, stream, tstamp, columns, start_ts, end_ts)
+        with _lock:
+            if size <= FRAME_CACHE_BYTES and \
+                    _catalogs.get((upath, stream)) == catalog:
+                if key in _frames:
+                    _drop(key)
+                _frames[key] = (frame, size)
+                _stats['bytes'] += size
+                while _stats['bytes'] > FRAME_CACHE_BYTES:
+                    _drop(next(iter(_frames)))
+    else:
+        ## Slice the cached superset: rows, then columns
+        if (start_ts, end_ts) != found[4:]:
+            ts = frame[tstamp].values
+            keep = np.ones(len(frame), dtype=bool)
+            if start_ts is not None:
+                keep &= ts >= start_ts
+            if end_ts is not None:
+                keep &= ts <= end_ts
+            frame = frame[keep]
+        if columns != found[3]:
+            wanted = set(columns) | set([tstamp, 'dt'])
+            frame = frame[[c for c in frame.columns if c in wanted]]
+
+    if setindex is True:
+        return frame.set_index('dt')
+    return frame.copy(deep=False)
+
+
+def clear_frame_cache(upath=None, stream=None):
+    """Drops the frames of load_stream() (all, or of a user and/or stream)"""
+    with _lock:
+        for key in list(_frames):
+            if (upath is None or key[0] == os.path.abspath(upath)) and \
+                    (stream is None or key[1] == stream):
+                _drop(key)
+        for pair in list(_catalogs):
+            if (upath is None or pair[0] == os.path.abspath(upath)) and \
+                    (stream is None or pair[1] == stream):
+                del _catalogs[pair]
+        if upath is None and stream is None:
+            _stats['hits'] = _stats['misses'] = 0
+
+
+def frame_cache_info():
+    """Hits, misses, frames and bytes held by load_stream()'s cache"""
+    with _lock:
+        return {'hits': _stats['hits'], 'misses': _stats['misses'],
+                'frames': len(_frames), 'bytes': _stats['bytes'],
+                'max_bytes': FRAME_CACHE_BYTES}
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+    The `beiwedata` command line.
+
+    One entry point for the jobs that otherwise need a script each:
+    downloading (sync), building indexes and archives (cache), summaries
+    (describe, coverage), audio conversion (audio) and daily features
+    (features). Every command works user by user, on a process pool where
+    that's safe, and reports progress as it goes -- as JSON lines
+    (`--progress json`) for schedulers. Each job's event carries its run
+    time and the peak memory so far of the process that ran it (see
+    process_peak_rss_mb()), so jobs can be sized from earlier runs. `batch`
+    runs several commands in one process, so the Python stack is only
+    loaded once.
+
+    Usage
+    -----
+    ```
+    python -m beiwedata sync --study 56cf... --folder ./study
+    python -m beiwedata --workers 8 --progress json cache ./study \\
+        --archive-before 2015-05-10
+    python -m beiwedata --memory-limit 4G features ./study -o features.csv
+    python -m beiwedata batch nightly.txt   # one command per line
+    ```
+
+    Credentials for sync come from --access-key / --secret-key or the
+    BEIWE_ACCESS_KEY / BEIWE_SECRET_KEY environment variables.
+"""
+
+from __future__ import print_function
+
+import argparse
+import calendar
+import json
+import multiprocessing
+import os
+import shlex
+import sys
+import time
+from datetime import datetime
+from beiwedata._lazy import lazy_import
+from beiwedata import profiling
+from beiwedata.archive import archive_user
+from beiwedata.audio import convert_mp4
+from beiwedata.basic import describe_user, list_audio_files
+from beiwedata.cohort import list_users, map_users
+from beiwedata.coverage import build_coverage, cohort_coverage
+from beiwedata.download import make_request, get_users_request
+from beiwedata.pipeline import run_pipeline
+from beiwedata.profiling import process_peak_rss_mb
+from beiwedata.store import dedupe_tree
+
+pd = lazy_import('pandas')
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def _memory_bytes(text):
+    """'512M', '4G', '1.5G' or a number of bytes, to bytes"""
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in _UNITS:
+        return int(float(text[:-1]) * _UNITS[text[-1]])
+    return int(text)
+
+
+def _timestamp(text):
+    """YYYY-MM-DD, YYYY-MM-DDThh:mm:ss (UTC) or Java time, to Java time"""
+    if text is None:
+        return None
+    if text.isdigit():
+        return int(text)
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            dt = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(dt.timetuple()) * 1000
+    raise argparse.ArgumentTypeError("Not a date or Java time: %s" % text)
+
+
+def _api_time(ts):
+    """Java time to the API's YYYY-MM-DDThh:mm:ss"""
+    if ts is None:
+        return None
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ts // 1000))
+
+
+def _emit(args, event, **fields):
+    """Reports progress on stderr (JSON lines with --progress json)"""
+    if args.progress == 'none':
+        return
+    fields['event'] = event
+    fields['command'] = args.command
+    if args.progress == 'json':
+        sys.stderr.write(json.dumps(fields, sort_keys=True) + '\n')
+    elif event == 'job':
+        sys.stderr.write('%s %s: %s (%.1fs)\n' % (
+            args.command, fields.get('user'), fields.get('status'),
+            fields.get('seconds', 0.)))
+    elif event == 'done':
+        sys.stderr.write('%s: %d jobs, %d errors, %.1fs\n' % (
+            args.command, fields['jobs'], fields['errors'],
+            fields['seconds']))
+    sys.stderr.flush()
+
+
+## Tasks: one user each, run in worker processes -------------------------
+
+def _task_sync(upath, study_id, access_key, secret_key, streams, start_ts,
+               end_ts, store, base_url):
+    folder = os.path.dirname(upath)
+    new = make_request(study_id, access_key, secret_key,
+                       user_ids=[os.path.basename(upath)],
+                       data_streams=streams, time_start=_api_time(start_ts),
+                       time_end=_api_time(end_ts), folder=folder,
+                       return_new=True, verbose=False, base_url=base_url,
+                       store=store)
+    return {'files': len(new or [])}
+
+
+def _task_cache(upath, coverage, archive_before, store):
+    out = {}
+    if store:
+        files, duplicates, saved = dedupe_tree(upath, store)
+        out.update(stored=files, duplicates=duplicates, bytes_saved=saved)
+    if archive_before is not None:
+        files, before, after = archive_user(upath, before=archive_before)
+        out.update(archived=files, bytes_before=before, bytes_after=after)
+    if coverage:
+        index = build_coverage(upath)
+        out['coverage_streams'] = len(index['streams'])
+    return out
+
+
+def _task_describe(upath):
+    frame = describe_user(upath)
+    frame.index.name = 'stream'
+    return frame.reset_index()
+
+
+def _task_coverage(upath, stream, start_ts, end_ts, freq):
+    return cohort_coverage(os.path.dirname(upath), stream, start_ts, end_ts,
+                           freq=freq, users=[upath])
+
+
+def _task_audio(upath):
+    converted = 0
+    for fname in list_audio_files(upath, mp4only=True):
+        ## convert_mp4() asks before overwriting, so skip what's done
+        if not os.path.exists(fname[:-4] + '.wav'):
+            convert_mp4(fname)
+            converted += 1
+    return {'converted': converted}
+
+
+def _task_features(upath, features, start_ts, end_ts):
+    return run_pipeline(os.path.dirname(upath), features=features,
+                        users=[upath], start_ts=start_ts, end_ts=end_ts,
+                        workers=1)
+
+
+_TASKS = {'sync': _task_sync, 'cache': _task_cache,
+          'describe': _task_describe, 'coverage': _task_coverage,
+          'audio': _task_audio, 'features': _task_features}
+
+
+def _run_job(job):
+    """Runs one task, catching errors. Runs in a worker process."""
+    command, upath, kwargs, profile = job
+    started = time.time()
+    if profile:
+        profiling.enable_profiling()
+    out = {'user': os.path.basename(os.path.normpath(upath)), 'result': None,
+           'error': None, 'stats': None}
+    try:
+        out['result'] = _TASKS[command](upath, **kwargs)
+    except Exception as e:
+        out['error'] = '%s: %s' % (type(e).__name__, e)
+    if profile:
+        out['stats'] = profiling.profile_stats().assign(user=out['user'])
+        profiling.disable_profiling()
+    out['seconds'] = time.time() - started
+    out['process_peak_rss_mb'] = process_peak_rss_mb()
+    return out
+
+
+def _run(args, upaths, kwargs, parallel=True):
+    """Runs a command for every user, reporting progress. Returns results."""
+    jobs = [(args.command, upath, kwargs, args.profile is not None)
+            for upath in upaths]
+    workers = args.workers or multiprocessing.cpu_count()
+    if not parallel or len(jobs) <= 1:
+        workers = 1
+    _emit(args, 'start', jobs=len(jobs), workers=min(workers, len(jobs)))
+    started = time.time()
+
+    done = []
+    for out in map_users(_run_job, jobs, workers):
+        done.append(out)
+        fields = dict((k, v) for k, v in out['result'].items()) \
+            if isinstance(out['result'], dict) else {}
+        fields.update(user=out['user'], done=len(done), total=len(jobs),
+                      seconds=round(out['seconds'], 3),
+                      process_peak_rss_mb=out['process_peak_rss_mb'],
+                      status='error: ' + out['error'] if out['error']
+                      else 'ok')
+        _emit(args, 'job', **fields)
+
+    errors = sum(1 for out in done if out['error'])
+    _emit(args, 'done', jobs=len(jobs), errors=errors,
+          seconds=round(time.time() - started, 3),
+          process_peak_rss_mb=max(
+              [out['process_peak_rss_mb'] or 0 for out in done] +
+              [process_peak_rss_mb() or 0]))
+    if args.profile is not None:
+        stats = [out['stats'] for out in done if out['stats'] is not None]
+        if stats:
+            _write(pd.concat(stats, ignore_index=True), args.profile)
+    return done
+
+
+def _write(frame, output):
+    """Writes a DataFrame as CSV to a file or stdout ('-')"""
+    if output == '-':
+        frame.to_csv(sys.stdout, index=False)
+    else:
+        frame.to_csv(output, index=False)
+
+
+def _frames(done):
+    frames = [out['result'] for out in done
+              if isinstance(out['result'], pd.DataFrame)]
+    return pd.concat(frames) if frames else pd.DataFrame()
+
+
+def _users(root, users):
+    """User directories of a study (all, or the ones named)"""
+    if not users:
+        return list_users(root)
+    upaths = [os.path.join(root, u) for u in users]
+    missing = [u for u in upaths if not os.path.isdir(u)]
+    if missing:
+        raise SystemExit("No such user folder: %s" % ', '.join(missing))
+    return upaths
+
+
+## Commands --------------------------------------------------------------
+
+def _cmd_sync(args):
+    access_key = args.access_key or os.environ.get('BEIWE_ACCESS_KEY')
+    secret_key = args.secret_key or os.environ.get('BEIWE_SECRET_KEY')
+    if not access_key or not secret_key:
+        raise SystemExit("sync needs --access-key and --secret-key (or "
+                         "BEIWE_ACCESS_KEY / BEIWE_SECRET_KEY)")
+    users = args.users or get_users_request(args.study, access_key,
+                                            secret_key,
+                                            base_url=args.base_url)
+    folder = os.path.abspath(args.folder)
+    kwargs = {'study_id': args.study, 'access_key': access_key,
+              'secret_key': secret_key, 'streams': args.streams,
+              'start_ts': args.start, 'end_ts': args.end,
+              'store': args.store and os.path.abspath(args.store),
+              'base_url': args.base_url}
+    ## Requests into one folder share its registry, so they run one at a
+    ## time
+    return _run(args, [os.path.join(folder, u) for u in users], kwargs,
+                parallel=False)
+
+
+def _cmd_cache(args):
+    kwargs = {'coverage': not args.no_coverage,
+              'archive_before': args.archive_before,
+              'store': args.store and os.path.abspath(args.store)}
+    return _run(args, _users(args.root, args.users), kwargs)
+
+
+def _cmd_describe(args):
+    done = _run(args, _users(args.root, args.users), {})
+    frame = _frames(done)
+    if len(frame):
+        users = [out['user'] for out in done
+                 if isinstance(out['result'], pd.DataFrame)
+                 for _ in range(len(out['result']))]
+        frame.insert(0, 'user', users)
+    _write(frame, args.output)
+    return done
+
+
+def _cmd_coverage(args):
+    if args.start is None or args.end is None:
+        raise SystemExit("coverage needs --start and --end")
+    kwargs = {'stream': args.stream, 'start_ts': args.start,
+              'end_ts': args.end, 'freq': args.freq}
+    done = _run(args, _users(args.root, args.users), kwargs)
+    frame = _frames(done)
+    if len(frame):
+        frame.index.name = 'user'
+        frame.columns = [str(c) for c in frame.columns]
+        frame = frame.sort_index().reset_index()
+    _write(frame, args.output)
+    return done
+
+
+def _cmd_audio(args):
+    return _run(args, _users(args.root, args.users), {})
+
+
+def _cmd_features(args):
+    kwargs = {'features': args.features, 'start_ts': args.start,
+              'end_ts': args.end}
+    done = _run(args, _users(args.root, args.users), kwargs)
+    if args.output is not None:
+        _write(_frames(done), args.output)
+    return done
+
+
+def _cmd_batch(args):
+    """Runs every command of a file (one per line) in this process"""
+    done = []
+    with open(args.file) as f:
+        lines = [line.strip() for line in f]
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        sub = _parser().parse_args(shlex.split(line))
+        if sub.command == 'batch':
+            raise SystemExit("batch files can't run batch")
+        done.extend(_dispatch(sub))
+    return done
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='beiwedata', description='Beiwe data jobs from the shell.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes (default is one per CPU)')
+    parser.add_argument('--memory-limit', type=_memory_bytes, default=None,
+                        help='address space limit per process, e.g. 4G')
+    parser.add_argument('--profile', metavar='CSV', default=None,
+                        help='write profiling stats (see '
+                        'beiwedata.profiling) of every job to CSV')
+    parser.add_argument('--progress', choices=['text', 'json', 'none'],
+                        default='text', help='progress on stderr')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    def study(p, root=True):
+        if root:
+            p.add_argument('root', help='study folder')
+        p.add_argument('--users', nargs='+', default=None,
+                       help='user IDs (default is every user)')
+        p.add_argument('--start', type=_timestamp, default=None,
+                       help='YYYY-MM-DD[Thh:mm:ss] (UTC) or Java time')
+        p.add_argument('--end', type=_timestamp, default=None)
+
+    p = commands.add_parser('sync', help='download new data')
+    p.add_argument('--study', required=True, help='study ID')
+    p.add_argument('--folder', default='.', help='study folder')
+    p.add_argument('--access-key', default=None)
+    p.add_argument('--secret-key', default=None)
+    p.add_argument('--streams', nargs='+', default=None,
+                   help='data streams (default is all)')
+    p.add_argument('--store', default=None,
+                   help='content-addressed store (see beiwedata.store)')
+    p.add_argument('--base-url', default=None)
+    study(p, root=False)
+
+    p = commands.add_parser('cache', help='build coverage indexes, '
+                            'archives and the store')
+    study(p)
+    p.add_argument('--no-coverage', action='store_true')
+    p.add_argument('--archive-before', type=_timestamp, default=None,
+                   help='archive days before this date (see '
+                   'beiwedata.archive)')
+    p.add_argument('--store', default=None,
+                   help='move files into this store (see dedupe_tree())')
+
+    p = commands.add_parser('describe', help='describe_user() of every user '
+                            '(flat downloads)')
+    study(p)
+    p.add_argument('-o', '--output', default='-', help='CSV (default stdout)')
+
+    p = commands.add_parser('coverage', help='coverage per user and period')
+    study(p)
+    p.add_argument('--stream', required=True)
+    p.add_argument('--freq', default='D')
+    p.add_argument('-o', '--output', default='-')
+
+    p = commands.add_parser('audio', help='convert voice recordings to wav')
+    study(p)
+
+    p = commands.add_parser('features', help='run the feature pipeline')
+    study(p)
+    p.add_argument('--features', nargs='+', default=None,
+                   help='features to run (default is all registered)')
+    p.add_argument('-o', '--output', default=None,
+                   help='CSV of the run log ("-" for stdout; default is '
+                   'none)')
+
+    p = commands.add_parser('batch', help='run the commands of a file')
+    p.add_argument('file', help='one command per line (# comments)')
+    return parser
+
+
+def _dispatch(args):
+    return globals()['_cmd_' + args.command](args)
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    if args.memory_limit is not None:
+        if resource is None:
+            raise SystemExit("--memory-limit isn't supported here")
+        ## Worker processes inherit the limit
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        if hard != resource.RLIM_INFINITY:
+            args.memory_limit = min(args.memory_limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (args.memory_limit, hard))
+    done = _dispatch(args)
+    return 1 if any(out['error'] for out in done) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+    Cohort-level (whole study) aggregation.
+
+    Everything else in `beiwedata` works on one user and one in-memory
+    DataFrame at a time. cohort_aggregate() runs one aggregation over every
+    user in a study folder instead: users are processed in parallel (one
+    process per user at a time), each user's files are streamed through in
+    bounded chunks, and the partial aggregates are combined into one frame.
+"""
+
+import multiprocessing
+import os
+from beiwedata._lazy import lazy_import
+from beiwedata.archive import read_data_csv
+from beiwedata.basic import (list_data_files, file_timestamp, files_in_window,
+                             TIMESTAMP_COLUMNS)
+from beiwedata.power import freq_ms
+
+__all__ = ['TIME_KEYS', 'AGGREGATIONS', 'list_users', 'map_users',
+           'aggregation_specs', 'read_columns', 'cohort_aggregate']
+
+pd = lazy_import('pandas')
+
+## Time keys allowed in `by` and their pandas frequency
+TIME_KEYS = {'day': 'D', 'hour': 'h', 'minute': 'min'}
+
+AGGREGATIONS = ['sum', 'count', 'mean', 'min', 'max', 'nunique', 'size']
+
+## How each partial column is combined
+_COMBINE = {'sum': 'sum', 'count': 'sum', 'size': 'sum', 'min': 'min',
+            'max': 'max'}
+
+
+def list_users(root):
+    """Returns the (sorted) user directories of a study folder"""
+    return sorted(os.path.join(root, d) for d in os.listdir(root)
+                  if os.path.isdir(os.path.join(root, d)) and
+                  not d.startswith('.'))
+
+
+def map_users(func, jobs, workers=None, verbose=False):
+    """Yields func(job) for every job, on a process pool
+
+    Parameters
+    ----------
+    func : top-level function of one job (it's pickled to the workers)
+    jobs : list of arguments, usually one per user
+    workers : number of processes (default is one per CPU; 1 runs in this
+        process)
+    verbose : if True, prints progress
+
+    Notes
+    -----
+    Results come in the order jobs finish. If a job raises, or the loop
+    over the results stops early (an error, Ctrl-C), the pool is terminated
+    right away instead of waiting for the jobs still running.
+
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers == 1 or len(jobs) <= 1:
+        for i, job in enumerate(jobs):
+            yield func(job)
+            if verbose:
+                print("%d / %d users done" % (i + 1, len(jobs)))
+        return
+
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        for i, result in enumerate(pool.imap_unordered(func, jobs)):
+            yield result
+            if verbose:
+                print("%d / %d users done" % (i + 1, len(jobs)))
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def aggregation_specs(aggs, allowed=AGGREGATIONS):
+    """(column, aggregation) pairs of an aggregation dict
+
+    Parameters
+    ----------
+    aggs : {column: aggregation or list of aggregations}, e.g.
+        {'x': 'mean', 'MAC': ['nunique', 'count']}
+    allowed : aggregations accepted (default is AGGREGATIONS)
+
+    Notes
+    -----
+    Returns [('MAC', 'nunique'), ('MAC', 'count'), ('x', 'mean')], sorted by
+    column. Raises ValueError for an aggregation that isn't allowed.
+
+    """
+    specs = []
+    for col in sorted(aggs):
+        funcs = aggs[col]
+        if not isinstance(funcs, (list, tuple)):
+            funcs = [funcs]
+        for func in funcs:
+            if func not in allowed:
+                raise ValueError("Unknown aggregation '%s'. Use one of: %s"
+                                 % (func, ', '.join(allowed)))
+            specs.append((col, func))
+    return specs
+
+
+def read_columns(fname, tstamp, columns):
+    """Reads the needed columns of one data file, with the time in '_ts'
+
+    Parameters
+    ----------
+    fname : a data file, plain or archived (see read_data_csv())
+    tstamp : timestamp column. If None (or missing from the file), '_ts'
+        is the file creation time (see file_timestamp()).
+    columns : list of columns to keep (may be empty)
+
+    Notes
+    -----
+    Only the timestamp and `columns` are parsed. Header names are stripped
+    of whitespace. Returns a DataFrame of '_ts' and `columns`.
+
+    """
+    wanted = set(columns) | set([tstamp])
+    ## Only parse the columns we need ('size' alone needs any column)
+    usecols = (lambda c: c.strip() in wanted) if columns else None
+    frame = read_data_csv(fname, usecols=usecols)
+    frame.columns = [c.strip() for c in frame.columns]
+    if tstamp is None or tstamp not in frame.columns:
+        frame['_ts'] = file_timestamp(fname)
+    else:
+        frame['_ts'] = frame[tstamp]
+    return frame[['_ts'] + [c for c in columns if c != '_ts']]
+
+
+def _partial(frame, user, by, specs):
+    """Partial aggregates of one chunk: (numbers, {column: unique pairs})"""
+    keys = []
+    for key in by:
+        if key == 'user':
+            frame['user'] = user
+        else:
+            width = freq_ms(TIME_KEYS[key])
+            frame[key] = (frame['_ts'].values // width) * width
+        keys.append(key)
+    if not keys:
+        frame['_all'] = 0
+        keys = ['_all']
+
+    grouped = frame.groupby(keys, sort=False)
+    numbers = {}
+    uniques = {}
+    for col, func in specs:
+        if func in ('sum', 'mean'):
+            numbers[col + '|sum'] = grouped[col].sum()
+        if func in ('count', 'mean'):
+            numbers[col + '|count'] = grouped[col].count()
+        if func in ('min', 'max'):
+            numbers[col + '|' + func] = getattr(grouped[col], func)()
+        if func == 'size':
+            numbers['|size'] = grouped.size()
+        if func == 'nunique':
+            uniques[col] = frame[keys + [col]].dropna().drop_duplicates()
+    return pd.DataFrame(numbers), uniques
+
+
+def _combine(parts):
+    """Combines a list of partial aggregates into one"""
+    parts = [p for p in parts if p is not None]
+    if not parts:
+        return None
+    frames = [p[0] for p in parts if len(p[0].columns)]
+    numbers = pd.DataFrame()
+    if frames:
+        numbers = pd.concat(frames, sort=False)
+        rules = dict((c, _COMBINE[c.split('|')[1]]) for c in numbers.columns)
+        numbers = numbers.groupby(level=list(range(numbers.index.nlevels))
+                                  ).agg(rules)
+    uniques = {}
+    for col in set(c for p in parts for c in p[1]):
+        uniques[col] = pd.concat([p[1][col] for p in parts if col in p[1]],
+                                 ignore_index=True).drop_duplicates()
+    return numbers, uniques
+
+
+def _user_job(args):
+    """Aggregates one user. Runs in a worker process."""
+    upath, stream, tstamp, by, specs, chunksize, start_ts, end_ts = args
+    user = os.path.basename(os.path.normpath(upath))
+    columns = sorted(set(col for col, func in specs if func != 'size'))
+
+    flist = files_in_window(list_data_files(upath, stream), start_ts, end_ts)
+    flist = sorted(flist, key=file_timestamp)
+
+    partial = None
+    buffered = []
+    nrows = 0
+    for i, fname in enumerate(flist):
+        frame = read_columns(fname, tstamp, columns)
+        if start_ts is not None:
+            frame = frame[frame['_ts'] >= start_ts]
+        if end_ts is not None:
+            frame = frame[frame['_ts'] <= end_ts]
+        buffered.append(frame)
+        nrows += len(frame)
+        ## Aggregate (and forget the rows) every `chunksize` rows
+        if nrows >= chunksize or i == len(flist) - 1:
+            chunk = pd.concat(buffered, ignore_index=True)
+            buffered = []
+            nrows = 0
+            if len(chunk):
+                partial = _combine([partial, _partial(chunk, user, by,
+                                                      specs)])
+    return partial
+
+
+def _finalize(partial, by, specs):
+    """Turns combined partial aggregates into the result frame"""
+    keys = list(by) if by else ['_all']
+    numbers, uniques = partial
+    names = []
+    columns = {}
+    for col, func in specs:
+        name = 'size' if func == 'size' else col + '_' + func
+        names.append(name)
+        if func == 'mean':
+            columns[name] = numbers[col + '|sum'] / numbers[col + '|count']
+        elif func == 'nunique':
+            columns[name] = uniques[col].groupby(keys).size()
+        elif func == 'size':
+            columns[name] = numbers['|size']
+        else:
+            columns[name] = numbers[col + '|' + func]
+
+    ## Groups with only missing values have no (group, value) pairs
+    out = pd.DataFrame(columns, columns=names)
+    for col, func in specs:
+        if func == 'nunique':
+            out[col + '_nunique'] = out[col + '_nunique'].fillna(0).astype(int)
+    out.index.names = keys
+    out = out.reset_index()
+    for key in keys:
+        if key in TIME_KEYS:
+            out[key] = pd.to_datetime(out[key], unit='ms')
+    if by:
+        out = out.set_index(keys).sort_index()
+    else:
+        out = out.drop('_all', axis=1)
+    return out
+
+
+def cohort_aggregate(root, stream, aggs, by=('user', 'day'), tstamp=None,
+                     users=None, start_ts=None, end_ts=None, workers=None,
+                     chunksize=500000, verbose=False):
+    """Aggregates one data stream over every user of a study
+
+    Parameters
+    ----------
+    root : study folder (one directory per user, as downloaded)
+    stream : the data stream (see list_data_files()), e.g. 'accel', 'gps'
+    aggs : dictionary of column : aggregation (or list of aggregations).
+        Aggregations are 'sum', 'count', 'mean', 'min', 'max', 'nunique' and
+        'size' (number of rows -- the column is ignored).
+    by : group by any of 'user', 'day', 'hour' or 'minute' (UTC). An empty
+        tuple aggregates everything into a single row.
+    tstamp : name of the timestamp column (default is TIMESTAMP_COLUMNS)
+    users : list of user directories (default is every folder in root)
+    start_ts : only use data at or after this timestamp (see make_timestamp())
+    end_ts : only use data at or before this timestamp
+    workers : number of processes (default is one per CPU; 1 runs in this
+        process, which is easier to debug)
+    chunksize : roughly how many rows of a user are held in memory at once
+    verbose : if True, prints progress
+
+    Usage
+    -----
+    ## Hourly accelerometer counts and mean magnitude-ish for everybody
+    hourly = cohort_aggregate('./study', 'accel',
+                              {'x': ['count', 'mean'], 'z': 'mean'},
+                              by=('user', 'hour'))
+
+    ## Number of distinct Bluetooth devices per day, whole cohort
+    devices = cohort_aggregate('./study', 'blue', {'MAC': 'nunique'},
+                               by=('day', ))
+
+    Notes
+    -----
+    Returns a DataFrame indexed by `by` with one column per aggregation,
+    named column_aggregation (e.g., 'x_mean') or 'size'.
+
+    Each user is one partition: a worker streams through the user's files,
+    aggregating every `chunksize` rows, so memory is bounded by the chunk
+    plus the partial aggregates, never by the size of the study. 'mean' is
+    carried as a sum and a count and 'nunique' as the distinct (group, value)
+    pairs, so partials combine exactly across chunks and users.
+
+    """
+    specs = aggregation_specs(aggs)
+    for key in by:
+        if key != 'user' and key not in TIME_KEYS:
+            raise ValueError("Can only group by 'user', " +
+                             ", ".join("'%s'" % k for k in sorted(TIME_KEYS)))
+    if tstamp is None:
+        tstamp = TIMESTAMP_COLUMNS.get(stream)
+    if users is None:
+        users = list_users(root)
+    jobs = [(upath, stream, tstamp, tuple(by), specs, chunksize, start_ts,
+             end_ts) for upath in users]
+
+    partial = None
+    for result in map_users(_user_job, jobs, workers, verbose):
+        partial = _combine([partial, result])
+
+    if partial is None:
+        raise ValueError("No '%s' data found under %s" % (stream, root))
+    return _finalize(partial, by, specs)
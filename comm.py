@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+    `beiwedata` scripts for the call and text log data streams.
+
+    Vectorized communication features (daily in/out counts, durations, missed
+    call rates, unique contacts, reciprocity, response latency) with
+    duplicate suppression built in. No row-wise apply() anywhere: categories
+    are mapped to integer codes once and everything else is numpy time
+    arithmetic on whole columns.
+"""
+
+import numpy as np
+from beiwedata._lazy import lazy_import
+from beiwedata.power import freq_ms
+
+__all__ = ['CALL_TYPES', 'TEXT_TYPES', 'CALL_KEYS', 'TEXT_KEYS',
+           'call_type_codes', 'text_type_codes', 'call_end_times',
+           'suppress_duplicates', 'call_features', 'response_latency',
+           'text_features', 'comm_features']
+
+pd = lazy_import('pandas')
+
+CALL_TYPES = ['Incoming Call', 'Outgoing Call', 'Missed Call']
+TEXT_TYPES = ['received SMS', 'sent SMS']
+
+## Columns that make two rows "the same" call or text (see duplicates())
+CALL_KEYS = ['hashed phone number', 'call type', 'duration in seconds']
+TEXT_KEYS = ['hashed phone number', 'sent vs received', 'message length']
+
+
+def _group_codes(df, cols):
+    """One integer code per unique combination of `cols` (NaNs included)"""
+    codes = np.zeros(len(df), dtype=np.int64)
+    for col in cols:
+        c, u = pd.factorize(df[col].values)
+        c = np.where(c < 0, len(u), c)
+        codes, _ = pd.factorize(codes * (len(u) + 1) + c)
+    return codes
+
+
+def call_type_codes(df, col='call type'):
+    """Codes of CALL_TYPES (0 incoming, 1 outgoing, 2 missed, -1 other)"""
+    return pd.Categorical(df[col].values, categories=CALL_TYPES).codes
+
+
+def text_type_codes(df, col='sent vs received'):
+    """Codes of TEXT_TYPES (0 received, 1 sent, -1 other)"""
+    return pd.Categorical(df[col].values, categories=TEXT_TYPES).codes
+
+
+def call_end_times(df, ts_col='timestamp', dur_col='duration in seconds'):
+    """Returns the (UTC) end time of every call as datetime64 values
+
+    Notes
+    -----
+    Like the start times made by import_df(), the start is truncated to the
+    second before the duration is added.
+
+    """
+    start = (df[ts_col].values.astype(np.int64) // 1000) * 1000
+    dur = np.nan_to_num(df[dur_col].values.astype(np.float64))
+    return (start.astype('datetime64[ms]') +
+            (dur * 1000).astype(np.int64).astype('timedelta64[ms]')
+            ).astype('datetime64[ns]')
+
+
+def suppress_duplicates(df, tbuffer=3000, cols=None, ts_col='timestamp'):
+    """Flags calls or texts that look like duplicates (vectorized)
+
+    Parameters
+    ----------
+    df : a call or text dataframe created by import_df()
+    tbuffer : amount of time (in milliseconds) to consider the next observation
+    cols : columns that must be identical (default is TEXT_KEYS for texts and
+        CALL_KEYS for calls)
+    ts_col : name of the timestamp column
+
+    Usage
+    -----
+    dupes = suppress_duplicates(df = text_data_frame)
+    text_no_duplicates = text_data_frame[~dupes]
+
+    Notes
+    -----
+    Returns a boolean numpy array in the same order as df. A row is a
+    duplicate if an identical row (same `cols`) happened less than
+    `tbuffer` ms before it, so the first of 3 or 4 copies is kept. Identical
+    rows don't have to be next to each other. Same idea as duplicates(), but
+    done with one sort instead of a Python loop.
+
+    """
+    if cols is None:
+        cols = TEXT_KEYS if TEXT_KEYS[1] in df.columns else CALL_KEYS
+    if len(df) == 0:
+        return np.zeros(0, dtype=bool)
+    codes = _group_codes(df, cols)
+    ts = df[ts_col].values.astype(np.int64)
+    order = np.lexsort((ts, codes))
+    codes, ts = codes[order], ts[order]
+
+    dupe = np.zeros(len(df), dtype=bool)
+    dupe[1:] = (codes[1:] == codes[:-1]) & (ts[1:] - ts[:-1] < tbuffer)
+    out = np.empty(len(df), dtype=bool)
+    out[order] = dupe
+    return out
+
+
+def _prepare(df, types, ts_col, width, dedupe, tbuffer):
+    """Drops duplicates and adds the bin and type code columns"""
+    if dedupe and len(df):
+        df = df[~suppress_duplicates(df, tbuffer=tbuffer, ts_col=ts_col)]
+    ts = df[ts_col].values.astype(np.int64)
+    return df, ts // width, types(df)
+
+
+def _per_bin(bins, values):
+    """Sums `values` (dict of name : array) by bin, as a DataFrame"""
+    frame = pd.DataFrame(values)
+    frame['bin'] = bins
+    return frame.groupby('bin').sum()
+
+
+def call_features(calldf, freq='D', ts_col='timestamp', dedupe=True,
+                  tbuffer=3000):
+    """Per-day (or any `freq`) call counts, minutes and missed call rates
+
+    Parameters
+    ----------
+    calldf : a call dataframe generated by import_df()
+    freq : pandas frequency string of the periods ('D', 'h', '7D', ...)
+    ts_col : name of the timestamp column
+    dedupe : if True, drops duplicates first (see suppress_duplicates())
+    tbuffer : see suppress_duplicates()
+
+    Notes
+    -----
+    Returns a DataFrame indexed by period (UTC) with calls_in, calls_out,
+    calls_missed, minutes_in, minutes_out, missed_rate (missed / (incoming +
+    missed)) and call_contacts (unique numbers). Periods without calls are
+    not included.
+
+    """
+    width = freq_ms(freq)
+    df, bins, kind = _prepare(calldf, call_type_codes, ts_col, width, dedupe,
+                              tbuffer)
+    minutes = np.nan_to_num(
+        df['duration in seconds'].values.astype(np.float64)) / 60.
+    out = _per_bin(bins, {'calls_in': kind == 0, 'calls_out': kind == 1,
+                          'calls_missed': kind == 2,
+                          'minutes_in': np.where(kind == 0, minutes, 0),
+                          'minutes_out': np.where(kind == 1, minutes, 0)})
+    for col in ['calls_in', 'calls_out', 'calls_missed']:
+        out[col] = out[col].astype(int)
+    attempts = (out['calls_in'] + out['calls_missed']).astype(float)
+    out['missed_rate'] = out['calls_missed'] / attempts.where(attempts > 0)
+    out['call_contacts'] = pd.Series(df['hashed phone number'].values).groupby(
+        bins).nunique()
+    out.index = pd.to_datetime(out.index.values * width, unit='ms')
+    out.index.name = 'period'
+    return out[['calls_in', 'calls_out', 'calls_missed', 'minutes_in',
+                'minutes_out', 'missed_rate', 'call_contacts']]
+
+
+def response_latency(textdf, ts_col='timestamp', max_latency=86400):
+    """Seconds from each received text until the next text sent to that number
+
+    Parameters
+    ----------
+    textdf : a text dataframe created by import_df() (deduplicate first)
+    ts_col : name of the timestamp column
+    max_latency : replies later than this (in seconds) don't count
+
+    Notes
+    -----
+    Returns a float numpy array in the same order as textdf: NaN for sent
+    texts and for received texts with no reply within max_latency.
+
+    Works with one sort by (number, time) and a reverse running minimum of
+    "number offset + send time", so it never loops over contacts.
+
+    """
+    n = len(textdf)
+    out = np.full(n, np.nan)
+    if n == 0:
+        return out
+    contact = _group_codes(textdf, ['hashed phone number'])
+    ts = textdf[ts_col].values.astype(np.int64)
+    sent = text_type_codes(textdf) == 1
+    order = np.lexsort((ts, contact))
+
+    ## Sorted by (contact, time), so key increases and the next sent text
+    ## at or after each row is a reverse running minimum over `key`
+    rel = ts - ts.min()
+    span = int(rel.max()) + 1
+    key = contact[order].astype(np.int64) * span + rel[order]
+    sent_key = np.where(sent[order], key, np.iinfo(np.int64).max)
+    next_sent = np.minimum.accumulate(sent_key[::-1])[::-1]
+
+    same = (next_sent != np.iinfo(np.int64).max) & \
+        (next_sent // span == contact[order])
+    latency = np.where(same, (next_sent - key) / 1000., np.nan)
+    latency[sent[order]] = np.nan
+    with np.errstate(invalid='ignore'):
+        latency[latency > max_latency] = np.nan
+    out[order] = latency
+    return out
+
+
+def text_features(textdf, freq='D', ts_col='timestamp', dedupe=True,
+                  tbuffer=3000, max_latency=86400):
+    """Per-day (or any `freq`) text counts, contacts and response latency
+
+    Parameters
+    ----------
+    textdf : a text dataframe created by import_df()
+    freq : pandas frequency string of the periods ('D', 'h', '7D', ...)
+    ts_col : name of the timestamp column
+    dedupe : if True, drops duplicates first (see suppress_duplicates())
+    tbuffer : see suppress_duplicates()
+    max_latency : see response_latency()
+
+    Notes
+    -----
+    Returns a DataFrame indexed by period (UTC) with texts_in, texts_out,
+    chars_in, chars_out, text_contacts and the median response latency (in
+    seconds) of received texts that got a reply.
+
+    """
+    width = freq_ms(freq)
+    df, bins, kind = _prepare(textdf, text_type_codes, ts_col, width, dedupe,
+                              tbuffer)
+    length = np.nan_to_num(df['message length'].values.astype(np.float64))
+    out = _per_bin(bins, {'texts_in': kind == 0, 'texts_out': kind == 1,
+                          'chars_in': np.where(kind == 0, length, 0),
+                          'chars_out': np.where(kind == 1, length, 0)})
+    for col in ['texts_in', 'texts_out']:
+        out[col] = out[col].astype(int)
+    out['text_contacts'] = pd.Series(df['hashed phone number'].values).groupby(
+        bins).nunique()
+    out['median_latency'] = pd.Series(
+        response_latency(df, ts_col, max_latency)).groupby(bins).median()
+    out.index = pd.to_datetime(out.index.values * width, unit='ms')
+    out.index.name = 'period'
+    return out[['texts_in', 'texts_out', 'chars_in', 'chars_out',
+                'text_contacts', 'median_latency']]
+
+
+def comm_features(calldf=None, textdf=None, freq='D', ts_col='timestamp',
+                  dedupe=True, tbuffer=3000, max_latency=86400):
+    """Call and text features together, plus contacts and reciprocity
+
+    Parameters
+    ----------
+    calldf : a call dataframe generated by import_df() (or None)
+    textdf : a text dataframe generated by import_df() (or None)
+    freq : pandas frequency string of the periods ('D', 'h', '7D', ...)
+    ts_col : name of the timestamp column (same for both)
+    dedupe : if True, drops duplicates first (see suppress_duplicates())
+    tbuffer : see suppress_duplicates()
+    max_latency : see response_latency()
+
+    Notes
+    -----
+    Returns the columns of call_features() and text_features() (zeros where
+    there were no calls or no texts) plus:
+        - contacts : unique numbers over calls and texts
+        - reciprocity : fraction of those contacts the user both heard from
+            (incoming/missed call, received text) and reached out to
+            (outgoing call, sent text) in the period
+
+    """
+    width = freq_ms(freq)
+    parts = []
+    inout = []
+    if calldf is not None:
+        parts.append(call_features(calldf, freq, ts_col, dedupe, tbuffer))
+        df, bins, kind = _prepare(calldf, call_type_codes, ts_col, width,
+                                  dedupe, tbuffer)
+        inout.append(pd.DataFrame({'bin': bins,
+                                   'contact': df['hashed phone number'].values,
+                                   'inc': (kind == 0) | (kind == 2),
+                                   'out': kind == 1}))
+    if textdf is not None:
+        parts.append(text_features(textdf, freq, ts_col, dedupe, tbuffer,
+                                   max_latency))
+        df, bins, kind = _prepare(textdf, text_type_codes, ts_col, width,
+                                  dedupe, tbuffer)
+        inout.append(pd.DataFrame({'bin': bins,
+                                   'contact': df['hashed phone number'].values,
+                                   'inc': kind == 0, 'out': kind == 1}))
+    if not parts:
+        raise ValueError("Need a call dataframe, a text dataframe or both.")
+
+    out = parts[0]
+    for part in parts[1:]:
+        out = out.join(part, how='outer')
+    ## Counts are zero in periods with only calls (or only texts), but rates
+    ## and latencies are missing
+    columns = out.columns
+    for col in columns:
+        if col not in ('missed_rate', 'median_latency'):
+            out[col] = out[col].fillna(0)
+            if col.startswith(('calls_', 'texts_')) or \
+                    col.endswith('_contacts'):
+                out[col] = out[col].astype(int)
+
+    both = pd.concat(inout, ignore_index=True)
+    per_contact = both.groupby(['bin', 'contact'])[['inc', 'out']].max()
+    mutual = (per_contact['inc'] & per_contact['out']).astype(float).groupby(
+        level=0)
+    stats = pd.DataFrame({'contacts': mutual.size(),
+                          'reciprocity': mutual.mean()})
+    stats.index = pd.to_datetime(stats.index.values * width, unit='ms')
+    out = out.join(stats)
+    out.index.name = 'period'
+    return out[list(columns) + ['contacts', 'reciprocity']]
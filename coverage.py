@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+    Data coverage: when was a phone actually collecting?
+
+    build_coverage() turns a user's files into one bitmap per data stream
+    (one bit per minute, or whatever resolution you pick) using only the
+    file names and the first and last timestamp in each file -- no file is
+    parsed in full. The bitmaps are saved next to the data (`.coverage.npz`)
+    with a manifest of the files they came from, so rebuilding only reads new
+    files. Queries (fraction covered, gaps) on a loaded index use prefix sums
+    and don't touch the data at all, and plot_coverage() draws a whole cohort
+    from the indexes.
+
+    Usage
+    -----
+    ```
+    index = build_coverage('./study/user1')
+    covered_fraction(index, 'gps', make_timestamp(2015, 5, 5),
+                     make_timestamp(2015, 5, 6))
+    coverage_gaps(index, 'accel', min_gap=3600)
+    fig, ax = plot_coverage('./study', 'gps', freq='h')
+    ```
+"""
+
+import io
+import json
+import os
+import numpy as np
+from beiwedata._lazy import lazy_import
+from beiwedata._plotting import new_figure
+from beiwedata.archive import open_data, data_stat, read_data_csv
+from beiwedata.basic import list_data_files, file_timestamp, TIMESTAMP_COLUMNS
+from beiwedata.cohort import list_users
+from beiwedata.power import freq_ms
+
+__all__ = ['COVERAGE_FILE', 'load_coverage', 'save_coverage', 'build_coverage',
+           'coverage_span', 'covered_fraction', 'coverage_intervals',
+           'coverage_gaps', 'cohort_coverage', 'plot_coverage']
+
+pd = lazy_import('pandas')
+
+COVERAGE_FILE = '.coverage.npz'
+
+## Bytes read from the end of a file to find its last row
+_TAIL_BYTES = 4096
+
+
+def _first_last(fname, tcol):
+    """First and last timestamp in a file, or None for a header-only file
+
+    Only reads the header, the first row and the last few KB of the file.
+    Files without a timestamp column (tcol is None, or the column is
+    missing) use the file creation time for both.
+    """
+    with open_data(fname) as f:
+        header = f.readline().decode('utf-8', 'replace')
+        first = f.readline().decode('utf-8', 'replace')
+        if not first.strip():
+            return None
+        cols = [c.strip() for c in header.split(',')]
+        if tcol is None or tcol not in cols:
+            created = file_timestamp(fname)
+            return created, created
+        i = cols.index(tcol)
+
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - _TAIL_BYTES))
+        tail = f.read().decode('utf-8', 'replace').strip().splitlines()
+    try:
+        return (int(float(first.split(',')[i])),
+                int(float(tail[-1].split(',')[i])))
+    except (ValueError, IndexError):
+        created = file_timestamp(fname)
+        return created, created
+
+
+def _all_times(fname, tcol):
+    """Every timestamp in a file (used when exact=True)"""
+    frame = read_data_csv(fname)
+    frame.columns = [c.strip() for c in frame.columns]
+    if len(frame) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if tcol is None or tcol not in frame.columns:
+        return np.array([file_timestamp(fname)], dtype=np.int64)
+    return frame[tcol].dropna().values.astype(np.int64)
+
+
+def _mark(stream_index, bins):
+    """Sets bits (absolute bin numbers), growing the bitmap as needed"""
+    if len(bins) == 0:
+        return
+    origin, bits = stream_index['origin'], stream_index['bits']
+    lo, hi = int(bins.min()), int(bins.max())
+    if origin is None:
+        origin, bits = lo, np.zeros(hi - lo + 1, dtype=bool)
+    new_origin = min(origin, lo)
+    new_len = max(origin + len(bits), hi + 1) - new_origin
+    if new_origin != origin or new_len != len(bits):
+        grown = np.zeros(new_len, dtype=bool)
+        grown[origin - new_origin:origin - new_origin + len(bits)] = bits
+        origin, bits = new_origin, grown
+    bits[bins - origin] = True
+    stream_index['origin'], stream_index['bits'] = origin, bits
+    stream_index['prefix'] = None
+
+
+def _empty_stream():
+    return {'origin': None, 'bits': np.zeros(0, dtype=bool), 'files': {},
+            'prefix': None}
+
+
+def load_coverage(upath, path=None):
+    """Loads a saved coverage index (see build_coverage()), or None
+
+    Parameters
+    ----------
+    upath : directory of user_id
+    path : where the index is saved (default is upath/.coverage.npz)
+
+    """
+    path = path or os.path.join(upath, COVERAGE_FILE)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        meta = json.loads(saved['meta'].tobytes().decode('utf-8'))
+        index = {'resolution_ms': meta['resolution_ms'],
+                 'exact': meta['exact'], 'streams': {}}
+        for stream, info in meta['streams'].items():
+            bits = np.unpackbits(saved[stream])[:info['length']].astype(bool)
+            index['streams'][stream] = {'origin': info['origin'],
+                                        'bits': bits,
+                                        'files': info['files'],
+                                        'prefix': None}
+    return index
+
+
+def save_coverage(index, upath, path=None):
+    """Saves a coverage index (bit-packed, with its file manifest)"""
+    path = path or os.path.join(upath, COVERAGE_FILE)
+    meta = {'resolution_ms': index['resolution_ms'], 'exact': index['exact'],
+            'streams': {}}
+    arrays = {}
+    for stream, s in index['streams'].items():
+        meta['streams'][stream] = {'origin': s['origin'],
+                                   'length': len(s['bits']),
+                                   'files': s['files']}
+        arrays[stream] = np.packbits(s['bits'])
+    arrays['meta'] = np.frombuffer(json.dumps(meta).encode('utf-8'),
+                                   dtype=np.uint8)
+    ## Write then rename, so a crash never leaves half an index behind
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **arrays)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(buf.getvalue())
+    os.rename(tmp, path)
+
+
+def build_coverage(upath, streams='all', resolution='1Min', exact=False,
+                   path=None, save=True, rebuild=False):
+    """Builds (or updates) a user's coverage index
+
+    Parameters
+    ----------
+    upath : directory of user_id
+    streams : 'all' or a list of streams (see list_data_files())
+    resolution : size of one bit as a pandas frequency ('1Min', '5Min', 'h')
+    exact : if False, everything between the first and last timestamp of a
+        file counts as covered. If True, every file is read and only bins
+        with at least one row are covered (slower, but sees gaps inside
+        files, e.g. GPS duty cycling).
+    path : where the index is saved (default is upath/.coverage.npz)
+    save : if True, saves the index
+    rebuild : if True, ignores any saved index
+
+    Notes
+    -----
+    Returns the index (a dict, see load_coverage()). Files already in the
+    saved index are skipped. If a file was changed or removed, that stream is
+    rebuilt from scratch; changing `resolution` or `exact` rebuilds
+    everything. Header-only files add nothing, and streams without a
+    timestamp column (see TIMESTAMP_COLUMNS) cover the bin of their file
+    creation time.
+
+    """
+    if streams == 'all':
+        streams = sorted(TIMESTAMP_COLUMNS)
+    width = freq_ms(resolution)
+    index = None if rebuild else load_coverage(upath, path)
+    if (index is None or index['resolution_ms'] != width or
+            index['exact'] != exact):
+        index = {'resolution_ms': width, 'exact': exact, 'streams': {}}
+
+    changed = False
+    for stream in streams:
+        tcol = TIMESTAMP_COLUMNS[stream]
+        current = {}
+        for fname in list_data_files(upath, stream, nonempty=False):
+            current[os.path.relpath(fname, upath)] = list(data_stat(fname))
+        s = index['streams'].get(stream, _empty_stream())
+        if any(current.get(f) != v for f, v in s['files'].items()):
+            s = _empty_stream()
+        new = sorted(f for f in current if f not in s['files'])
+        ## Nothing new and nothing removed (a reset with no files left
+        ## still has to be saved)
+        if not new and s is index['streams'].get(stream):
+            continue
+
+        for rel in new:
+            fname = os.path.join(upath, rel)
+            if exact:
+                times = _all_times(fname, tcol)
+                _mark(s, np.unique(times // width))
+            else:
+                span = _first_last(fname, tcol)
+                if span is not None:
+                    lo, hi = sorted(span)
+                    _mark(s, np.arange(lo // width, hi // width + 1))
+            s['files'][rel] = current[rel]
+        index['streams'][stream] = s
+        changed = True
+
+    if save and changed:
+        save_coverage(index, upath, path)
+    return index
+
+
+def _window(index, stream, start_ts, end_ts):
+    """(stream index, first bin, last bin + 1) of a query, in absolute bins"""
+    s = index['streams'][stream]
+    width = index['resolution_ms']
+    origin = s['origin'] if s['origin'] is not None else 0
+    lo = origin if start_ts is None else int(start_ts) // width
+    hi = origin + len(s['bits']) if end_ts is None else \
+        -(-int(end_ts) // width)
+    return s, lo, max(lo, hi)
+
+
+def _prefix(s):
+    """Prefix sums of a stream's bitmap (computed once, then cached)"""
+    if s['prefix'] is None:
+        s['prefix'] = np.r_[0, np.cumsum(s['bits'], dtype=np.int64)]
+    return s['prefix']
+
+
+def _covered_bins(s, lo, hi):
+    """Covered bins in each [lo, hi) (arrays ok) -- O(1) with prefix sums"""
+    if s['origin'] is None:
+        return np.zeros(np.shape(lo), dtype=np.int64)
+    n = len(s['bits'])
+    a = np.clip(np.asarray(lo) - s['origin'], 0, n)
+    b = np.clip(np.asarray(hi) - s['origin'], 0, n)
+    prefix = _prefix(s)
+    return prefix[b] - prefix[a]
+
+
+def coverage_span(index, stream):
+    """(first, last) Java time covered by a stream, or None if no data"""
+    s = index['streams'][stream]
+    if s['origin'] is None:
+        return None
+    width = index['resolution_ms']
+    return s['origin'] * width, (s['origin'] + len(s['bits'])) * width
+
+
+def covered_fraction(index, stream, start_ts=None, end_ts=None):
+    """Fraction of [start_ts, end_ts) with data
+
+    Parameters
+    ----------
+    index : coverage index (see build_coverage())
+    stream : the data stream (see list_data_files())
+    start_ts : Java time (default is the first covered bin)
+    end_ts : Java time (default is the end of the last covered bin)
+
+    """
+    s, lo, hi = _window(index, stream, start_ts, end_ts)
+    if hi == lo:
+        return np.nan
+    return int(_covered_bins(s, lo, hi)) / float(hi - lo)
+
+
+def coverage_intervals(index, stream, start_ts=None, end_ts=None,
+                       covered=True):
+    """Covered (or uncovered) intervals within [start_ts, end_ts)
+
+    Parameters
+    ----------
+    index : coverage index (see build_coverage())
+    stream : the data stream (see list_data_files())
+    start_ts : Java time (default is the first covered bin)
+    end_ts : Java time (default is the end of the last covered bin)
+    covered : if False, returns the gaps instead
+
+    Notes
+    -----
+    Returns a DataFrame with start and end (Java time, at bin boundaries) and
+    seconds.
+
+    """
+    s, lo, hi = _window(index, stream, start_ts, end_ts)
+    width = index['resolution_ms']
+    window = np.zeros(hi - lo, dtype=bool)
+    if s['origin'] is not None:
+        a = max(lo, s['origin'])
+        b = min(hi, s['origin'] + len(s['bits']))
+        if b > a:
+            window[a - lo:b - lo] = s['bits'][a - s['origin']:b - s['origin']]
+    if not covered:
+        window = ~window
+    edges = np.diff(np.r_[0, window.astype(np.int8), 0])
+    starts = (np.flatnonzero(edges == 1) + lo) * width
+    ends = (np.flatnonzero(edges == -1) + lo) * width
+    return pd.DataFrame({'start': starts, 'end': ends,
+                         'seconds': (ends - starts) / 1000.},
+                        columns=['start', 'end', 'seconds'])
+
+
+def coverage_gaps(index, stream, start_ts=None, end_ts=None, min_gap=0):
+    """Gaps (no data) of at least min_gap seconds, see coverage_intervals()"""
+    gaps = coverage_intervals(index, stream, start_ts, end_ts, covered=False)
+    return gaps[gaps['seconds'] >= min_gap].reset_index(drop=True)
+
+
+def cohort_coverage(root, stream, start_ts, end_ts, freq='D', users=None,
+                    **kwargs):
+    """Fraction covered per user and period, from the coverage indexes
+
+    Parameters
+    ----------
+    root : study folder (one directory per user)
+    stream : the data stream (see list_data_files())
+    start_ts : Java time
+    end_ts : Java time
+    freq : period size, a multiple of the index resolution ('h', 'D', ...)
+    users : list of user directories (default is every folder in root)
+    kwargs : passed to build_coverage() (indexes are built or updated first)
+
+    Notes
+    -----
+    Returns a DataFrame with one row per user and one column per period.
+
+    """
+    if users is None:
+        users = list_users(root)
+    period = freq_ms(freq)
+    starts = np.arange(int(start_ts) // period * period, int(end_ts), period)
+    rows = []
+    for upath in users:
+        index = build_coverage(upath, streams=[stream], **kwargs)
+        width = index['resolution_ms']
+        if period % width:
+            raise ValueError("freq must be a multiple of the resolution")
+        s = index['streams'][stream]
+        counts = _covered_bins(s, starts // width, (starts + period) // width)
+        rows.append(counts / float(period // width))
+    names = [os.path.basename(os.path.normpath(u)) for u in users]
+    return pd.DataFrame(rows, index=names,
+                        columns=pd.to_datetime(starts, unit='ms'))
+
+
+def plot_coverage(root, stream, start_ts=None, end_ts=None, freq='h',
+                  users=None, cmap='viridis', ax=None, headless=False,
+                  psave=False, savename=None, dpi=150, **kwargs):
+    """Heatmap of data coverage, one row per user
+
+    Parameters
+    ----------
+    root : study folder (one directory per user)
+    stream : the data stream (see list_data_files())
+    start_ts : Java time (default is the earliest data of any user)
+    end_ts : Java time (default is the latest data of any user)
+    freq : size of one cell ('h', 'D', ...)
+    users : list of user directories (default is every folder in root)
+    cmap : matplotlib colormap
+    ax : axes to draw on (default is a new figure)
+    headless : if True, the figure is a bare matplotlib Figure with an Agg
+        canvas, so pyplot (and a display) is never touched
+    psave : if True, saves the figure
+    savename : file name to save as
+    kwargs : passed to build_coverage()
+
+    Notes
+    -----
+    Returns (fig, ax). Only the coverage indexes are read, never the data.
+
+    """
+    if users is None:
+        users = list_users(root)
+    if start_ts is None or end_ts is None:
+        spans = [coverage_span(build_coverage(upath, streams=[stream],
+                                              **kwargs), stream)
+                 for upath in users]
+        spans = [span for span in spans if span is not None]
+        if not spans:
+            raise ValueError("No '%s' data found under %s" % (stream, root))
+        start_ts = min(sp[0] for sp in spans) if start_ts is None else start_ts
+        end_ts = max(sp[1] for sp in spans) if end_ts is None else end_ts
+    cov = cohort_coverage(root, stream, start_ts, end_ts, freq=freq,
+                          users=users, **kwargs)
+
+    if ax is None:
+        fig, ax = new_figure(figsize=(10, max(2, .3 * len(cov) + 1)),
+                             headless=headless)
+    else:
+        fig = ax.figure
+    image = ax.imshow(cov.values, aspect='auto', interpolation='nearest',
+                      cmap=cmap, vmin=0, vmax=1)
+    ax.set_yticks(np.arange(len(cov)))
+    ax.set_yticklabels(cov.index)
+    ticks = np.linspace(0, len(cov.columns) - 1,
+                        min(8, len(cov.columns))).astype(int)
+    ax.set_xticks(ticks)
+    ax.set_xticklabels([cov.columns[i].strftime('%m-%d %H:%M')
+                        for i in ticks], rotation=30, ha='right')
+    ax.set_title('%s coverage (fraction of each %s)' % (stream, freq))
+    fig.colorbar(image, ax=ax)
+
+    if psave is True:
+        if savename is None:
+            savename = 'coverage_' + stream + '.pdf'
+        fig.savefig(savename, bbox_inches='tight', dpi=dpi)
+    return fig, ax
@@ -1,11 +1,18 @@
-import urllib
-import urllib2
-import StringIO
+from __future__ import print_function
+try:
+    from urllib import urlencode
+    from urllib2 import Request, urlopen
+except ImportError:  # Python 3
+    from urllib.parse import urlencode
+    from urllib.request import Request, urlopen
+import io
 import zipfile
 import json
 import os
 import errno
 from datetime import datetime
+from beiwedata.profiling import profiled
+from beiwedata.store import extract_zip, extract_member
 
 
 ## Convenience variables
@@ -22,7 +29,20 @@ TEXTS = "texts"
 VOICE = "audio_recordings"
 WIFI = "wifi"
 
+## Server to download from. Change this (or pass `base_url`) to use another
+## deployment, or a local beiwedata.mockserver for offline testing.
+BASE_URL = os.environ.get('BEIWE_SERVER_URL', 'https://studies.beiwe.org')
+
+## Content-addressed store for downloaded files (see beiwedata.store). None
+## extracts plain files; set it (or pass `store`) to keep duplicates once.
+DATA_STORE = os.environ.get('BEIWE_DATA_STORE')
+
 ## Helper functions
+def api_url(endpoint, base_url=None):
+    """Full URL of an API endpoint, e.g. api_url('get-data/v1')"""
+    return (base_url or BASE_URL).rstrip('/') + '/' + endpoint
+
+
 def mkdir_p(path):
     """Same as `mkdir -p` in linux -- makes directory with intermediates 
     
@@ -81,7 +101,8 @@ class cd:
 
 def make_request(study_id, access_key, secret_key, user_ids=None, 
                  data_streams=None, time_start=None, time_end=None, 
-                 folder='.', return_new=False, verbose=True):
+                 folder='.', return_new=False, verbose=True, base_url=None,
+                 store=None):
     """Submit a download request to the studies.beiwe.org server
      
     Parameters
@@ -96,12 +117,20 @@ def make_request(study_id, access_key, secret_key, user_ids=None,
     folder : download to this folder (default is current working directory)
     return_new : if True, return a list of new/updated files
     verbose : if True, provide feedback
+    base_url : server to download from (default is BASE_URL)
+    store : content-addressed store folder (default is DATA_STORE). Files
+        are hashed as they are extracted, kept once in the store and hard
+        linked into `folder` (see beiwedata.store).
     
     Notes
     -----
     It is preferrable to download all the data in the same directory so the
     function can leverage the `registry` file and prevent downloading 
     redundant data and speeding up the process.
+
+    With a store, byte-identical files (overlapping requests, different
+    folders, re-registered users) share one copy on disk, and import_df()
+    parses them only once.
      
     Details
     -------
@@ -145,9 +174,13 @@ def make_request(study_id, access_key, secret_key, user_ids=None,
     """
     if folder != '.':
         mkdir_p(folder)
+    store = store or DATA_STORE
+    if store:
+        ## Before cd() so a relative store is relative to where we are now
+        store = os.path.abspath(store)
     
-    with cd(folder):    
-        url = 'https://studies.beiwe.org/get-data/v1'
+    with cd(folder), profiled('make_request'):
+        url = api_url('get-data/v1', base_url)
         values = {'access_key' : access_key,
                     'secret_key' : secret_key,
                     'study_id' : study_id }
@@ -173,19 +206,32 @@ def make_request(study_id, access_key, secret_key, user_ids=None,
         else: old_registry = {}
 
         if verbose:
-            print "Sending request, this could take some time."
-
-        req = urllib2.Request(url, urllib.urlencode(values))
-        response = urllib2.urlopen(req)
-        return_data = response.read()
-        
-        z = zipfile.ZipFile(StringIO.StringIO(return_data))
-        z.extractall()  
-        # could use z.extractall(path=...) but cd() makes registry mgmt easier
+            print("Sending request, this could take some time.")
+
+        with profiled('make_request.download') as p:
+            req = Request(url, urlencode(values).encode('ascii'))
+            response = urlopen(req)
+            return_data = response.read()
+            if p:
+                p.add(bytes=len(return_data))
+
+        with profiled('make_request.extract') as p:
+            z = zipfile.ZipFile(io.BytesIO(return_data))
+            if store:
+                extract_zip(z, store)
+            else:
+                ## Not z.extractall(): files may be links to a store
+                ## object, which must be replaced rather than written over
+                for info in z.infolist():
+                    extract_member(z, info)
+            # could extract to path=... but cd() makes registry mgmt easier
+            if p:
+                p.add(files=len(z.filelist),
+                      bytes=sum(i.file_size for i in z.filelist))
         
         if verbose:
-            print "Data received."
-            print "Unpacking files:", os.path.abspath('.')
+            print("Data received.")
+            print("Unpacking files:", os.path.abspath('.'))
 
         with open("registry") as f:
             new_registry = json.load(f)
@@ -199,35 +245,36 @@ def make_request(study_id, access_key, secret_key, user_ids=None,
                         if name.filename != "registry"]
         
         if verbose:
-            print "Completed: " + str(len(new_files)) + " new files"
+            print("Completed: " + str(len(new_files)) + " new files")
      
         if return_new:
             return new_files
 
-def get_users_request(study_id, access_key, secret_key):
+def get_users_request(study_id, access_key, secret_key, base_url=None):
      """ Provides a list of user ids enrolled in the given study. """
-     url = 'https://studies.beiwe.org/get-users/v1'
+     url = api_url('get-users/v1', base_url)
      values = {'access_key' : access_key,
                'secret_key' : secret_key,
                'study_id' : study_id }
 
-     req = urllib2.Request(url, urllib.urlencode(values))
-     response = urllib2.urlopen(req)
+     req = Request(url, urlencode(values).encode('ascii'))
+     response = urlopen(req)
      return json.loads(response.read())
 
-def get_studies_request(access_key, secret_key):
+def get_studies_request(access_key, secret_key, base_url=None):
      """ Provides a dictionary of the form {study_key:study_name} for studies accessible to the provided user credentials"""
-     url = 'https://studies.beiwe.org/get-studies/v1'
+     url = api_url('get-studies/v1', base_url)
      values = {'access_key' : access_key,
                'secret_key' : secret_key}
 
-     req = urllib2.Request(url, urllib.urlencode(values))
-     response = urllib2.urlopen(req)
+     req = Request(url, urlencode(values).encode('ascii'))
+     response = urlopen(req)
      return json.loads(response.read())
 
 ## Wrapper functions start here
 def download_accel(study_id, access_key, secret_key, user_ids=None, 
-            time_start=None, time_end=None, folder='.'): 
+            time_start=None, time_end=None, folder='.',
+            base_url=None, store=None): 
     """ Wrapper function to download only accelerometer data 
     
     Notes
@@ -237,11 +284,13 @@ def download_accel(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["accelerometer"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_audio(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only audio data 
     
     Notes
@@ -251,11 +300,13 @@ def download_audio(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["audio_recordings"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_bt(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only Bluetooth data 
     
     Notes
@@ -265,11 +316,13 @@ def download_bt(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["bluetooth"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_calls(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only call log data 
     
     Notes
@@ -279,11 +332,13 @@ def download_calls(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["calls"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_gps(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only GPS data 
     
     Notes
@@ -293,11 +348,13 @@ def download_gps(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["gps"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_ids(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only user identifer data 
     
     Notes
@@ -307,11 +364,13 @@ def download_ids(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["identifiers"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_logs(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only application log data 
     
     Notes
@@ -321,11 +380,13 @@ def download_logs(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["app_log"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_power(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only power state data 
     
     Notes
@@ -335,11 +396,13 @@ def download_power(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["power_state"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_surveyA(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only survey answer data 
     
     Notes
@@ -349,11 +412,13 @@ def download_surveyA(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["survey_answers"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_surveyT(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only survey timing data 
     
     Notes
@@ -363,11 +428,13 @@ def download_surveyT(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["survey_timings"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_texts(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only text log data 
     
     Notes
@@ -377,11 +444,13 @@ def download_texts(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["texts"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 def download_wifi(study_id, access_key, secret_key, user_ids=None, 
-                    time_start=None, time_end=None, folder='.'): 
+                    time_start=None, time_end=None, folder='.',
+                    base_url=None, store=None): 
     """ Wrapper function to download only survey answer data 
     
     Notes
@@ -391,7 +460,8 @@ def download_wifi(study_id, access_key, secret_key, user_ids=None,
     
     make_request(study_id=study_id, access_key=access_key, user_ids=user_ids, 
                     secret_key=secret_key, data_streams=["wifi"], 
-                    time_start=time_start, time_end=time_end, folder=folder)
+                    time_start=time_start, time_end=time_end, folder=folder,
+                    base_url=base_url, store=store)
 
 
 
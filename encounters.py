@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+    Encounters between participants from Bluetooth.
+
+    The identifiers stream holds the hashed Bluetooth MAC of each phone and
+    the Bluetooth stream the hashed MACs every phone saw, so a participant
+    seeing another participant's MAC means the two were close. Instead of
+    merging every pair of users, participant_macs() indexes the
+    participants' MACs once (sorted), participant_sightings() streams every
+    user's Bluetooth files on a process pool and joins them against the
+    index with a binary search, and encounter_intervals() sorts the
+    sightings by pair and time and cuts them into intervals in one sweep.
+
+    Usage
+    -----
+    ```
+    met = find_encounters('./study')
+    met.groupby(['user_a', 'user_b'])['seconds'].sum()
+    ```
+"""
+
+import os
+import numpy as np
+from beiwedata._lazy import lazy_import
+from beiwedata.archive import read_data_csv
+from beiwedata.basic import list_data_files, file_timestamp, files_in_window
+from beiwedata.cohort import list_users, map_users
+
+__all__ = ['ENCOUNTER_COLUMNS', 'participant_macs', 'identifier_index',
+           'lookup_owners', 'participant_sightings', 'encounter_intervals',
+           'find_encounters']
+
+pd = lazy_import('pandas')
+
+ENCOUNTER_COLUMNS = ['user_a', 'user_b', 'start', 'end', 'seconds',
+                     'sightings', 'rssi_max', 'rssi_mean', 'mutual']
+
+
+def participant_macs(root, users=None):
+    """Hashed Bluetooth MAC of every participant's phone
+
+    Parameters
+    ----------
+    root : study folder (one directory per user, as downloaded)
+    users : list of user directories (default is every folder in root)
+
+    Notes
+    -----
+    Returns a DataFrame of MAC, user sorted by MAC. A phone that changed
+    MACs has a row per MAC. MACs claimed by more than one user (e.g., the
+    placeholder address of Android 6 phones) can't tell phones apart and
+    are left out.
+
+    """
+    return identifier_index(root, users, 'MAC')
+
+
+def identifier_index(root, users, column):
+    """Every user's values of an identifiers column
+
+    Parameters
+    ----------
+    root : study folder (one directory per user, as downloaded)
+    users : list of user directories (None is every folder in root)
+    column : column of the identifiers stream ('MAC', 'phone_number', ...)
+
+    Notes
+    -----
+    Returns a DataFrame of column, user sorted by value, ready for
+    lookup_owners(). Values claimed by more than one user are left out.
+
+    """
+    if users is None:
+        users = list_users(root)
+    values, owners = [], []
+    for upath in users:
+        user = os.path.basename(os.path.normpath(upath))
+        for fname in list_data_files(upath, 'id'):
+            frame = read_data_csv(fname, usecols=lambda c: c.strip() == column)
+            frame.columns = [c.strip() for c in frame.columns]
+            for value in frame[column].dropna().unique():
+                values.append(value)
+                owners.append(user)
+    index = pd.DataFrame({column: values, 'user': owners},
+                         columns=[column, 'user']).drop_duplicates()
+    index = index[~index[column].duplicated(keep=False)]
+    return index.sort_values(column).reset_index(drop=True)
+
+
+def lookup_owners(keys, owners, values):
+    """Owner of every value and whether it was found in the sorted keys
+
+    Parameters
+    ----------
+    keys : sorted array of keys (e.g., a column of identifier_index())
+    owners : array of the owner of each key
+    values : values to look up
+
+    Notes
+    -----
+    A merge join of the values against the sorted keys by binary search.
+    Returns (owners, found): where found is False, the owner is meaningless.
+
+    """
+    values = np.asarray(values).astype(object)
+    if not len(keys):
+        return np.full(len(values), None, dtype=object), \
+            np.zeros(len(values), dtype=bool)
+    pos = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+    return owners[pos], keys[pos] == values
+
+
+def _sightings_job(args):
+    """Participants seen by one user. Runs in a worker process."""
+    upath, macs, owners, start_ts, end_ts, min_rssi = args
+    user = os.path.basename(os.path.normpath(upath))
+    flist = files_in_window(list_data_files(upath, 'blue'), start_ts, end_ts)
+    wanted = set(['timestamp', 'MAC', 'RSSI'])
+    parts = []
+    for fname in sorted(flist, key=file_timestamp):
+        frame = read_data_csv(fname, usecols=lambda c: c.strip() in wanted)
+        frame.columns = [c.strip() for c in frame.columns]
+        frame = frame[frame['MAC'].notnull().values]
+        if start_ts is not None:
+            frame = frame[frame['timestamp'].values >= start_ts]
+        if end_ts is not None:
+            frame = frame[frame['timestamp'].values <= end_ts]
+        if min_rssi is not None:
+            frame = frame[frame['RSSI'].values >= min_rssi]
+        ## Join against the sorted index of participant MACs
+        seen, found = lookup_owners(macs, owners, frame['MAC'].values)
+        hit = found & (seen != user)
+        if hit.any():
+            parts.append(pd.DataFrame({
+                'observer': user, 'seen': seen[hit],
+                'timestamp': frame['timestamp'].values[hit].astype(np.int64),
+                'RSSI': frame['RSSI'].values[hit].astype(float)}))
+    if not parts:
+        return None
+    return pd.concat(parts, ignore_index=True)
+
+
+def participant_sightings(root, users=None, start_ts=None, end_ts=None,
+                          min_rssi=None, workers=None, verbose=False):
+    """Every time a participant's phone saw another participant's phone
+
+    Parameters
+    ----------
+    root : study folder (one directory per user, as downloaded)
+    users : list of user directories (default is every folder in root)
+    start_ts : only use scans at or after this timestamp (see
+        make_timestamp())
+    end_ts : only use scans at or before this timestamp
+    min_rssi : drop sightings weaker than this (dBm)
+    workers : number of processes (default is one per CPU; 1 runs in this
+        process)
+    verbose : if True, prints progress
+
+    Notes
+    -----
+    Returns a DataFrame of observer, seen, timestamp, RSSI. Workers only
+    send back the rows that matched a participant, so memory doesn't grow
+    with the number of Bluetooth scans.
+
+    """
+    if users is None:
+        users = list_users(root)
+    index = participant_macs(root, users)
+    macs = index['MAC'].values.astype(object)
+    owners = index['user'].values.astype(object)
+    jobs = [(upath, macs, owners, start_ts, end_ts, min_rssi)
+            for upath in users]
+
+    parts = [result for result in map_users(_sightings_job, jobs, workers,
+                                            verbose)
+             if result is not None]
+    columns = ['observer', 'seen', 'timestamp', 'RSSI']
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(parts, ignore_index=True)[columns]
+
+
+def encounter_intervals(sightings, max_gap=600):
+    """Cuts sightings (see participant_sightings()) into encounters
+
+    Parameters
+    ----------
+    sightings : DataFrame of observer, seen, timestamp, RSSI
+    max_gap : seconds without a sighting (either way) that end an encounter
+
+    Notes
+    -----
+    Returns a DataFrame with columns user_a, user_b (user_a < user_b),
+    start, end (Java time), seconds, sightings, rssi_max, rssi_mean and
+    mutual (True if both phones saw each other). A sighting of b by a and
+    one of a by b count toward the same encounter. Sightings are sorted by
+    (pair, time) once and every interval is found in a single sweep.
+
+    """
+    if not len(sightings):
+        return pd.DataFrame(columns=ENCOUNTER_COLUMNS)
+    observer = sightings['observer'].values.astype(object)
+    seen = sightings['seen'].values.astype(object)
+    codes, names = pd.factorize(np.concatenate([observer, seen]), sort=True)
+    obs, other = codes[:len(observer)], codes[len(observer):]
+    a, b = np.minimum(obs, other), np.maximum(obs, other)
+    ts = sightings['timestamp'].values.astype(np.int64)
+    rssi = sightings['RSSI'].values.astype(float)
+
+    order = np.lexsort((ts, b, a))
+    a, b, ts, rssi, obs = a[order], b[order], ts[order], rssi[order], \
+        obs[order]
+    new = np.ones(len(ts), dtype=bool)
+    new[1:] = ((a[1:] != a[:-1]) | (b[1:] != b[:-1]) |
+               (np.diff(ts) > max_gap * 1000))
+    starts = np.flatnonzero(new)
+    count = np.diff(np.append(starts, len(ts)))
+    from_a = np.add.reduceat((obs == a).astype(np.int64), starts)
+    out = pd.DataFrame({
+        'user_a': np.asarray(names)[a[starts]],
+        'user_b': np.asarray(names)[b[starts]],
+        'start': ts[starts],
+        'end': np.maximum.reduceat(ts, starts),
+        'sightings': count,
+        'rssi_max': np.fmax.reduceat(rssi, starts),
+        'rssi_mean': np.add.reduceat(np.nan_to_num(rssi), starts) /
+        np.maximum(np.add.reduceat((~np.isnan(rssi)).astype(np.int64),
+                                   starts), 1),
+        'mutual': (from_a > 0) & (from_a < count)})
+    out['seconds'] = (out['end'] - out['start']) / 1000.
+    return out.sort_values(['start', 'user_a', 'user_b'])[
+        ENCOUNTER_COLUMNS].reset_index(drop=True)
+
+
+def find_encounters(root, users=None, start_ts=None, end_ts=None,
+                    max_gap=600, min_rssi=None, workers=None, verbose=False):
+    """Encounter intervals between every pair of participants of a study
+
+    Parameters
+    ----------
+    root : study folder (one directory per user, as downloaded)
+    max_gap : seconds without a sighting that end an encounter
+    users / start_ts / end_ts / min_rssi / workers / verbose : see
+        participant_sightings()
+
+    Notes
+    -----
+    participant_sightings() followed by encounter_intervals(); see both.
+    Bluetooth scans are usually 5 minutes apart, so `max_gap` should be at
+    least that. An encounter seen in a single scan has 0 seconds.
+
+    """
+    sightings = participant_sightings(root, users, start_ts, end_ts,
+                                      min_rssi, workers, verbose)
+    return encounter_intervals(sightings, max_gap)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+    `beiwedata` scripts for the GPS data stream.
+
+    These are the fast (no `basemap`) versions of the GPS plots. Points are
+    projected to Web Mercator with plain numpy, binned into a 2D density
+    raster, and drawn as a single image, so a few million points take about a
+    second and nothing here needs a display.
+"""
+
+import os
+import numpy as np
+from beiwedata._plotting import new_figure
+
+__all__ = ['EARTH_RADIUS', 'MAX_LATITUDE', 'mercator', 'inverse_mercator',
+           'gps_density', 'load_shapefile', 'plot_gps_density']
+
+## Radius used by Web Mercator (EPSG:3857), in meters
+EARTH_RADIUS = 6378137.0
+
+## Web Mercator is undefined at the poles, so clip like everybody else does
+MAX_LATITUDE = 85.0511287798
+
+## Width (and height) in meters given to bounds with none, e.g. a single
+## point with spacer=0
+_MIN_EXTENT = 1.0
+
+## Shapefiles already read (and projected) -- see load_shapefile()
+_SHAPE_CACHE = {}
+
+
+def mercator(lon, lat):
+    """Projects longitude and latitude (degrees) to Web Mercator (meters)
+
+    Parameters
+    ----------
+    lon : array of longitudes
+    lat : array of latitudes
+
+    Notes
+    -----
+    Returns a tuple of numpy arrays (x, y). Latitudes are clipped to
+    +/- 85.05 degrees since the projection goes to infinity at the poles.
+
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.clip(np.asarray(lat, dtype=np.float64),
+                  -MAX_LATITUDE, MAX_LATITUDE)
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def inverse_mercator(x, y):
+    """Inverse of mercator() -- returns (lon, lat) in degrees"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    lon = np.degrees(x / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    return lon, lat
+
+
+def gps_density(lon, lat, bounds=None, bins=512, spacer=.001):
+    """Bins GPS points into a 2D count raster in Web Mercator coordinates
+
+    Parameters
+    ----------
+    lon : array of longitudes
+    lat : array of latitudes
+    bounds : [llcrnrlat, llcrnrlon, urcrnrlat, urcrnrlon] (same as plot_gps())
+        If None, uses the min/max of the points plus `spacer`.
+    bins : number of pixels along the longer side of the raster (the other
+        side is scaled so pixels are square), or a (ny, nx) tuple
+    spacer : if bounds are not specified, the amount of buffer (in degrees)
+        to add to min/max latitude/longitude
+
+    Notes
+    -----
+    Returns (counts, extent) where counts is an (ny, nx) integer array with
+    row 0 at the *bottom* (i.e., use origin='lower') and extent is
+    (xmin, xmax, ymin, ymax) in Web Mercator meters. Points outside of the
+    bounds are dropped. Bounds with no width or height (one point, or the
+    same point over and over, with spacer=0) are widened to a meter around
+    it.
+
+    Uses np.bincount on flattened pixel indices rather than np.histogram2d,
+    which is several times faster for millions of points.
+
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    keep = np.isfinite(lon) & np.isfinite(lat)
+    lon = lon[keep]
+    lat = lat[keep]
+
+    if bounds is None:
+        if len(lon) == 0:
+            raise ValueError("No GPS points to bin and no bounds given.")
+        bounds = [lat.min() - spacer, lon.min() - spacer,
+                  lat.max() + spacer, lon.max() + spacer]
+    xmin, ymin = mercator(bounds[1], bounds[0])
+    xmax, ymax = mercator(bounds[3], bounds[2])
+    xmin, ymin, xmax, ymax = float(xmin), float(ymin), float(xmax), float(ymax)
+    if xmax == xmin:
+        xmin, xmax = xmin - _MIN_EXTENT / 2, xmax + _MIN_EXTENT / 2
+    if ymax == ymin:
+        ymin, ymax = ymin - _MIN_EXTENT / 2, ymax + _MIN_EXTENT / 2
+
+    ## Square pixels unless told otherwise
+    if np.isscalar(bins):
+        width = max(xmax - xmin, 1e-9)
+        height = max(ymax - ymin, 1e-9)
+        if width >= height:
+            nx = int(bins)
+            ny = max(1, int(round(bins * height / width)))
+        else:
+            ny = int(bins)
+            nx = max(1, int(round(bins * width / height)))
+    else:
+        ny, nx = int(bins[0]), int(bins[1])
+
+    x, y = mercator(lon, lat)
+    col = np.floor((x - xmin) / (xmax - xmin) * nx).astype(np.int64)
+    row = np.floor((y - ymin) / (ymax - ymin) * ny).astype(np.int64)
+
+    ## Points exactly on the upper edge belong to the last pixel
+    col[x == xmax] = nx - 1
+    row[y == ymax] = ny - 1
+    inside = (col >= 0) & (col < nx) & (row >= 0) & (row < ny)
+
+    counts = np.bincount(row[inside] * nx + col[inside], minlength=nx * ny)
+    counts = counts.reshape(ny, nx)
+
+    return counts, (xmin, xmax, ymin, ymax)
+
+
+def load_shapefile(shpfile):
+    """Reads a line/polygon shapefile and returns its parts in Web Mercator
+
+    Parameters
+    ----------
+    shpfile : path to the shapefile, with or without the .shp extension
+        (same convention as Basemap.readshapefile())
+
+    Notes
+    -----
+    Needs `pyshp` (`pip install pyshp`), which is what basemap used under the
+    hood anyway. Shapefiles must be in longitude/latitude (WGS84).
+
+    Results are cached by path and modification time, so the (usually slow)
+    read and projection only happens once per process. Returns a list of
+    (n, 2) numpy arrays, one per part.
+
+    """
+    if shpfile.endswith('.shp'):
+        shpfile = shpfile[:-4]
+    key = (os.path.abspath(shpfile), os.path.getmtime(shpfile + '.shp'))
+    if key in _SHAPE_CACHE:
+        return _SHAPE_CACHE[key]
+
+    import shapefile
+
+    reader = shapefile.Reader(shpfile)
+    parts = []
+    for shape in reader.shapes():
+        if not shape.points:
+            continue
+        points = np.asarray(shape.points, dtype=np.float64)[:, :2]
+        x, y = mercator(points[:, 0], points[:, 1])
+        starts = list(shape.parts) + [len(points)]
+        for i in range(len(starts) - 1):
+            if starts[i + 1] - starts[i] > 1:
+                parts.append(np.column_stack((x[starts[i]:starts[i + 1]],
+                                              y[starts[i]:starts[i + 1]])))
+
+    _SHAPE_CACHE[key] = parts
+    return parts
+
+
+def plot_gps_density(df, start_ts=None, end_ts=None, bounds=None, spacer=.001,
+                     bins=512, ts_col='time', shpfile=None, shp_color='.6',
+                     shp_lw=.5, cmap='inferno', log=True, ax=None,
+                     headless=False, psave=False, savename=None, dpi=150):
+    """Plots users GPS points as a density raster (no basemap needed)
+
+    Parameters
+    ----------
+    df : a pandas.DataFrame containing GPS data (via import_df())
+    start_ts : starting timestamp (see make_timestamp())
+    end_ts : ending timestamp (see make_timestamp())
+    bounds : lower left and upper right bounds of the plot
+        If specified, should be a list specifying
+            [llcrnrlat, llcrnrlon, urcrnrlat, urcrnrlon]
+    spacer : if bounds are not specified, the amount of buffer to
+        add to min/max latitude/longitude
+    bins : pixels along the longer side of the raster (see gps_density())
+    ts_col : the name of the timestamp column
+    shpfile : an overlay shapefile if you want (e.g., roads). Cached after the
+        first load (see load_shapefile()).
+    shp_color : line color of the shapefile overlay
+    shp_lw : line width of the shapefile overlay
+    cmap : matplotlib colormap for the density
+    log : if True, color by log(1 + count) so single points stay visible
+    ax : draw on this axes instead of making a new figure
+    headless : if True, the figure is a bare matplotlib Figure with an Agg
+        canvas, so pyplot (and a display) is never touched
+    psave : if True, save the plot
+    savename : name of the plot to be saved (default is 'gps_density.png')
+    dpi : resolution of the saved plot
+
+    Notes
+    -----
+    Same idea as plot_gps(), but the points are binned in Web Mercator with
+    numpy and drawn with one imshow() call instead of projecting and plotting
+    every point through basemap. Empty pixels are transparent. Axes are in
+    Web Mercator meters; ticks are turned off.
+
+    Returns fig, ax.
+
+    """
+    ## Data stuff -- slice with numpy so we never copy the whole frame
+    ts = df[ts_col].values
+    mask = np.ones(len(ts), dtype=bool)
+    if start_ts is not None:
+        mask &= ts >= start_ts
+    if end_ts is not None:
+        mask &= ts <= end_ts
+    lon = df['longitude'].values[mask]
+    lat = df['latitude'].values[mask]
+
+    counts, extent = gps_density(lon, lat, bounds=bounds, bins=bins,
+                                 spacer=spacer)
+
+    ## Set up the figure
+    if ax is not None:
+        fig = ax.figure
+    else:
+        fig, ax = new_figure(headless=headless)
+
+    ## Plotting
+    if log is True:
+        values = np.ma.masked_equal(np.log1p(counts), 0)
+    else:
+        values = np.ma.masked_equal(counts, 0)
+    ax.imshow(values, extent=extent, origin='lower', cmap=cmap,
+              interpolation='nearest', aspect='equal', zorder=1)
+
+    if shpfile is not None:
+        from matplotlib.collections import LineCollection
+        ax.add_collection(LineCollection(load_shapefile(shpfile),
+                                         colors=shp_color, linewidths=shp_lw,
+                                         zorder=2))
+
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+    ax.set_xticks([])
+    ax.set_yticks([])
+
+    ## save?
+    if psave is True:
+        if savename is None:
+            savename = 'gps_density.png'
+        fig.savefig(savename, bbox_inches='tight', dpi=dpi)
+
+    return fig, ax
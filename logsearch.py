@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+    Regex search over app logs (or any stream) of a whole study.
+
+    The app log (`logFile`) stream is free text: upload failures, Doze and
+    Bluetooth crashes only show up there. search_logs() greps it across
+    every user without parsing anything: file names are used to skip files
+    outside the time window (see files_in_window()), files are spread over
+    a process pool in batches, and each worker memory-maps its files and
+    runs one compiled regex over the raw bytes, so only the matching lines
+    are ever turned into strings and sent back.
+
+    Usage
+    -----
+    ```
+    hits = search_logs('./study', r'(?i)doze|bluetooth.*(crash|error)',
+                       start_ts=make_timestamp(2015, 5, 5))
+    hits.groupby('user').size()
+    ```
+"""
+
+import mmap
+import os
+import re
+from beiwedata._lazy import lazy_import
+from beiwedata.archive import is_archived, read_member
+from beiwedata.basic import list_data_files, file_timestamp, files_in_window
+from beiwedata.cohort import list_users, map_users
+
+__all__ = ['SEARCH_COLUMNS', 'search_logs']
+
+pd = lazy_import('pandas')
+
+SEARCH_COLUMNS = ['user', 'file_ts', 'lineno', 'line']
+
+## Files per pool job. Log files are small, so one job per file would spend
+## more time on pickling than on searching.
+_BATCH_FILES = 64
+
+
+def _search_bytes(regex, data):
+    """(line number, line) of every line with a match. Skips the header."""
+    found = []
+    start = data.find(b'\n') + 1
+    if start == 0:
+        return found
+    lineno, counted = 2, start
+    end = len(data)
+    while start < end:
+        match = regex.search(data, start)
+        if match is None:
+            break
+        first = data.rfind(b'\n', 0, match.start()) + 1
+        if first < start:  # a match that runs into the header
+            first = start
+        last = data.find(b'\n', max(match.end() - 1, match.start()))
+        if last == -1:
+            last = end
+        lineno += data[counted:first].count(b'\n')
+        counted = first
+        line = data[first:last].rstrip(b'\r')
+        found.append((lineno, line.decode('utf-8', 'replace')))
+        start = last + 1
+    return found
+
+
+def _search_file(regex, fname):
+    """Matching lines of one data file, plain (memory-mapped) or archived"""
+    if is_archived(fname):
+        return _search_bytes(regex, read_member(fname))
+    with open(fname, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return []
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _search_bytes(regex, data)
+        finally:
+            data.close()
+
+
+def _search_job(args):
+    """Matching lines of a batch of files. Runs in a worker process."""
+    pattern, flags, files = args
+    regex = re.compile(pattern, flags)
+    rows = []
+    for user, fname in files:
+        ts = file_timestamp(fname)
+        for lineno, line in _search_file(regex, fname):
+            rows.append((user, ts, lineno, line))
+    return len(files), rows
+
+
+def search_logs(root, pattern, users=None, start_ts=None, end_ts=None,
+                stream='app', ignore_case=False, workers=None,
+                verbose=False):
+    """Lines matching a regular expression in every user's files of a stream
+
+    Parameters
+    ----------
+    root : study folder (one directory per user, as downloaded)
+    pattern : regular expression (Python `re` syntax), matched against each
+        line like grep does
+    users : list of user directories (default is every folder in root)
+    start_ts : skip files that can't hold lines at or after this Java time
+        (see make_timestamp())
+    end_ts : skip files that can't hold lines at or before this Java time
+    stream : data stream to search (default is the app log, 'app'; see
+        list_data_files())
+    ignore_case : if True, matches regardless of case
+    workers : number of processes (default is one per CPU; 1 runs in this
+        process)
+    verbose : if True, prints progress
+
+    Notes
+    -----
+    Returns a DataFrame of user, file_ts (creation time of the file, Java
+    time), lineno (1 is the header) and line, in user, file and line order.
+    A line is returned once however many times it matches. The time window
+    only prunes whole files by their names (see files_in_window()); lines
+    aren't filtered by their own timestamps.
+
+    The pattern is compiled once per batch of files and run over the bytes
+    of each file (memory-mapped, or decoded from the archive for archived
+    files, see beiwedata.archive), so lines are only decoded (as UTF-8)
+    when they match.
+
+    """
+    if not isinstance(pattern, bytes):
+        pattern = pattern.encode('utf-8')
+    ## ^ and $ match at every line, as in grep
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    re.compile(pattern, flags)  # raises here rather than in the workers
+    if users is None:
+        users = list_users(root)
+
+    files = []
+    for upath in users:
+        user = os.path.basename(os.path.normpath(upath))
+        flist = files_in_window(list_data_files(upath, stream), start_ts,
+                                end_ts)
+        files.extend((user, f) for f in sorted(flist, key=file_timestamp))
+    jobs = [(pattern, flags, files[i:i + _BATCH_FILES])
+            for i in range(0, len(files), _BATCH_FILES)]
+
+    rows = []
+    done = 0
+    for n_files, found in map_users(_search_job, jobs, workers):
+        rows.extend(found)
+        done += n_files
+        if verbose:
+            print("%d / %d files done" % (done, len(files)))
+
+    out = pd.DataFrame(rows, columns=SEARCH_COLUMNS)
+    return out.sort_values(['user', 'file_ts', 'lineno'],
+                           kind='mergesort').reset_index(drop=True)
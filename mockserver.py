@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+    A local stand-in for the Beiwe data API, for offline testing and
+    benchmarking of downloads.
+
+    Serves the `get-studies/v1`, `get-users/v1` and `get-data/v1` endpoints
+    the way studies.beiwe.org does: form-encoded POSTs with access_key /
+    secret_key, and get-data answers with a zip of `<user>/<stream>/...`
+    files plus a `registry` of their hashes. Files the client already has
+    (same hash in the posted registry) are left out, so make_request()'s
+    master_registry works as it does against the real server. Data comes
+    from study folders on disk, e.g. written by beiwedata.synthetic, and
+    latency and bandwidth can be set to mimic a real network.
+
+    Usage
+    -----
+    ```
+    from beiwedata.mockserver import serve_mock
+    server = serve_mock(n_users=5, days=2, latency=.2)
+    make_request(server.study_id, server.access_key, server.secret_key,
+                 folder='./data', base_url=server.url)
+    server.stop()
+    ```
+
+    Or from a shell (Ctrl-C to stop):
+    ```
+    python -m beiwedata.mockserver --users 5 --days 2 --port 8000
+    ```
+"""
+
+import argparse
+import calendar
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime
+from beiwedata.basic import file_timestamp
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+API_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+## Bytes written at a time when bandwidth is limited
+_CHUNK = 64 * 1024
+
+
+def _index_study(root):
+    """[(user, path in zip, stream, Java time, hash, full path)] of a study"""
+    entries = []
+    for user in sorted(os.listdir(root)):
+        upath = os.path.join(root, user)
+        if user.startswith('.') or not os.path.isdir(upath):
+            continue
+        for path, subdirs, files in os.walk(upath):
+            subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+            for name in sorted(files):
+                if name.startswith('.') or not name.endswith(
+                        ('.csv', '.mp4', '.wav')):
+                    continue
+                fname = os.path.join(path, name)
+                rel = os.path.relpath(fname, root).replace(os.sep, '/')
+                stream = rel.split('/')[1] if rel.count('/') > 1 else None
+                try:
+                    stamp = file_timestamp(fname)
+                except ValueError:
+                    stamp = None
+                with open(fname, 'rb') as f:
+                    digest = hashlib.md5(f.read()).hexdigest()
+                entries.append((user, rel, stream, stamp, digest, fname))
+    return entries
+
+
+def _java_time(text):
+    """API time string (YYYY-MM-DDThh:mm:ss) to Java time"""
+    dt = datetime.strptime(text, API_TIME_FORMAT)
+    return calendar.timegm(dt.timetuple()) * 1000
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answers one request. The server holds the data and settings."""
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def _send(self, code, body, ctype='application/json'):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        bandwidth = self.server.bandwidth
+        for i in range(0, len(body), _CHUNK):
+            chunk = body[i:i + _CHUNK]
+            self.wfile.write(chunk)
+            if bandwidth:
+                time.sleep(len(chunk) / float(bandwidth))
+        self.server._count(bytes=len(body))
+
+    def _error(self, code, message):
+        self._send(code, message.encode('utf-8'), 'text/plain')
+
+    def do_POST(self):
+        self.server._count(requests=1, active=1)
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode('utf-8')
+            params = dict((k, v[0]) for k, v in parse_qs(body).items())
+            endpoint = self.path.strip('/')
+            if endpoint not in ('get-studies/v1', 'get-users/v1',
+                                'get-data/v1'):
+                return self._error(404, 'Unknown endpoint: ' + self.path)
+            if (params.get('access_key') != self.server.access_key or
+                    params.get('secret_key') != self.server.secret_key):
+                return self._error(403, 'Invalid credentials')
+            if endpoint == 'get-studies/v1':
+                studies = dict((sid, s['name'])
+                               for sid, s in self.server.studies.items())
+                return self._send(200, json.dumps(studies).encode('utf-8'))
+            study = self.server.studies.get(params.get('study_id'))
+            if study is None:
+                return self._error(404, 'Unknown study')
+            if endpoint == 'get-users/v1':
+                users = sorted(set(e[0] for e in self.server._index(study)))
+                return self._send(200, json.dumps(users).encode('utf-8'))
+            return self._send(200, self.server._zip(study, params),
+                              'application/zip')
+        finally:
+            self.server._count(active=-1)
+
+    def do_GET(self):
+        self._error(405, 'Use POST')
+
+
+class MockBeiweServer(ThreadingMixIn, HTTPServer):
+    """Local Beiwe data API server (see the module docstring)
+
+    Parameters
+    ----------
+    studies : {study_id: study folder} or {study_id: (name, study folder)}.
+        A study folder has one folder per user, as downloaded.
+    access_key / secret_key : the credentials it accepts
+    host / port : where to listen (port 0 picks a free port)
+    latency : seconds to wait before every response
+    bandwidth : bytes per second to send at (None is as fast as possible)
+    compress : if True, zips are deflated like the real server's; False is
+        faster for throughput tests
+    verbose : if True, logs every request
+
+    Notes
+    -----
+    Requests are handled in threads, so concurrent downloads are served
+    concurrently. `stats` counts requests, bytes and files sent and the most
+    requests in flight at once. Study folders are indexed (and hashed) on
+    the first request; call rescan() after adding files.
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, studies, access_key='mock-access-key',
+                 secret_key='mock-secret-key', host='127.0.0.1', port=0,
+                 latency=0., bandwidth=None, compress=True, verbose=False):
+        HTTPServer.__init__(self, (host, port), _Handler)
+        self.studies = {}
+        for sid, study in studies.items():
+            name, root = study if isinstance(study, tuple) else (sid, study)
+            self.studies[sid] = {'name': name, 'root': root, 'index': None}
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.compress = compress
+        self.verbose = verbose
+        self.stats = {'requests': 0, 'bytes': 0, 'files': 0, 'active': 0,
+                      'max_active': 0}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._handlers = set()
+        self._tmp = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    @property
+    def study_id(self):
+        """ID of the first study (handy when there's only one)"""
+        return sorted(self.studies)[0]
+
+    def _count(self, **stats):
+        with self._lock:
+            for key, value in stats.items():
+                self.stats[key] += value
+            self.stats['max_active'] = max(self.stats['max_active'],
+                                           self.stats['active'])
+
+    def _index(self, study):
+        with self._lock:
+            if study['index'] is None:
+                study['index'] = _index_study(study['root'])
+            return study['index']
+
+    def rescan(self):
+        """Re-reads the study folders (e.g., after adding data)"""
+        with self._lock:
+            for study in self.studies.values():
+                study['index'] = None
+
+    def _zip(self, study, params):
+        """The get-data/v1 zip for one request"""
+        users = streams = None
+        if params.get('user_ids'):
+            users = set(json.loads(params['user_ids']))
+        if params.get('data_streams'):
+            streams = set(json.loads(params['data_streams']))
+        start = _java_time(params['time_start']) \
+            if params.get('time_start') else None
+        end = _java_time(params['time_end']) if params.get('time_end') else None
+        registry = json.loads(params['registry']) \
+            if params.get('registry') else {}
+
+        sent = {}
+        buf = io.BytesIO()
+        method = zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED
+        with zipfile.ZipFile(buf, 'w', method) as z:
+            for user, rel, stream, stamp, digest, fname in self._index(study):
+                if users is not None and user not in users:
+                    continue
+                if streams is not None and stream not in streams:
+                    continue
+                if stamp is not None and ((start is not None and stamp < start)
+                                          or (end is not None and stamp > end)):
+                    continue
+                if registry.get(rel) == digest:
+                    continue
+                z.write(fname, rel)
+                sent[rel] = digest
+            z.writestr('registry', json.dumps(sent))
+        self._count(files=len(sent))
+        return buf.getvalue()
+
+    def process_request(self, request, client_address):
+        """Handles a request in a new thread, remembered until it ends so
+        stop() can wait for it"""
+        thread = threading.Thread(target=self._handle_request,
+                                  args=(request, client_address))
+        thread.daemon = self.daemon_threads
+        with self._lock:
+            self._handlers.add(thread)
+        thread.start()
+
+    def _handle_request(self, request, client_address):
+        try:
+            self.process_request_thread(request, client_address)
+        finally:
+            with self._lock:
+                self._handlers.discard(threading.current_thread())
+
+    def start(self):
+        """Serves in a background thread, returns the base URL"""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        """Stops serving (and removes generated data, see serve_mock())
+
+        Waits for the requests being handled to finish first, so none of
+        them reads files that are being removed.
+        """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            handlers = list(self._handlers)
+        for thread in handlers:
+            thread.join()
+        self.server_close()
+        if self._tmp is not None:
+            shutil.rmtree(self._tmp, ignore_errors=True)
+            self._tmp = None
+
+    def __enter__(self):
+        if self._thread is None:
+            self.start()
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.stop()
+
+
+def serve_mock(root=None, study_id='5873fe38644ad7557b168e43',
+               n_users=3, days=1, scale=1., seed=None, **kwargs):
+    """Starts a MockBeiweServer in the background and returns it
+
+    Parameters
+    ----------
+    root : study folder to serve. If None, a synthetic study is written to a
+        temporary folder (removed by stop()).
+    study_id : ID the study is served under
+    n_users / days / scale / seed : size of the synthetic study (see
+        beiwedata.synthetic.make_study())
+    kwargs : passed to MockBeiweServer (latency, bandwidth, port, ...)
+
+    """
+    tmp = None
+    if root is None:
+        from beiwedata.synthetic import make_study
+        tmp = tempfile.mkdtemp(prefix='beiwe_mock_')
+        root = os.path.join(tmp, 'study')
+        make_study(root, n_users=n_users, seed=seed, days=days, scale=scale)
+    server = MockBeiweServer({study_id: ('Mock study', root)}, **kwargs)
+    server._tmp = tmp
+    server.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the Beiwe data API')
+    parser.add_argument('--root', help='study folder to serve (default is a '
+                        'synthetic study)')
+    parser.add_argument('--study-id', default='5873fe38644ad7557b168e43')
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--scale', type=float, default=1.)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.)
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='bytes per second')
+    parser.add_argument('--no-compress', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    server = serve_mock(args.root, args.study_id, n_users=args.users,
+                        days=args.days, scale=args.scale, seed=args.seed,
+                        host=args.host, port=args.port, latency=args.latency,
+                        bandwidth=args.bandwidth,
+                        compress=not args.no_compress, verbose=args.verbose)
+    print('Serving study %s at %s' % (args.study_id, server.url))
+    print('access_key=%s secret_key=%s' % (server.access_key,
+                                           server.secret_key))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+    The in-study communication network from calls and texts.
+
+    Call and text logs hold the hashed phone number of the other side and
+    the identifiers stream each participant's own hashed phone number, so
+    calls and texts between two participants can be told apart from the
+    rest. build_network() turns every user's logs into a weighted edge list
+    (calls, minutes, texts from one participant to another, per day or any
+    other window) -- one process per user, duplicates suppressed like
+    suppress_duplicates(). Nothing is ever loaded for more than one user at
+    a time.
+
+    The edges are saved at the top of the study folder (`.network.npz`) as
+    integer arrays with a manifest of the files they came from, so later
+    builds only re-read users whose logs changed, and network_edges(),
+    network_matrix() and network_degrees() work from the saved edges without
+    touching the logs.
+
+    Usage
+    -----
+    ```
+    net = build_network('./study', freq='7D')
+    network_degrees(net, weight='texts')
+    matrix, users = network_matrix(net, weight='minutes')
+    ```
+"""
+
+import io
+import json
+import os
+import numpy as np
+from beiwedata._lazy import lazy_import
+from beiwedata.archive import read_data_csv, data_stat
+from beiwedata.basic import list_data_files
+from beiwedata.cohort import list_users, map_users
+from beiwedata.comm import (suppress_duplicates, call_type_codes,
+                            text_type_codes)
+from beiwedata.encounters import identifier_index, lookup_owners
+from beiwedata.power import freq_ms
+
+__all__ = ['NETWORK_FILE', 'NETWORK_WEIGHTS', 'participant_numbers',
+           'load_network', 'save_network', 'build_network', 'network_edges',
+           'network_matrix', 'network_degrees']
+
+pd = lazy_import('pandas')
+sparse = lazy_import('scipy.sparse')
+
+NETWORK_FILE = '.network.npz'
+
+NETWORK_WEIGHTS = ['calls', 'minutes', 'texts']
+
+## Integer arrays of the saved edge list (minutes are float)
+_EDGE_ARRAYS = ['reporter', 'window', 'src', 'dst', 'calls', 'texts']
+
+
+def participant_numbers(root, users=None):
+    """Hashed phone number of every participant's phone
+
+    Parameters
+    ----------
+    root : study folder (one directory per user, as downloaded)
+    users : list of user directories (default is every folder in root)
+
+    Notes
+    -----
+    Returns a DataFrame of phone_number, user sorted by number. Numbers
+    claimed by more than one user are left out (see participant_macs()).
+
+    """
+    return identifier_index(root, users, 'phone_number')
+
+
+def _read_log(upath, stream, columns):
+    """All of a user's call or text files as one frame (stripped headers)"""
+    wanted = set(columns)
+    frames = []
+    for fname in list_data_files(upath, stream):
+        frame = read_data_csv(fname, usecols=lambda c: c.strip() in wanted)
+        frame.columns = [c.strip() for c in frame.columns]
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _user_edges(args):
+    """Edges from one user's call and text logs. Runs in a worker process."""
+    upath, numbers, owners, width, tbuffer = args
+    user = os.path.basename(os.path.normpath(upath))
+    parts = []
+
+    calls = _read_log(upath, 'call', ['timestamp', 'hashed phone number',
+                                      'call type', 'duration in seconds'])
+    texts = _read_log(upath, 'text', ['timestamp', 'hashed phone number',
+                                      'sent vs received', 'message length'])
+    for stream, log, types in (('call', calls, call_type_codes),
+                               ('text', texts, text_type_codes)):
+        if tbuffer is not None and len(log):
+            log = log[~suppress_duplicates(log, tbuffer=tbuffer)]
+        other, found = lookup_owners(numbers, owners,
+                                     log['hashed phone number'].values)
+        kind = np.asarray(types(log))
+        keep = found & (other != user) & (kind >= 0)
+        kind, other = kind[keep], other[keep]
+        ## Outgoing calls (1) and sent texts (1) go from this user
+        out = kind == 1
+        edges = pd.DataFrame({
+            'window': log['timestamp'].values[keep].astype(np.int64) // width,
+            'src': np.where(out, user, other),
+            'dst': np.where(out, other, user)})
+        if stream == 'call':
+            edges['calls'] = 1
+            edges['minutes'] = np.where(kind < 2, np.nan_to_num(
+                log['duration in seconds'].values[keep].astype(float)) / 60.,
+                0.)
+            edges['texts'] = 0
+        else:
+            edges['calls'] = 0
+            edges['minutes'] = 0.
+            edges['texts'] = 1
+        parts.append(edges)
+    edges = pd.concat(parts, ignore_index=True)
+    edges = edges.groupby(['window', 'src', 'dst'], as_index=False)[
+        NETWORK_WEIGHTS].sum()
+    return user, edges
+
+
+def _manifest(upath):
+    """{relative path: [size, mtime]} of a user's call and text files"""
+    files = {}
+    for stream in ('call', 'text'):
+        for fname in list_data_files(upath, stream, nonempty=False):
+            files[os.path.relpath(fname, upath)] = list(data_stat(fname))
+    return files
+
+
+def _empty_network(width, tbuffer, numbers):
+    arrays = dict((name, np.zeros(0, dtype=np.int32))
+                  for name in _EDGE_ARRAYS)
+    arrays['minutes'] = np.zeros(0, dtype=np.float32)
+    return {'freq_ms': width, 'tbuffer': tbuffer, 'numbers': numbers,
+            'users': [], 'files': {}, 'edges': arrays}
+
+
+def load_network(root, path=None):
+    """Loads a saved network (see build_network()), or None
+
+    Parameters
+    ----------
+    root : study folder
+    path : where the network is saved (default is root/.network.npz)
+
+    """
+    path = path or os.path.join(root, NETWORK_FILE)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        meta = json.loads(saved['meta'].tobytes().decode('utf-8'))
+        edges = dict((name, saved[name]) for name in
+                     _EDGE_ARRAYS + ['minutes'])
+    meta['edges'] = edges
+    return meta
+
+
+def save_network(network, root, path=None):
+    """Saves a network (edge arrays, users and file manifest)"""
+    path = path or os.path.join(root, NETWORK_FILE)
+    meta = dict((k, v) for k, v in network.items() if k != 'edges')
+    arrays = dict(network['edges'])
+    arrays['meta'] = np.frombuffer(json.dumps(meta).encode('utf-8'),
+                                   dtype=np.uint8)
+    ## Write then rename, so a crash never leaves half a network behind
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **arrays)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(buf.getvalue())
+    os.rename(tmp, path)
+
+
+def build_network(root, freq='D', users=None, tbuffer=3000, path=None,
+                  save=True, rebuild=False, workers=None, verbose=False):
+    """Builds (or updates) the communication network of a study
+
+    Parameters
+    ----------
+    root : study folder (one directory per user, as downloaded)
+    freq : window of the edges as a pandas frequency ('D', 'h', '7D', ...)
+    users : list of user directories (default is every folder in root)
+    tbuffer : duplicates within this many ms are dropped (see
+        suppress_duplicates()); None keeps everything
+    path : where the network is saved (default is root/.network.npz)
+    save : if True, saves the network
+    rebuild : if True, ignores any saved network
+    workers : number of processes (default is one per CPU; 1 runs in this
+        process)
+    verbose : if True, prints progress
+
+    Notes
+    -----
+    Returns the network (a dict, see load_network()). The edges are kept
+    per reporting user: a call between two participants is usually in both
+    of their logs, and network_edges() takes the larger of the two counts
+    rather than adding them. Users whose call and text files are unchanged
+    since the saved network are not read again. Changing `freq` or
+    `tbuffer`, or a change in the participants' phone numbers, rebuilds
+    everything.
+
+    """
+    if users is None:
+        users = list_users(root)
+    width = freq_ms(freq)
+    index = participant_numbers(root, users)
+    numbers = index['phone_number'].values.astype(object)
+    owners = index['user'].values.astype(object)
+    mapping = sorted(zip(numbers.tolist(), owners.tolist()))
+
+    network = None if rebuild else load_network(root, path)
+    if (network is None or network['freq_ms'] != width or
+            network['tbuffer'] != tbuffer or
+            [tuple(m) for m in network['numbers']] != mapping):
+        network = _empty_network(width, tbuffer, mapping)
+
+    ## Users whose logs changed (or are new) are read again
+    names = [os.path.basename(os.path.normpath(u)) for u in users]
+    current = dict((name, _manifest(u)) for name, u in zip(names, users))
+    stale = [u for name, u in zip(names, users)
+             if network['files'].get(name) != current[name]]
+    jobs = [(upath, numbers, owners, width, tbuffer) for upath in stale]
+
+    fresh = {}
+    for user, edges in map_users(_user_edges, jobs, workers, verbose):
+        fresh[user] = edges
+
+    if fresh or set(network['files']) != set(names):
+        network = _merge(network, fresh, names, current)
+        if save:
+            save_network(network, root, path)
+    return network
+
+
+def _merge(network, fresh, names, current):
+    """Replaces the edges of re-read users and drops users that are gone"""
+    old = _edge_frame(network)
+    keep = old['reporter'].isin(set(names) - set(fresh)).values
+    frames = [old[keep]]
+    for user, edges in fresh.items():
+        frames.append(edges.assign(reporter=user)[list(old.columns)])
+    edges = pd.concat(frames, ignore_index=True)
+    users = sorted(set(names) | set(edges['src']) | set(edges['dst']))
+    code = dict((u, i) for i, u in enumerate(users))
+    arrays = {}
+    for col in ['reporter', 'src', 'dst']:
+        arrays[col] = np.array([code[u] for u in edges[col].values],
+                               dtype=np.int32)
+    arrays['window'] = edges['window'].values.astype(np.int32)
+    arrays['calls'] = edges['calls'].values.astype(np.int32)
+    arrays['texts'] = edges['texts'].values.astype(np.int32)
+    arrays['minutes'] = edges['minutes'].values.astype(np.float32)
+    network = dict(network)
+    network.update({'users': users, 'files': current, 'edges': arrays})
+    return network
+
+
+def _edge_frame(network, start_ts=None, end_ts=None):
+    """Edges of every reporter as saved, windows as numbers"""
+    e = network['edges']
+    users = np.array(network['users'], dtype=object)
+    width = network['freq_ms']
+    keep = np.ones(len(e['window']), dtype=bool)
+    if start_ts is not None:
+        keep &= e['window'].astype(np.int64) * width >= start_ts
+    if end_ts is not None:
+        keep &= e['window'].astype(np.int64) * width < end_ts
+    return pd.DataFrame({'reporter': users[e['reporter'][keep]],
+                         'window': e['window'][keep].astype(np.int64),
+                         'src': users[e['src'][keep]],
+                         'dst': users[e['dst'][keep]],
+                         'calls': e['calls'][keep].astype(np.int64),
+                         'minutes': e['minutes'][keep].astype(float),
+                         'texts': e['texts'][keep].astype(np.int64)},
+                        columns=['reporter', 'window', 'src', 'dst'] +
+                        NETWORK_WEIGHTS)
+
+
+def network_edges(network, start_ts=None, end_ts=None, per_reporter=False):
+    """The edge list of a network as a DataFrame
+
+    Parameters
+    ----------
+    network : see build_network()
+    start_ts : only windows that start at or after this Java time
+    end_ts : only windows that start before this Java time
+    per_reporter : if True, one row per reporting user (see build_network())
+
+    Notes
+    -----
+    Returns window (UTC start), src, dst, calls, minutes, texts, and
+    reporter first if per_reporter is True.
+
+    """
+    edges = _edge_frame(network, start_ts, end_ts)
+    if not per_reporter:
+        edges = edges.groupby(['window', 'src', 'dst'], as_index=False)[
+            NETWORK_WEIGHTS].max()
+    edges['window'] = pd.to_datetime(
+        edges['window'].values * network['freq_ms'], unit='ms')
+    return edges
+
+
+def network_matrix(network, weight='calls', start_ts=None, end_ts=None):
+    """Sparse users x users matrix of one weight, summed over windows
+
+    Parameters
+    ----------
+    network : see build_network()
+    weight : 'calls', 'minutes' or 'texts'
+    start_ts / end_ts : see network_edges()
+
+    Notes
+    -----
+    Returns (matrix, users): a scipy.sparse CSR matrix where [i, j] is the
+    weight from users[i] to users[j].
+
+    """
+    if weight not in NETWORK_WEIGHTS:
+        raise ValueError("weight must be one of: " +
+                         ', '.join(NETWORK_WEIGHTS))
+    users = list(network['users'])
+    code = dict((u, i) for i, u in enumerate(users))
+    edges = network_edges(network, start_ts, end_ts)
+    src = np.array([code[u] for u in edges['src'].values], dtype=np.int64)
+    dst = np.array([code[u] for u in edges['dst'].values], dtype=np.int64)
+    matrix = sparse.csr_matrix((edges[weight].values, (src, dst)),
+                               shape=(len(users), len(users)))
+    matrix.eliminate_zeros()
+    return matrix, users
+
+
+def network_degrees(network, weight='calls', start_ts=None, end_ts=None):
+    """Degree and strength of every user in every window
+
+    Parameters
+    ----------
+    network : see build_network()
+    weight : 'calls', 'minutes' or 'texts'
+    start_ts / end_ts : see network_edges()
+
+    Notes
+    -----
+    Returns a DataFrame indexed by (window, user) with out_degree and
+    in_degree (number of participants) and out_weight and in_weight (sum
+    of `weight`). Only edges with a non-zero weight count, and users
+    without any edge in a window are left out.
+
+    """
+    if weight not in NETWORK_WEIGHTS:
+        raise ValueError("weight must be one of: " +
+                         ', '.join(NETWORK_WEIGHTS))
+    edges = network_edges(network, start_ts, end_ts)
+    edges = edges[edges[weight].values > 0]
+    parts = []
+    for side, user in (('out', 'src'), ('in', 'dst')):
+        grouped = edges.groupby(['window', user])[weight]
+        part = pd.DataFrame({side + '_degree': grouped.size(),
+                             side + '_weight': grouped.sum()})
+        part.index.names = ['window', 'user']
+        parts.append(part)
+    out = pd.concat(parts, axis=1)
+    for col in ['out_degree', 'in_degree']:
+        out[col] = out[col].fillna(0).astype(int)
+    out = out.fillna(0)
+    return out[['out_degree', 'in_degree', 'out_weight',
+                'in_weight']].sort_index()
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+    Daily features that are only recomputed when their data changes.
+
+    A feature is a function of one user's data for one day. It declares the
+    data streams it reads and the other features it uses, and
+    run_pipeline() runs every feature for every user and day in dependency
+    order. Each result is saved in the user's folder
+    (`.pipeline/<feature>/<day>.pkl`) with a key made from the files it was
+    computed from -- the files list_data_files() returns for that day, by
+    size and modification time -- and the keys of the features it uses.
+    When the key hasn't changed, the result is reused without reading any
+    data, so a nightly run only computes the days whose files changed
+    (usually the newest one) and anything that depends on them. Users are
+    spread over a process pool.
+
+    Usage
+    -----
+    ```
+    @feature(streams=['accel'])
+    def accel_rows(data, start_ts, end_ts):
+        return {'rows': len(data['accel'])}
+
+    @feature(depends=['activity', 'screen_time'])
+    def active_screen(data, start_ts, end_ts):
+        ...
+
+    log = run_pipeline('./study')
+    daily = load_feature('./study', 'accel_rows')
+    ```
+
+    activity, mobility, screen_time and communication are built in.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+from collections import OrderedDict
+import numpy as np
+from beiwedata._lazy import lazy_import
+from beiwedata.archive import data_stat
+from beiwedata.basic import (list_data_files, import_df, file_timestamp,
+                             files_in_window, TIMESTAMP_COLUMNS)
+from beiwedata.cohort import list_users, map_users
+from beiwedata.comm import comm_features
+from beiwedata.power import power_summary
+
+__all__ = ['PIPELINE_DIR', 'PIPELINE_FEATURES', 'PIPELINE_LOG_COLUMNS',
+           'register_feature', 'feature', 'run_pipeline', 'load_feature']
+
+pd = lazy_import('pandas')
+
+PIPELINE_DIR = '.pipeline'
+
+## Registered features, name : spec (see register_feature())
+PIPELINE_FEATURES = OrderedDict()
+
+PIPELINE_LOG_COLUMNS = ['feature', 'user', 'day', 'status', 'seconds']
+
+_DAY = 86400000
+
+
+def register_feature(name, func, streams=(), depends=(), version=1):
+    """Adds a feature to the pipeline
+
+    Parameters
+    ----------
+    name : name of the feature (also its folder in .pipeline)
+    func : func(data, start_ts, end_ts) -> result. data maps every stream
+        to its rows for the day (a DataFrame from import_df() with
+        setindex=False, possibly empty) and every feature in `depends` to
+        its result for the same day (None if it has none). start_ts and
+        end_ts (Java time) are the day. The result can be anything that
+        pickles; dicts and Series become one row in load_feature().
+    streams : data streams it reads (see list_data_files())
+    depends : features it uses
+    version : bump it when func changes, so saved results are recomputed
+
+    Notes
+    -----
+    func has to be a module-level function so worker processes can find
+    it. Registering a name again replaces the feature.
+
+    """
+    for stream in streams:
+        if stream not in TIMESTAMP_COLUMNS:
+            raise ValueError("Unknown stream '%s'" % stream)
+    PIPELINE_FEATURES[name] = {'name': name, 'func': func,
+                               'streams': tuple(streams),
+                               'depends': tuple(depends), 'version': version}
+    return func
+
+
+def feature(streams=(), depends=(), version=1, name=None):
+    """Decorator version of register_feature() (name defaults to the
+    function's)"""
+    def register(func):
+        return register_feature(name or func.__name__, func, streams,
+                                depends, version)
+    return register
+
+
+def _ordered(names):
+    """Specs of the features and everything they use, dependencies first"""
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name not in PIPELINE_FEATURES:
+            raise ValueError("Unknown feature '%s'" % name)
+        if name in visiting:
+            raise ValueError("Features depend on each other: '%s'" % name)
+        visiting.add(name)
+        for dep in PIPELINE_FEATURES[name]['depends']:
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in names:
+        visit(name)
+    return [PIPELINE_FEATURES[name] for name in order]
+
+
+def _result_path(upath, name, day):
+    stamp = time.strftime('%Y-%m-%d', time.gmtime(day // 1000))
+    return os.path.join(upath, PIPELINE_DIR, name, stamp + '.pkl')
+
+
+def _load_saved(path):
+    """The saved {'key', 'result'} of a partition, or None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:  # unreadable (e.g., half written by an old version)
+        return None
+
+
+def _save(path, key, result):
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    ## Write then rename, so a crash never leaves half a result behind
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump({'key': key, 'result': result}, f, 2)
+    os.rename(tmp, path)
+
+
+def _key(spec, fingerprints, dep_keys):
+    text = json.dumps([spec['name'], spec['version'], fingerprints,
+                       dep_keys], sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _run_user(args):
+    """Runs the features for every day of one user. Runs in a worker."""
+    upath, specs, start_ts, end_ts = args
+    user = os.path.basename(os.path.normpath(upath))
+    streams = sorted(set(s for spec in specs for s in spec['streams']))
+    files = dict((s, list_data_files(upath, s)) for s in streams)
+
+    stamps = [file_timestamp(f) for s in streams for f in files[s]]
+    if not stamps:
+        return []
+    first = (start_ts if start_ts is not None else min(stamps)) // _DAY
+    last = (end_ts - 1 if end_ts is not None else max(stamps)) // _DAY
+
+    records = []
+    for day in range(int(first) * _DAY, int(last) * _DAY + 1, _DAY):
+        day_files = dict((s, files_in_window(files[s], day, day + _DAY - 1))
+                         for s in streams)
+        fingerprints = dict(
+            (s, sorted([os.path.relpath(f, upath)] + list(data_stat(f))
+                       for f in day_files[s])) for s in streams)
+        frames = {}
+        keys, results, failed = {}, {}, set()
+
+        def load(stream):
+            if stream not in frames:
+                tstamp = TIMESTAMP_COLUMNS[stream] or 'timestamp'
+                if day_files[stream]:
+                    frames[stream] = import_df(
+                        day_files[stream], tstamp=tstamp, setindex=False,
+                        start_ts=day, end_ts=day + _DAY - 1)
+                else:
+                    frames[stream] = pd.DataFrame(columns=[tstamp])
+            return frames[stream]
+
+        for spec in specs:
+            name = spec['name']
+            bad = [d for d in spec['depends'] if d in failed]
+            if not bad and not any(fingerprints[s] for s in spec['streams']) \
+                    and not any(keys.get(d) for d in spec['depends']):
+                continue
+            started = time.time()
+            record = {'feature': name, 'user': user,
+                      'day': pd.to_datetime(day, unit='ms')}
+            if bad:
+                failed.add(name)
+                record['status'] = 'skipped: %s failed' % ', '.join(bad)
+                record['seconds'] = 0.
+                records.append(record)
+                continue
+            key = _key(spec, [fingerprints[s] for s in spec['streams']],
+                       [keys.get(d) for d in spec['depends']])
+            path = _result_path(upath, name, day)
+            saved = _load_saved(path)
+            if saved is not None and saved['key'] == key:
+                record['status'] = 'cached'
+                results[name] = saved['result']
+            else:
+                try:
+                    data = dict((s, load(s)) for s in spec['streams'])
+                    for dep in spec['depends']:
+                        data[dep] = results.get(dep)
+                    if spec['streams'] and not any(len(data[s]) for s in
+                                                   spec['streams']):
+                        result = None
+                        record['status'] = 'no data'
+                    else:
+                        result = spec['func'](data, day, day + _DAY)
+                        record['status'] = 'computed'
+                    _save(path, key, result)
+                    results[name] = result
+                except Exception as e:
+                    failed.add(name)
+                    record['status'] = 'error: %s: %s' % (type(e).__name__, e)
+            if name not in failed:
+                keys[name] = key
+            record['seconds'] = time.time() - started
+            records.append(record)
+    return records
+
+
+def run_pipeline(root, features=None, users=None, start_ts=None, end_ts=None,
+                 workers=None, verbose=False):
+    """Computes (or reuses) features for every user and day of a study
+
+    Parameters
+    ----------
+    root : study folder (one directory per user, as downloaded)
+    features : names of the features to run (default is every registered
+        feature). Features they depend on are run too.
+    users : list of user directories (default is every folder in root)
+    start_ts : first day to run (Java time; default is each user's first
+        file)
+    end_ts : end of the last day to run (default is each user's last file)
+    workers : number of processes (default is one per CPU; 1 runs in this
+        process)
+    verbose : if True, prints progress
+
+    Notes
+    -----
+    Returns a log DataFrame with columns feature, user, day, status and
+    seconds. Status is 'computed', 'cached' (saved result reused), 'no data'
+    (none of its streams had rows that day; saved as None), 'error: ...'
+    (not saved, so it's tried again next time) or 'skipped: ... failed'.
+    Days without any file of a feature's streams are left out.
+
+    """
+    specs = _ordered(list(features or PIPELINE_FEATURES))
+    if users is None:
+        users = list_users(root)
+    jobs = [(upath, specs, start_ts, end_ts) for upath in users]
+
+    records = []
+    for result in map_users(_run_user, jobs, workers, verbose):
+        records.extend(result)
+
+    log = pd.DataFrame(records, columns=PIPELINE_LOG_COLUMNS)
+    return log.sort_values(['user', 'day']).reset_index(drop=True)
+
+
+def load_feature(root, name, users=None):
+    """Saved results of one feature for every user and day
+
+    Parameters
+    ----------
+    root : study folder
+    name : feature name
+    users : list of user directories (default is every folder in root)
+
+    Notes
+    -----
+    Dict and Series results become a DataFrame indexed by (user, day);
+    DataFrame results are concatenated with user and day added to their
+    index. Days without data (None) are left out. Results are read as saved;
+    run run_pipeline() first to bring them up to date.
+
+    """
+    if users is None:
+        users = list_users(root)
+    keys, results = [], []
+    for upath in users:
+        user = os.path.basename(os.path.normpath(upath))
+        folder = os.path.join(upath, PIPELINE_DIR, name)
+        if not os.path.isdir(folder):
+            continue
+        for fname in sorted(os.listdir(folder)):
+            if not fname.endswith('.pkl'):
+                continue
+            saved = _load_saved(os.path.join(folder, fname))
+            if saved is None or saved['result'] is None:
+                continue
+            keys.append((user, pd.Timestamp(fname[:-len('.pkl')])))
+            results.append(saved['result'])
+    if not results:
+        return pd.DataFrame()
+    if all(isinstance(r, pd.DataFrame) for r in results):
+        return pd.concat(results, keys=keys, names=['user', 'day'])
+    out = pd.DataFrame([dict(r) for r in results])
+    out.index = pd.MultiIndex.from_tuples(keys, names=['user', 'day'])
+    return out
+
+
+## Built-in features -----------------------------------------------------
+
+def _activity(data, start_ts, end_ts):
+    """Accelerometer rows, minutes with data and magnitude mean/std"""
+    accel = data['accel']
+    magnitude = np.sqrt(accel['x'].values.astype(float) ** 2 +
+                        accel['y'].values.astype(float) ** 2 +
+                        accel['z'].values.astype(float) ** 2)
+    minutes = np.unique(accel['timestamp'].values.astype(np.int64) // 60000)
+    return {'accel_rows': len(accel), 'accel_minutes': len(minutes),
+            'magnitude_mean': magnitude.mean(),
+            'magnitude_std': magnitude.std()}
+
+
+def _mobility(data, start_ts, end_ts):
+    """GPS fixes, distinct ~100 m cells and radius of gyration (km)"""
+    gps = data['gps']
+    lat = gps['latitude'].values.astype(float)
+    lon = gps['longitude'].values.astype(float)
+    ## Equirectangular projection around the mean position
+    y = np.radians(lat - lat.mean()) * 6371.
+    x = np.radians(lon - lon.mean()) * 6371. * np.cos(np.radians(lat.mean()))
+    ## One complex number per (lat, lon) cell, so no two cells share a key
+    cells = np.unique(np.round(lat, 3) + 1j * np.round(lon, 3))
+    return {'gps_fixes': len(gps), 'places_visited': len(cells),
+            'radius_of_gyration_km': np.sqrt((x ** 2 + y ** 2).mean())}
+
+
+def _screen_time(data, start_ts, end_ts):
+    """power_summary() of the day"""
+    summary = power_summary(data['power'], freq='D')
+    if not len(summary):
+        return None
+    return summary.iloc[0]
+
+
+def _communication(data, start_ts, end_ts):
+    """comm_features() of the day"""
+    calls = data['call'] if len(data['call']) else None
+    texts = data['text'] if len(data['text']) else None
+    features = comm_features(calls, texts, freq='D')
+    if not len(features):
+        return None
+    return features.iloc[0]
+
+
+register_feature('activity', _activity, streams=['accel'])
+register_feature('mobility', _mobility, streams=['gps'], version=2)
+register_feature('screen_time', _screen_time, streams=['power'])
+register_feature('communication', _communication, streams=['call', 'text'])
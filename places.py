@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+    Recurring places (home, work, ...) from WiFi scans, without GPS.
+
+    Every WiFi file is one scan: the set of hashed MACs the phone saw at the
+    time import_df() takes from the file name. scan_matrix() turns the rows
+    of one or many users into a sparse scans x MACs matrix. Scans at the
+    same place see mostly the same access points, so places are groups of
+    scans with a high Jaccard similarity. Instead of comparing every pair of
+    scans, minhash_signatures() summarizes each scan in a few dozen numbers
+    and detect_places() uses locality-sensitive hashing (LSH) on them: only
+    scans that share a bucket in at least one band are compared, and the
+    connected groups of similar scans are the places.
+
+    Usage
+    -----
+    ```
+    wifi = import_df(list_data_files(upath, 'wifi'), setindex=False)
+    scans = detect_places(wifi)
+    place_summary(scans)
+    wifi.merge(scans[['timestamp', 'place']], on='timestamp')  # every row
+    ```
+
+    Or a whole study at once (places never span users):
+    ```
+    scans = detect_places(study_wifi, user_col='user')
+    ```
+"""
+
+import numpy as np
+from beiwedata._lazy import lazy_import
+from beiwedata.power import freq_ms
+
+__all__ = ['time_buckets', 'scan_matrix', 'minhash_signatures',
+           'detect_places', 'place_summary']
+
+pd = lazy_import('pandas')
+sparse = lazy_import('scipy.sparse')
+csgraph = lazy_import('scipy.sparse.csgraph')
+
+## Mersenne prime of the minhash hash functions, (a * MAC + b) % prime
+_PRIME = (1 << 31) - 1
+
+
+def time_buckets(timestamps, freq):
+    """Start (Java time) of the `freq` bucket of every timestamp
+
+    Parameters
+    ----------
+    timestamps : Java times (array or Series)
+    freq : bucket width, e.g. '15s', '5Min', 'h'
+
+    Notes
+    -----
+    Buckets are aligned to the epoch (midnight UTC for anything that divides
+    a day), like pandas resampling. Shared by rank_mac(), plot_n_macs() and
+    scan_matrix().
+
+    """
+    width = freq_ms(freq)
+    return (np.asarray(timestamps).astype(np.int64) // width) * width
+
+
+def scan_matrix(df, cname='hashed MAC', ts_col='timestamp', user_col=None,
+                freq=None, min_rssi=None):
+    """Sparse scans x MACs matrix of WiFi (or Bluetooth) data
+
+    Parameters
+    ----------
+    df : a WiFi dataframe (see import_df(); use setindex=False), one or many
+        users
+    cname : name of the MAC column
+    ts_col : time of the scan (import_df() sets it from the file name)
+    user_col : column with the user, if df holds several users. MACs are
+        hashed per user, so the same hash in two users is two MACs.
+    freq : if set, scans in the same bucket (see time_buckets()) are merged
+    min_rssi : drop rows weaker than this (dBm), e.g. -85
+
+    Notes
+    -----
+    Returns (matrix, scans, macs): a scipy.sparse CSR matrix of 0/1 with one
+    row per scan and one column per MAC, a DataFrame of the scans (user,
+    time, number of MACs) in row order, and the MAC of every column.
+
+    """
+    if min_rssi is not None:
+        df = df[df['RSSI'].values >= min_rssi]
+    times = df[ts_col].values.astype(np.int64)
+    if freq is not None:
+        times = time_buckets(times, freq)
+    if user_col is not None:
+        users, user_names = pd.factorize(df[user_col].values)
+        users = users.astype(np.int64)
+    else:
+        users = np.zeros(len(df), dtype=np.int64)
+
+    ## Scans sorted by user, then time; MACs are (user, MAC) pairs
+    tcode, tvalues = pd.factorize(times, sort=True)
+    mcode, mvalues = pd.factorize(df[cname].values)
+    nt, nm = max(len(tvalues), 1), max(len(mvalues), 1)
+    scan_keys, scan = np.unique(users * nt + tcode, return_inverse=True)
+    mac, mac_keys = pd.factorize(users * nm + mcode)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(df), dtype=np.int8), (scan.ravel(), mac)),
+        shape=(len(scan_keys), len(mac_keys)))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+
+    scans = pd.DataFrame({ts_col: np.asarray(tvalues)[scan_keys % nt]})
+    if user_col is not None:
+        scans.insert(0, user_col, np.asarray(user_names)[scan_keys // nt])
+    scans['n_macs'] = np.diff(matrix.indptr)
+    return matrix, scans, np.asarray(mvalues)[mac_keys % nm]
+
+
+def minhash_signatures(matrix, n_hashes=64, seed=0):
+    """MinHash signature of every row of a sparse 0/1 matrix
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix, one set per row (see scan_matrix())
+    n_hashes : length of the signatures
+    seed : seed of the hash functions
+
+    Notes
+    -----
+    Returns an (n_rows, n_hashes) int64 array. The fraction of positions
+    where two signatures agree estimates the Jaccard similarity of the two
+    rows. One pass over the non-zeros per hash function; empty rows get
+    `_PRIME` everywhere.
+
+    """
+    matrix = sparse.csr_matrix(matrix)
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, _PRIME, size=n_hashes).astype(np.int64)
+    b = rng.randint(0, _PRIME, size=n_hashes).astype(np.int64)
+    cols = matrix.indices.astype(np.int64)
+    starts = matrix.indptr[:-1]
+    empty = np.diff(matrix.indptr) == 0
+    ## reduceat can't start at the end of the array
+    starts = np.minimum(starts, max(len(cols) - 1, 0))
+    sig = np.empty((matrix.shape[0], n_hashes), dtype=np.int64)
+    for i in range(n_hashes):
+        if len(cols):
+            sig[:, i] = np.minimum.reduceat((a[i] * cols + b[i]) % _PRIME,
+                                            starts)
+        sig[empty, i] = _PRIME
+    return sig
+
+
+def _band_keys(sig, users, bands):
+    """One uint64 key per row and band (collisions are checked afterwards)"""
+    rows = sig.shape[1] // bands
+    keys = np.empty((sig.shape[0], bands), dtype=np.uint64)
+    mult = np.uint64(0x100000001b3)
+    for band in range(bands):
+        key = users.astype(np.uint64)
+        for j in range(band * rows, (band + 1) * rows):
+            key = key * mult ^ sig[:, j].astype(np.uint64)
+        keys[:, band] = key
+    return keys
+
+
+def detect_places(df, cname='hashed MAC', ts_col='timestamp', user_col=None,
+                  freq=None, min_rssi=None, threshold=.5, min_scans=10,
+                  n_hashes=64, bands=16, seed=0):
+    """Labels every WiFi scan with a recurring place
+
+    Parameters
+    ----------
+    df : a WiFi dataframe (see scan_matrix())
+    cname / ts_col / user_col / freq / min_rssi : see scan_matrix()
+    threshold : estimated Jaccard similarity for two scans to be the same
+        place
+    min_scans : places with fewer scans are not places (label -1)
+    n_hashes : MinHash signature length (see minhash_signatures())
+    bands : LSH bands; n_hashes / bands hashes per band. Scans that are
+        (1 / bands) ** (bands / n_hashes) similar have about even odds of
+        being compared (0.5 by default), more similar ones almost surely are.
+    seed : seed of the hash functions
+
+    Notes
+    -----
+    Returns the scans of scan_matrix() with a `place` column. Places are
+    numbered per user by number of scans: place 0 is where the phone spent
+    the most scans (usually home), -1 is a scan that's not at a recurring
+    place. Within a band, every scan is compared with the first scan of its
+    bucket only, so the work is linear in the number of scans; places are
+    the connected groups of similar scans. Scans without MACs are -1.
+
+    """
+    matrix, scans, macs = scan_matrix(df, cname, ts_col, user_col, freq,
+                                      min_rssi)
+    n = len(scans)
+    if user_col is not None:
+        users = pd.factorize(scans[user_col].values)[0]
+    else:
+        users = np.zeros(n, dtype=np.int64)
+    sig = minhash_signatures(matrix, n_hashes, seed)
+    nonempty = scans['n_macs'].values > 0
+
+    heads, tails = [], []
+    for keys in _band_keys(sig, users, bands).T:
+        _, first, inverse = np.unique(keys, return_index=True,
+                                      return_inverse=True)
+        rep = first[inverse.ravel()]
+        pair = (rep != np.arange(n)) & nonempty
+        agree = (sig[pair] == sig[rep[pair]]).mean(axis=1)
+        similar = np.flatnonzero(pair)[agree >= threshold]
+        heads.append(similar)
+        tails.append(rep[similar])
+    heads = np.concatenate(heads) if heads else np.zeros(0, dtype=np.int64)
+    tails = np.concatenate(tails) if tails else np.zeros(0, dtype=np.int64)
+    graph = sparse.coo_matrix((np.ones(len(heads), dtype=np.int8),
+                               (heads, tails)), shape=(n, n))
+    _, group = csgraph.connected_components(graph, directed=False)
+
+    ## Number groups by size within each user, drop the small ones
+    sizes = np.bincount(group, minlength=n)
+    groups = pd.DataFrame({'user': users, 'group': group,
+                           'size': sizes[group]})[nonempty]
+    groups = groups.drop_duplicates('group')
+    groups = groups[groups['size'].values >= min_scans]
+    groups = groups.sort_values(['user', 'size', 'group'],
+                                ascending=[True, False, True])
+    ranks = groups.groupby('user').cumcount().values
+    place = np.full(n, -1, dtype=np.int64)
+    lookup = np.full(n, -1, dtype=np.int64)
+    lookup[groups['group'].values] = ranks
+    place[nonempty] = lookup[group[nonempty]]
+    scans['place'] = place
+    return scans
+
+
+def place_summary(scans, ts_col='timestamp', user_col=None):
+    """Scans, days seen, first and last time of every place
+
+    Parameters
+    ----------
+    scans : output of detect_places()
+    ts_col : time column
+    user_col : user column, if scans holds several users
+
+    """
+    keys = ([user_col] if user_col is not None else []) + ['place']
+    sub = scans[scans['place'].values >= 0]
+    sub = sub.assign(day=sub[ts_col].values // freq_ms('D'))
+    grouped = sub.groupby(keys)
+    summary = pd.DataFrame({'scans': grouped.size(),
+                            'days': grouped['day'].nunique(),
+                            'first': grouped[ts_col].min(),
+                            'last': grouped[ts_col].max(),
+                            'median_macs': grouped['n_macs'].median()})
+    return summary[['scans', 'days', 'first', 'last', 'median_macs']]
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+    `beiwedata` scripts for the power state data stream.
+
+    Turns the `time`, `event` rows of the power state stream into intervals
+    (screen on sessions, charging, Doze, power save) and summarizes them by
+    hour or day. Everything is done with numpy on whole columns, so a whole
+    study can go through in one pass (see the `user_col` parameters).
+"""
+
+import numpy as np
+from beiwedata._lazy import lazy_import
+
+__all__ = ['POWER_EVENTS', 'POWER_STATES', 'freq_ms', 'classify_events',
+           'split_intervals', 'power_intervals', 'power_summary']
+
+pd = lazy_import('pandas')
+
+## (lowercase text found in the event, state, on/off). Checked in order, so
+## the "not in ..." versions need to come first.
+POWER_EVENTS = [('screen turned on', 'screen', True),
+                ('screen turned off', 'screen', False),
+                ('screen on', 'screen', True),
+                ('screen off', 'screen', False),
+                ('power connected', 'charging', True),
+                ('power disconnected', 'charging', False),
+                ('not in idle state', 'doze', False),
+                ('in idle state', 'doze', True),
+                ('not in power save state', 'power_save', False),
+                ('in power save state', 'power_save', True),
+                ('unlocked', 'locked', False),
+                ('locked', 'locked', True)]
+
+POWER_STATES = ['screen', 'charging', 'doze', 'power_save']
+
+
+def freq_ms(freq):
+    """Length of a fixed pandas frequency ('h', '15Min', 'D', ...) in
+    milliseconds, the unit of Java times"""
+    from pandas.tseries.frequencies import to_offset
+    return int(to_offset(freq).nanos // 10 ** 6)
+
+
+def _order(ucodes, times):
+    """Stable sort order by user, then time (skips the sort if it's sorted)"""
+    if len(times) == 0:
+        return np.arange(0)
+    tmin = times.min()
+    span = int(times.max() - tmin) + 1
+    if int(ucodes.max()) * span < 2 ** 62:
+        key = ucodes.astype(np.int64) * span + (times - tmin)
+        if np.all(key[1:] >= key[:-1]):
+            return np.arange(len(times))
+        return np.argsort(key, kind='mergesort')
+    return np.lexsort((times, ucodes))
+
+
+def classify_events(events):
+    """Maps power state event strings to (state, on) arrays
+
+    Parameters
+    ----------
+    events : array or pandas.Series of event strings
+
+    Notes
+    -----
+    Returns (state, on) where state is an object array of state names (None
+    for events we don't know, e.g. 'Reboot signal received') and on is a
+    boolean array. Only the *unique* strings are matched against
+    POWER_EVENTS, so this is fast no matter how many rows there are.
+
+    """
+    codes, uniques = pd.factorize(np.asarray(events, dtype=object))
+    u_state = np.empty(len(uniques) + 1, dtype=object)
+    u_on = np.zeros(len(uniques) + 1, dtype=bool)
+    for i, event in enumerate(uniques):
+        text = str(event).lower()
+        for pattern, state, on in POWER_EVENTS:
+            if pattern in text:
+                u_state[i], u_on[i] = state, on
+                break
+    ## factorize() uses -1 for missing values, which lands on the None slot
+    return u_state[codes], u_on[codes]
+
+
+def split_intervals(start, end, freq='h'):
+    """Splits [start, end) intervals at bin boundaries (vectorized)
+
+    Parameters
+    ----------
+    start : array of interval starts (Java time)
+    end : array of interval ends (Java time)
+    freq : bin size as a pandas frequency string ('h', 'D', '5Min', ...)
+
+    Notes
+    -----
+    Returns (index, bins, seg_start, seg_end) arrays: the piece of interval
+    `index` that falls into bin number `bins` (bin start is bins * freq in
+    Java time) runs from seg_start to seg_end. Bins are aligned to UTC
+    midnight. Zero-length intervals are dropped.
+
+    """
+    width = freq_ms(freq)
+    start = np.asarray(start, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64)
+    keep = np.flatnonzero(end > start)
+    first = start[keep] // width
+    last = (end[keep] - 1) // width
+    counts = last - first + 1
+
+    index = np.repeat(keep, counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                 counts)
+    bins = np.repeat(first, counts) + offset
+    seg_start = np.maximum(start[index], bins * width)
+    seg_end = np.minimum(end[index], (bins + 1) * width)
+    return index, bins, seg_start, seg_end
+
+
+def power_intervals(df, states=None, ts_col='time', event_col='event',
+                    user_col=None, max_duration=None, include_off=False):
+    """Turns power state events into a table of intervals
+
+    Parameters
+    ----------
+    df : a power state dataframe (see import_df()) -- can hold many users
+    states : list of states to return (default is POWER_STATES)
+    ts_col : name of the timestamp column
+    event_col : name of the event column
+    user_col : name of the column identifying users, if df holds more than
+        one user (intervals never cross from one user to the next)
+    max_duration : longest believable interval in seconds. Longer intervals
+        are cut short and marked incomplete (e.g., a missed 'screen off').
+    include_off : if True, also returns the "off" intervals (e.g., screen off
+        periods, used for idle time in power_summary())
+
+    Notes
+    -----
+    Returns a DataFrame with columns [user_col], state, on, start, end (Java
+    time), seconds and complete.
+
+    Missing transitions are common (the phone dies, the app is killed,
+    events are delivered twice). Repeated events are collapsed so an
+    interval starts at the *first* 'on' and ends at the next 'off'. An
+    interval still open at the end of a user's data ends at their last event
+    of any kind; an 'off' with no 'on' before it starts at their first event.
+    Either way it is marked complete=False.
+
+    """
+    if states is None:
+        states = POWER_STATES
+    columns = ([user_col] if user_col else []) + ['state', 'on', 'start',
+                                                   'end', 'seconds',
+                                                   'complete']
+
+    ## Sort once (by user, then time) and work on plain arrays from here on
+    times = df[ts_col].values.astype(np.int64)
+    if user_col:
+        ucodes, unames = pd.factorize(df[user_col])
+    else:
+        ucodes, unames = np.zeros(len(times), dtype=np.int64), np.array([None])
+    order = _order(ucodes, times)
+    times = times[order]
+    ucodes = ucodes[order]
+    state, on = classify_events(df[event_col].values[order])
+
+    ## First/last event time of every user, for intervals left open
+    if len(times):
+        starts = np.flatnonzero(np.r_[True, ucodes[1:] != ucodes[:-1]])
+        ends = np.r_[starts[1:], len(times)] - 1
+        ufirst = np.zeros(len(unames), dtype=np.int64)
+        ulast = np.zeros(len(unames), dtype=np.int64)
+        ufirst[ucodes[starts]] = times[starts]
+        ulast[ucodes[ends]] = times[ends]
+
+    pieces = []
+    for name in states:
+        rows = np.flatnonzero(state == name)
+        if len(rows) == 0:
+            continue
+        t, v, u = times[rows], on[rows], ucodes[rows]
+
+        ## Keep only changes of state (within a user)
+        new_user = np.r_[True, u[1:] != u[:-1]]
+        keep = new_user | np.r_[True, v[1:] != v[:-1]]
+        t, v, u, new_user = t[keep], v[keep], u[keep], new_user[keep]
+        last_of_user = np.r_[new_user[1:], True]
+
+        ## Each kept event starts an interval that ends at the next one
+        end = np.r_[t[1:], 0]
+        end[last_of_user] = ulast[u[last_of_user]]
+        complete = ~last_of_user
+        start = t
+
+        ## Leading 'off' events: the 'on' happened before the data starts
+        lead = np.flatnonzero(new_user & ~v)
+        lead = lead[ufirst[u[lead]] < t[lead]]
+        start = np.r_[start, ufirst[u[lead]]]
+        end = np.r_[end, t[lead]]
+        value = np.r_[v, np.ones(len(lead), dtype=bool)]
+        user = np.r_[u, u[lead]]
+        complete = np.r_[complete, np.zeros(len(lead), dtype=bool)]
+
+        if max_duration is not None:
+            too_long = (end - start) > max_duration * 1000
+            end = np.where(too_long, start + int(max_duration * 1000), end)
+            complete &= ~too_long
+
+        if not include_off:
+            keep = value
+            start, end, value, user, complete = (start[keep], end[keep],
+                                                 value[keep], user[keep],
+                                                 complete[keep])
+
+        ## Drop intervals that are empty *because* they were left open
+        keep = (end > start) | complete
+        pieces.append((name, start[keep], end[keep], value[keep], user[keep],
+                       complete[keep]))
+
+    if not pieces:
+        return pd.DataFrame(columns=columns)
+    state = np.concatenate([np.repeat(p[0], len(p[1])) for p in pieces])
+    start, end, value, user, complete = [
+        np.concatenate([p[i] for p in pieces]) for i in range(1, 6)]
+    order = _order(user, start)
+
+    out = pd.DataFrame({'state': state[order], 'on': value[order],
+                        'start': start[order], 'end': end[order],
+                        'seconds': (end[order] - start[order]) / 1000.,
+                        'complete': complete[order]})
+    if user_col:
+        out[user_col] = unames[user[order]]
+    return out[columns]
+
+
+def power_summary(df, freq='D', ts_col='time', event_col='event',
+                  user_col=None, max_duration=None):
+    """Per-hour or per-day screen time, unlocks, charging and Doze time
+
+    Parameters
+    ----------
+    df : a power state dataframe (see import_df()) -- can hold many users
+    freq : 'D' for daily, 'h' for hourly (any pandas frequency works)
+    ts_col : name of the timestamp column
+    event_col : name of the event column
+    user_col : name of the column identifying users (see power_intervals())
+    max_duration : see power_intervals()
+
+    Notes
+    -----
+    Returns a DataFrame indexed by ([user_col,] period) where period is the
+    UTC start of the bin, with columns:
+        - screen_seconds : time the screen was on
+        - unlocks : number of screen on sessions that started in the bin
+            (Android doesn't log unlocks, so this counts 'screen on')
+        - longest_idle_seconds : longest screen off stretch within the bin
+        - charging_seconds / doze_seconds / power_save_seconds
+        - events : number of power state events
+
+    Intervals spanning bins are split between them.
+
+    """
+    intervals = power_intervals(df, ts_col=ts_col, event_col=event_col,
+                                user_col=user_col, max_duration=max_duration,
+                                include_off=True)
+    keys = [user_col] if user_col else []
+    width = freq_ms(freq)
+    cols = ['screen_seconds', 'unlocks', 'longest_idle_seconds',
+            'charging_seconds', 'doze_seconds', 'power_save_seconds',
+            'events']
+    if len(df) == 0:
+        return pd.DataFrame(columns=keys + ['period'] + cols).set_index(
+            keys + ['period'])
+
+    index, bins, seg_start, seg_end = split_intervals(
+        intervals['start'].values, intervals['end'].values, freq)
+    segs = pd.DataFrame({'bin': bins,
+                         'seconds': (seg_end - seg_start) / 1000.,
+                         'state': intervals['state'].values[index],
+                         'on': intervals['on'].values[index]})
+    for key in keys:
+        segs[key] = intervals[key].values[index]
+
+    group = keys + ['bin']
+    on = segs[segs['on']]
+    out = on.pivot_table(index=group, columns='state', values='seconds',
+                         aggfunc='sum')
+    out = out.reindex(columns=POWER_STATES).fillna(0)
+    out.columns = [c + '_seconds' for c in out.columns]
+
+    idle = segs[(~segs['on']) & (segs['state'] == 'screen')]
+    out = out.join(idle.groupby(group)['seconds'].max()
+                   .rename('longest_idle_seconds'), how='outer')
+
+    sessions = intervals[(intervals['state'] == 'screen') & intervals['on']]
+    unlocks = sessions.assign(bin=sessions['start'].values // width)
+    out = out.join(unlocks.groupby(group).size().rename('unlocks'),
+                   how='outer')
+
+    events = pd.DataFrame({'bin': df[ts_col].values.astype(np.int64) //
+                           width})
+    for key in keys:
+        events[key] = df[key].values
+    out = out.join(events.groupby(group).size().rename('events'),
+                   how='outer')
+
+    out = out.fillna(0)
+    for col in ['unlocks', 'events']:
+        out[col] = out[col].astype(int)
+    out = out.reset_index()
+    out['period'] = pd.to_datetime(out['bin'] * width, unit='ms')
+    out = out.set_index(keys + ['period']).drop('bin', axis=1)
+    return out[cols].sort_index()
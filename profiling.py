@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+    Opt-in instrumentation for the slow parts of `beiwedata`.
+
+    When profiling is enabled, list_data_files(), import_df(), make_request(),
+    convert_mp4() (and anything else wrapped in profiled()) record the wall
+    time, bytes read and rows parsed of each call and each phase of the
+    call, along with memory: the process' peak resident memory when the
+    block ended and how much the block raised it. Stats come back as a
+    pandas.DataFrame or can be pushed to your own monitoring with a hook.
+    When profiling is off (the default), the overhead is one function call
+    per instrumented block.
+
+    Usage
+    -----
+    ```
+    from beiwedata.profiling import enable_profiling, profile_stats
+    enable_profiling()
+    df = import_df(list_data_files('./user1', stream='accel'))
+    profile_stats()      # one row per call / phase
+    ```
+"""
+
+import time
+from beiwedata._lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+## Module state. Not thread-safe by design -- profile one job at a time.
+_ENABLED = False
+_RECORDS = []
+_HOOKS = []
+_STACK = []
+
+## Columns of profile_stats(), in order
+STAT_COLUMNS = ['name', 'parent', 'start', 'seconds', 'bytes', 'rows',
+                'files', 'process_peak_rss_mb', 'peak_rss_growth_mb']
+
+
+def process_peak_rss_mb():
+    """High-water mark of the process' resident memory so far, in MB
+
+    Notes
+    -----
+    This never goes down, so it's the peak of everything the process did up
+    to now, not of one call. See peak_rss_growth_mb in profile_stats() for
+    what one block added.
+
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## Linux reports KB, macOS reports bytes
+    if peak > 2 ** 32:
+        return peak / 2. ** 20
+    return peak / 2. ** 10
+
+
+class _Noop(object):
+    """What profiled() returns when profiling is off. Falsy, so callers can
+    skip computing expensive stats (e.g., `if p: p.add(bytes=...)`)."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        return False
+
+    def add(self, **stats):
+        pass
+
+    def __nonzero__(self):
+        return False
+    __bool__ = __nonzero__
+
+
+_NOOP = _Noop()
+
+
+class _Profiled(object):
+    """One timed block. Use profiled() instead of making these directly."""
+    def __init__(self, name, stats):
+        self.name = name
+        self.stats = dict(bytes=None, rows=None, files=None)
+        self.stats.update(stats)
+
+    def add(self, **stats):
+        """Adds to the bytes / rows / files counted for this block"""
+        for key, value in stats.items():
+            if self.stats.get(key) is None:
+                self.stats[key] = value
+            else:
+                self.stats[key] += value
+
+    def __enter__(self):
+        self.parent = _STACK[-1].name if _STACK else None
+        _STACK.append(self)
+        self.start = time.time()
+        self.peak_before = process_peak_rss_mb()
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        seconds = time.time() - self.start
+        _STACK.pop()
+        peak = process_peak_rss_mb()
+        row = {'name': self.name, 'parent': self.parent, 'start': self.start,
+               'seconds': seconds, 'process_peak_rss_mb': peak,
+               'peak_rss_growth_mb': None if peak is None else
+               peak - self.peak_before}
+        row.update(self.stats)
+        _RECORDS.append(row)
+        for hook in list(_HOOKS):
+            hook(row)
+        return False
+
+    def __nonzero__(self):
+        return True
+    __bool__ = __nonzero__
+
+
+def profiled(name, **stats):
+    """Context manager that records a block when profiling is enabled
+
+    Parameters
+    ----------
+    name : name of the call or phase, e.g. 'import_df.read'
+    stats : starting values for 'bytes', 'rows' or 'files'
+
+    Usage
+    -----
+    ```
+    with profiled('my_plot') as p:
+        fig = plot_accel(df, start, end)
+        if p:
+            p.add(rows=len(df))
+    ```
+
+    Notes
+    -----
+    Blocks nest: the record of an inner block has the outer block's name in
+    its 'parent' column.
+
+    """
+    if not _ENABLED:
+        return _NOOP
+    return _Profiled(name, stats)
+
+
+def enable_profiling(clear=True):
+    """Turns instrumentation on (optionally clearing old stats)"""
+    global _ENABLED
+    _ENABLED = True
+    if clear:
+        clear_stats()
+
+
+def disable_profiling():
+    """Turns instrumentation off. Recorded stats are kept."""
+    global _ENABLED
+    _ENABLED = False
+
+
+def profiling_enabled():
+    return _ENABLED
+
+
+def clear_stats():
+    del _RECORDS[:]
+
+
+def add_hook(func):
+    """Calls func(record) every time a block finishes
+
+    Notes
+    -----
+    `record` is a dict with the keys in STAT_COLUMNS. Use this to send stats
+    to your own monitoring (statsd, logs, etc.). Exceptions raised by the
+    hook are *not* caught.
+
+    """
+    if func not in _HOOKS:
+        _HOOKS.append(func)
+
+
+def remove_hook(func):
+    if func in _HOOKS:
+        _HOOKS.remove(func)
+
+
+def profile_stats(summary=False):
+    """Returns recorded stats as a pandas.DataFrame
+
+    Parameters
+    ----------
+    summary : if True, returns totals per name (calls, seconds, bytes, rows,
+        files), the largest process_peak_rss_mb and the largest
+        peak_rss_growth_mb instead of one row per block
+
+    """
+    df = pd.DataFrame(_RECORDS, columns=STAT_COLUMNS)
+    if summary is False:
+        return df
+    grouped = df.groupby('name', sort=False)
+    out = grouped[['seconds', 'bytes', 'rows', 'files']].sum()
+    out.insert(0, 'calls', grouped.size())
+    out['process_peak_rss_mb'] = grouped['process_peak_rss_mb'].max()
+    out['peak_rss_growth_mb'] = grouped['peak_rss_growth_mb'].max()
+    return out.sort_values('seconds', ascending=False)
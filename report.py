@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+    Batch, headless QC reports: every plot for every user, as PNGs.
+
+    render_reports() gives each user to a worker process. The worker loads
+    each data stream once (only the time window asked for), draws every plot
+    that needs it on its own Agg Figure (pyplot is never used, see
+    new_figure()), and writes the PNGs. Users share nothing, so this scales
+    with the number of cores. An index.csv and index.html list every figure.
+
+    Usage
+    -----
+    ```
+    index = render_reports('./study', './qc', start_ts=make_timestamp(2015,
+                           5, 4), end_ts=make_timestamp(2015, 5, 11))
+    ```
+"""
+
+import os
+import sys
+import time
+from beiwedata._lazy import lazy_import
+from beiwedata.basic import (list_data_files, list_audio_files, import_df,
+                             file_timestamp, plot_accel, rank_mac,
+                             plot_most_macs, plot_n_macs, plot_calls_texts,
+                             TIMESTAMP_COLUMNS)
+from beiwedata.audio import plot_wav
+from beiwedata.cohort import list_users, map_users
+from beiwedata.gps import plot_gps_density
+
+pd = lazy_import('pandas')
+
+try:
+    from html import escape
+except ImportError:  # Python 2
+    from cgi import escape
+
+REPORT_PLOTS = ['accel', 'gps', 'most_macs', 'n_macs', 'calls_texts', 'wav']
+
+## Data streams each plot needs -- loaded once per user and shared
+_NEEDS = {'accel': ['accel'], 'gps': ['gps'], 'most_macs': ['blue'],
+          'n_macs': ['blue'], 'calls_texts': ['call', 'text'], 'wav': []}
+
+INDEX_COLUMNS = ['user', 'plot', 'file', 'status', 'rows', 'seconds']
+
+
+def _window(frames, start_ts, end_ts):
+    """Fills in a missing start/end with the first/last row of the data"""
+    times = [f['timestamp'] for f in frames if len(f)]
+    if start_ts is None:
+        start_ts = int(min(t.min() for t in times))
+    if end_ts is None:
+        end_ts = int(max(t.max() for t in times))
+    return start_ts, end_ts
+
+
+def _draw(plot, frames, start_ts, end_ts):
+    """Draws one plot on a headless figure, returns the figure"""
+    start_ts, end_ts = _window(frames, start_ts, end_ts)
+    if plot == 'accel':
+        fig, axes = plot_accel(frames[0], start_ts, end_ts, headless=True)
+    elif plot == 'gps':
+        fig, ax = plot_gps_density(frames[0], start_ts, end_ts,
+                                   ts_col='timestamp', headless=True)
+    elif plot == 'most_macs':
+        ranked = rank_mac(frames[0], start_ts, end_ts)
+        fig, ax = plot_most_macs(ranked, headless=True)
+    elif plot == 'n_macs':
+        fig, axes = plot_n_macs(frames[0], start_ts, end_ts, headless=True)
+    elif plot == 'calls_texts':
+        fig, ax = plot_calls_texts(frames[0], frames[1], start_ts, end_ts,
+                                   dedupe=True, headless=True)
+    return fig
+
+
+def _render_user(args):
+    """Renders every plot of one user. Runs in a worker process."""
+    upath, outdir, plots, start_ts, end_ts, dpi, max_wavs = args
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+
+    user = os.path.basename(os.path.normpath(upath))
+    udir = os.path.join(outdir, user)
+    if not os.path.isdir(udir):
+        os.makedirs(udir)
+
+    ## Each stream is read once, then shared by every plot that needs it
+    frames = {}
+
+    def load(stream):
+        if stream not in frames:
+            flist = list_data_files(upath, stream)
+            frames[stream] = None
+            if flist:
+                df = import_df(flist, tstamp=TIMESTAMP_COLUMNS[stream],
+                               start_ts=start_ts, end_ts=end_ts)
+                ## One name for the time column, whatever the stream calls it
+                df['timestamp'] = df[TIMESTAMP_COLUMNS[stream]]
+                frames[stream] = df if len(df) else None
+        return frames[stream]
+
+    jobs = []
+    for plot in plots:
+        if plot != 'wav':
+            jobs.append((plot, plot + '.png', None))
+            continue
+        wavs = [f for f in sorted(list_audio_files(upath, mp4only=False))
+                if f.endswith('.wav') and
+                (start_ts is None or file_timestamp(f) >= start_ts) and
+                (end_ts is None or file_timestamp(f) <= end_ts)]
+        for fname in wavs[:max_wavs]:
+            stem = os.path.basename(fname).rsplit('.', 1)[0]
+            jobs.append(('wav', 'wav_' + stem.replace(' ', '_') + '.png',
+                         fname))
+
+    records = []
+    for plot, name, wav in jobs:
+        started = time.time()
+        record = {'user': user, 'plot': plot, 'file': None, 'rows': 0}
+        try:
+            if wav is not None:
+                fig = plot_wav(wav, headless=True)
+            else:
+                data = [load(stream) for stream in _NEEDS[plot]]
+                if any(d is None for d in data):
+                    record['status'] = 'no data'
+                    fig = None
+                else:
+                    record['rows'] = sum(len(d) for d in data)
+                    fig = _draw(plot, data, start_ts, end_ts)
+            if fig is not None:
+                fig.savefig(os.path.join(udir, name), dpi=dpi,
+                            bbox_inches='tight')
+                record['file'] = os.path.join(user, name)
+                record['status'] = 'ok'
+        except Exception as e:
+            record['status'] = 'error: %s: %s' % (type(e).__name__, e)
+        record['seconds'] = time.time() - started
+        records.append(record)
+    return records
+
+
+def _write_html(index, fname):
+    """One row per user, one column per plot (thumbnails link to the PNG)"""
+    lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8">',
+             '<title>beiwedata report</title>',
+             '<style>td {vertical-align: top; padding: 4px} '
+             'img {width: 240px}</style>', '</head><body>', '<table>',
+             '<tr><th>user</th>' +
+             ''.join('<th>%s</th>' % escape(p) for p in index['plot'].unique())
+             + '</tr>']
+    plots = list(index['plot'].unique())
+    for user, rows in index.groupby('user', sort=True):
+        cells = dict((p, []) for p in plots)
+        for _, row in rows.iterrows():
+            if row['status'] == 'ok':
+                path = escape(row['file'])
+                cells[row['plot']].append(
+                    '<a href="%s"><img src="%s"></a>' % (path, path))
+            else:
+                cells[row['plot']].append(escape(row['status']))
+        lines.append('<tr><td>%s</td>' % escape(user) +
+                     ''.join('<td>%s</td>' % '<br>'.join(cells[p])
+                             for p in plots) + '</tr>')
+    lines += ['</table>', '</body></html>']
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def render_reports(root, outdir, plots=None, users=None, start_ts=None,
+                   end_ts=None, workers=None, dpi=100, max_wavs=3,
+                   verbose=False):
+    """Renders QC plots for every user of a study as PNGs, plus an index
+
+    Parameters
+    ----------
+    root : study folder (one directory per user)
+    outdir : where to write (one folder per user, index.csv and index.html)
+    plots : list of plots (default is REPORT_PLOTS: 'accel', 'gps',
+        'most_macs', 'n_macs', 'calls_texts', 'wav')
+    users : list of user directories (default is every folder in root)
+    start_ts : start of the window (Java time, default is the user's first
+        observation)
+    end_ts : end of the window (Java time, default is the last observation)
+    workers : number of processes (default is one per CPU)
+    dpi : resolution of the PNGs
+    max_wavs : most voice recordings (.wav, see convert_mp4()) plotted per
+        user
+    verbose : if True, prints progress
+
+    Notes
+    -----
+    Returns the index as a DataFrame with columns user, plot, file
+    (relative to outdir), status ('ok', 'no data' or the error), rows and
+    seconds. A plot that fails is recorded in the index; it doesn't stop
+    the rest of the report.
+
+    The GPS plot is plot_gps_density() (plot_gps() needs basemap and is far
+    slower). Calls and texts are plotted with duplicates suppressed.
+
+    """
+    if plots is None:
+        plots = REPORT_PLOTS
+    unknown = [p for p in plots if p not in REPORT_PLOTS]
+    if unknown:
+        raise ValueError("Unknown plot(s): %s. Use any of: %s"
+                         % (', '.join(unknown), ', '.join(REPORT_PLOTS)))
+    if users is None:
+        users = list_users(root)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    jobs = [(upath, outdir, list(plots), start_ts, end_ts, dpi, max_wavs)
+            for upath in users]
+
+    records = []
+    for result in map_users(_render_user, jobs, workers, verbose):
+        records.extend(result)
+
+    index = pd.DataFrame(records, columns=INDEX_COLUMNS)
+    index = index.sort_values(['user', 'plot', 'file']).reset_index(drop=True)
+    index.to_csv(os.path.join(outdir, 'index.csv'), index=False)
+    _write_html(index, os.path.join(outdir, 'index.html'))
+    return index
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+    Content-addressed storage of downloaded files.
+
+    Overlapping download windows, re-registered users and pulls into
+    several folders leave many byte-identical CSVs and recordings on disk.
+    With a store, every file is hashed (SHA-1) as it is extracted and kept
+    once, as `<store>/<first 2 hex>/<rest of hex>`. The paths under the
+    download folder are hard links to it, so a duplicate costs a directory
+    entry instead of its size. Store objects are read-only; replacing a
+    file re-links its path and never touches other copies.
+
+    Hard-linked files share an inode, which is how loaders recognise
+    identical files without reading them: import_df() keeps the parsed
+    frame of hard-linked files (see cached_parse()) and reuses it for every
+    other path to the same bytes.
+
+    Usage
+    -----
+    ```
+    make_request(study_id, access_key, secret_key, folder='./data',
+                 store='./store')
+    dedupe_tree('./old_downloads', './store')  # files already on disk
+    ```
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+## Most rows of parsed frames kept by cached_parse() (least recently used
+## are dropped first)
+PARSED_CACHE_ROWS = 2000000
+
+_parsed = OrderedDict()
+_parsed_rows = [0]
+
+
+def hash_bytes(data):
+    """SHA-1 hex digest of a bytes object"""
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_file(fname, blocksize=1 << 20):
+    """SHA-1 hex digest of a file, read in blocks"""
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def object_path(store, digest):
+    """Where the store keeps the file with this digest"""
+    return os.path.join(store, digest[:2], digest[2:])
+
+
+def _write_object(store, digest, write):
+    """Adds an object if it's missing. write(f) writes its bytes to f."""
+    path = object_path(store, digest)
+    if os.path.exists(path):
+        return path
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:  # made by another process in the meantime
+            if not os.path.isdir(folder):
+                raise
+    ## Write next to it and rename, so a crash never leaves half an object
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(tmp, 0o444)
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return path
+
+
+def put_bytes(store, data):
+    """Adds data (bytes) to the store, returns its digest"""
+    digest = hash_bytes(data)
+    _write_object(store, digest, lambda f: f.write(data))
+    return digest
+
+
+def put_file(store, fname):
+    """Adds a file to the store, returns its digest"""
+    digest = hash_file(fname)
+
+    def write(f):
+        with open(fname, 'rb') as src:
+            shutil.copyfileobj(src, f)
+    _write_object(store, digest, write)
+    return digest
+
+
+def _replace(tmp, dest):
+    """Renames tmp to dest, replacing it (os.rename() won't on Windows)"""
+    try:
+        os.rename(tmp, dest)
+    except OSError:
+        if not os.path.lexists(dest) or os.path.isdir(dest):
+            raise
+        os.remove(dest)
+        os.rename(tmp, dest)
+
+
+def link(store, digest, dest):
+    """Makes dest a hard link to a store object (replacing dest)
+
+    Notes
+    -----
+    The link is made next to dest and renamed over it, so a file at dest is
+    unlinked, never written through: it may be a link to another object,
+    shared with other folders. Falls back to a copy where hard links aren't
+    possible (store on another file system, or no os.link()).
+
+    """
+    source = object_path(store, digest)
+    folder = os.path.dirname(dest)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    if os.path.exists(dest) and os.path.samefile(source, dest):
+        return dest
+    fd, tmp = tempfile.mkstemp(dir=folder or '.', prefix='.tmp')
+    os.close(fd)
+    try:
+        os.remove(tmp)
+        try:
+            os.link(source, tmp)
+        except (OSError, AttributeError):
+            shutil.copyfile(source, tmp)
+        _replace(tmp, dest)
+    except Exception:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    return dest
+
+
+def extract_member(z, info, path='.'):
+    """Extracts one member of a zipfile.ZipFile as a plain file
+
+    Notes
+    -----
+    Like ZipFile.extract(), but a file already at the destination is
+    removed first instead of being written over: it may be a hard link to
+    a store object (see link()), whose other links would change with it.
+    Returns the path of the extracted file.
+
+    """
+    parts = [p for p in info.filename.replace('\\', '/').split('/')
+             if p not in ('', '.', '..')]
+    dest = os.path.join(path, *parts) if parts else path
+    if os.path.lexists(dest) and not os.path.isdir(dest):
+        os.remove(dest)
+    return z.extract(info, path)
+
+
+def extract_zip(z, store, path='.', skip=('registry',), members=None):
+    """Extracts a zipfile.ZipFile through the store
+
+    Parameters
+    ----------
+    z : an open zipfile.ZipFile
+    store : store folder
+    path : folder to extract to
+    skip : members that are extracted as plain files (not stored)
+    members : names of the members to extract (default is all)
+
+    Notes
+    -----
+    Members are read, hashed and stored one at a time. Returns
+    {member name: digest} of the stored members.
+
+    """
+    digests = {}
+    wanted = None if members is None else set(members)
+    for info in z.infolist():
+        name = info.filename
+        if name.endswith('/') or (wanted is not None and name not in wanted):
+            continue
+        if name in skip:
+            extract_member(z, info, path)
+            continue
+        digest = put_bytes(store, z.read(info))
+        link(store, digest, os.path.join(path, *name.split('/')))
+        digests[name] = digest
+    return digests
+
+
+def dedupe_tree(root, store, verbose=False):
+    """Moves the files under root into a store, leaving hard links
+
+    Parameters
+    ----------
+    root : folder of downloaded data (e.g., a study folder)
+    store : store folder
+    verbose : if True, prints the space saved
+
+    Notes
+    -----
+    Hidden files (indexes, caches) and registries are left alone. Returns
+    (files, duplicates, bytes saved).
+
+    """
+    files = duplicates = saved = 0
+    for path, subdirs, names in os.walk(root):
+        subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+        for name in names:
+            if name.startswith('.') or name in ('registry',
+                                                'master_registry'):
+                continue
+            fname = os.path.join(path, name)
+            digest = put_file(store, fname)
+            files += 1
+            obj = object_path(store, digest)
+            if os.path.samefile(obj, fname):  # already linked
+                continue
+            if os.stat(obj).st_nlink > 1:
+                duplicates += 1
+                saved += os.path.getsize(fname)
+            link(store, digest, fname)
+    if verbose:
+        print("%d files, %d duplicates, %.1f MB saved"
+              % (files, duplicates, saved / 1e6))
+    return files, duplicates, saved
+
+
+def cached_parse(fname, parse, options=()):
+    """parse(fname), reusing the result for other links to the same file
+
+    Parameters
+    ----------
+    fname : a file
+    parse : function of the file name, returns a DataFrame
+    options : hashable description of how parse() reads (columns, ...),
+        part of the cache key
+
+    Notes
+    -----
+    Files are recognised by (device, inode, size, mtime), which every link
+    to a file shares. Only files with more than one link (e.g., extracted
+    through a store, see extract_zip()) are cached, so ordinary files cost
+    nothing. The cache
+    keeps at most PARSED_CACHE_ROWS rows. Don't modify the returned frame.
+
+    """
+    try:
+        st = os.stat(fname)
+    except OSError:  # not a plain file (e.g., archived, see beiwedata.archive)
+        return parse(fname)
+    if st.st_nlink < 2:
+        return parse(fname)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime, options)
+    if key in _parsed:
+        frame = _parsed.pop(key)
+        _parsed[key] = frame
+        return frame
+    frame = parse(fname)
+    if len(frame) <= PARSED_CACHE_ROWS:
+        _parsed[key] = frame
+        _parsed_rows[0] += len(frame)
+        while _parsed_rows[0] > PARSED_CACHE_ROWS:
+            _, old = _parsed.popitem(last=False)
+            _parsed_rows[0] -= len(old)
+    return frame
+
+
+def clear_parsed_cache():
+    """Empties the cache of cached_parse()"""
+    _parsed.clear()
+    _parsed_rows[0] = 0
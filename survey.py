@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+    Survey answers and survey timings.
+
+    Survey files don't look like the other streams: there is one folder per
+    survey ID, every survey has its own questions, and survey answers have
+    no timestamp column at all. import_surveys() turns them into one long
+    table (a row per user, survey, submission and question) with the
+    question text stored once as a categorical, indexed by user and survey.
+    Files are parsed in parallel and the result is cached per user, so
+    re-running only parses new files.
+
+    Usage
+    -----
+    ```
+    answers = import_surveys('./study')           # every user
+    answers.loc['user1']                          # one user
+    answers.xs(survey_id, level='survey_id')      # one survey
+    survey_questions(answers)                     # question text, once
+    ```
+"""
+
+import multiprocessing
+import os
+import numpy as np
+from beiwedata._lazy import lazy_import
+from beiwedata.archive import data_stat, read_data_csv
+from beiwedata.basic import list_data_files, file_timestamp
+from beiwedata.cohort import list_users
+
+__all__ = ['SURVEY_COLUMNS', 'SURVEY_CATEGORIES', 'survey_id',
+           'import_surveys', 'survey_questions']
+
+pd = lazy_import('pandas')
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError:  # Python 3
+    _STRING_TYPES = (str,)
+
+## Columns of the long table (besides the user, survey_id index)
+SURVEY_COLUMNS = ['submitted', 'timestamp', 'question_id', 'question_type',
+                  'question_text', 'answer_options', 'answer']
+
+## Stored as categoricals (few distinct values, repeated on every row)
+SURVEY_CATEGORIES = ['question_id', 'question_type', 'question_text',
+                     'answer_options']
+
+## Stream key : (folder name, file prefix of older flat downloads)
+_FOLDERS = {'survey_a': ('survey_answers', 'surveyAnswers'),
+            'survey_t': ('survey_timings', 'surveyTimings')}
+
+## File header : column of the long table
+_RENAME = {'question id': 'question_id', 'question type': 'question_type',
+           'question text': 'question_text',
+           'question answer options': 'answer_options'}
+
+
+def _cache_file(upath, stream):
+    return os.path.join(upath, '.%s.pkl' % stream)
+
+
+def survey_id(fname, stream='survey_a'):
+    """Survey ID of a survey file (from its folder, or its name if flat)"""
+    folder, prefix = _FOLDERS[stream]
+    parent = os.path.basename(os.path.dirname(fname))
+    if parent != folder and os.path.basename(
+            os.path.dirname(os.path.dirname(fname))) == folder:
+        return parent
+    ## Flat downloads: surveyAnswers<survey id>_<time>.csv (ID may be blank)
+    name = os.path.basename(fname)
+    return name.split('_')[0][len(prefix):] or None
+
+
+def _is_user_dir(path, stream):
+    """True if path holds survey files itself (not one folder per user)"""
+    folder, prefix = _FOLDERS[stream]
+    return os.path.isdir(os.path.join(path, folder)) or any(
+        name.startswith(prefix) for name in os.listdir(path))
+
+
+def _parse(args):
+    """Parses one survey file into the long table. Runs in a worker."""
+    user, stream, fname = args
+    frame = read_data_csv(fname, dtype=str)
+    frame.columns = [_RENAME.get(c.strip(), c.strip()) for c in frame.columns]
+    submitted = file_timestamp(fname)
+    if 'timestamp' in frame.columns:
+        times = pd.to_numeric(frame['timestamp'], errors='coerce')
+    else:
+        times = np.repeat(submitted, len(frame)).astype(float)
+    out = pd.DataFrame({'user': user, 'survey_id': survey_id(fname, stream),
+                        'submitted': submitted, 'timestamp': times})
+    for col in SURVEY_COLUMNS[2:]:
+        out[col] = frame[col].values if col in frame.columns else None
+    return out[['user', 'survey_id'] + SURVEY_COLUMNS]
+
+
+def _manifest(upath, stream):
+    """{relative path: [size, mtime]} of a user's survey files"""
+    files = {}
+    for fname in list_data_files(upath, stream, nonempty=False):
+        files[os.path.relpath(fname, upath)] = list(data_stat(fname))
+    return files
+
+
+def _finish(frame):
+    """Categoricals, sorted (user, survey_id) index"""
+    for col in SURVEY_CATEGORIES:
+        frame[col] = frame[col].astype('category')
+    frame = frame.sort_values(['user', 'survey_id', 'submitted', 'timestamp'],
+                              kind='mergesort')
+    return frame.set_index(['user', 'survey_id'])
+
+
+def import_surveys(paths, stream='survey_a', workers=None, cache=True):
+    """Parses survey answers or timings into one long, indexed table
+
+    Parameters
+    ----------
+    paths : a study folder, a user directory or a list of user directories
+    stream : 'survey_a' (answers) or 'survey_t' (timings)
+    workers : number of processes (default is one per CPU; 1 parses in
+        this process)
+    cache : if True, reuses and updates each user's cache
+        (upath/.survey_a.pkl or upath/.survey_t.pkl)
+
+    Notes
+    -----
+    Returns a DataFrame indexed by (user, survey_id), sorted, with columns:
+        - submitted : Java time the file was created (one per submission)
+        - timestamp : Java time of the row (survey timings), or submitted
+          (survey answers have no timestamp)
+        - question_id, question_type, question_text, answer_options :
+          categoricals, so each distinct text is stored once
+        - answer : the answer as text. In survey timings, rows without a
+          question_id are events (e.g., 'User hit submit').
+
+    A folder counts as a user directory if it has a survey_answers or
+    survey_timings folder (or flat survey files) in it. The cache remembers
+    the size and modification time of every file; new files are parsed and
+    added, and a changed or removed file re-parses that user.
+
+    """
+    if stream not in _FOLDERS:
+        raise ValueError("stream must be 'survey_a' or 'survey_t'")
+    if isinstance(paths, _STRING_TYPES):
+        users = [paths] if _is_user_dir(paths, stream) else list_users(paths)
+    else:
+        users = list(paths)
+
+    ## Work out which files still need parsing
+    jobs = []
+    owners = []
+    cached = {}
+    manifests = {}
+    for upath in users:
+        user = os.path.basename(os.path.normpath(upath))
+        manifests[upath] = files = _manifest(upath, stream)
+        old = None
+        if cache and os.path.exists(_cache_file(upath, stream)):
+            old = pd.read_pickle(_cache_file(upath, stream))
+            if any(files.get(f) != v for f, v in old['files'].items()):
+                old = None
+        done = old['files'] if old is not None else {}
+        cached[upath] = old['frame'] if old is not None else None
+        new = [f for f in sorted(files) if f not in done]
+        jobs.extend((user, stream, os.path.join(upath, f)) for f in new)
+        owners.extend([upath] * len(new))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers == 1 or len(jobs) < 2:
+        parsed = [_parse(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            parsed = pool.map(_parse, jobs,
+                              chunksize=max(1, len(jobs) // (4 * workers)))
+        except BaseException:
+            ## Don't wait for the other files (an error, Ctrl-C)
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    ## Put each user back together (and update their cache)
+    by_user = {}
+    for upath, frame in zip(owners, parsed):
+        by_user.setdefault(upath, []).append(frame)
+    frames = []
+    for upath in users:
+        pieces = by_user.get(upath, [])
+        if cached[upath] is not None:
+            pieces = [cached[upath].reset_index().astype(
+                dict((c, object) for c in SURVEY_CATEGORIES))] + pieces
+        if not pieces:
+            continue
+        frame = _finish(pd.concat(pieces, ignore_index=True))
+        if cache and by_user.get(upath):
+            pd.to_pickle({'files': manifests[upath], 'frame': frame},
+                         _cache_file(upath, stream))
+        frames.append(frame.reset_index())
+
+    if not frames:
+        return _finish(pd.DataFrame(columns=['user', 'survey_id'] +
+                                    SURVEY_COLUMNS))
+    ## Categoricals with different categories concat as objects, so the
+    ## categories are rebuilt once for the whole table
+    for frame in frames:
+        for col in SURVEY_CATEGORIES:
+            frame[col] = frame[col].astype(object)
+    return _finish(pd.concat(frames, ignore_index=True))
+
+
+def survey_questions(df):
+    """One row per (survey_id, question_id) with its type, text and options
+
+    Parameters
+    ----------
+    df : a table from import_surveys()
+
+    """
+    cols = ['question_type', 'question_text', 'answer_options']
+    questions = df.reset_index()[['survey_id', 'question_id'] + cols]
+    questions = questions.dropna(subset=['question_id'])
+    for col in ['question_id'] + cols:
+        questions[col] = questions[col].astype(object)
+    return questions.drop_duplicates(['survey_id', 'question_id']).set_index(
+        ['survey_id', 'question_id']).sort_index()
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+    Synthetic Beiwe data for testing and benchmarking.
+
+    Writes user directories that look like real downloads: all 12 data
+    streams, the same file naming and headers, empty (header only) files,
+    duplicated texts, duplicated accelerometer timestamps and the odd header
+    with whitespace in it. See the README for what the real data looks like.
+"""
+
+import base64
+import calendar
+import datetime
+import hashlib
+import os
+import struct
+import wave
+import numpy as np
+from beiwedata.download import (mkdir_p, ACCEL, BT, CALL_LOG, GPS, IDS, LOGS,
+                                POWER, SURVEY_ANSWERS, SURVEY_TIMINGS, TEXTS,
+                                VOICE, WIFI)
+
+## Stream key (as in list_data_files()) : (downloaded folder, file prefix)
+## The file prefix is what older, "flat" user directories use.
+STREAM_NAMES = {'accel': (ACCEL, 'accel'),
+                'blue': (BT, 'bluetoothLog'),
+                'call': (CALL_LOG, 'callLog'),
+                'gps': (GPS, 'gps'),
+                'id': (IDS, 'identifiers'),
+                'app': (LOGS, 'logFile'),
+                'power': (POWER, 'powerState'),
+                'survey_a': (SURVEY_ANSWERS, 'surveyAnswers'),
+                'survey_t': (SURVEY_TIMINGS, 'surveyTimings'),
+                'text': (TEXTS, 'textsLog'),
+                'voice': (VOICE, 'voiceRecording'),
+                'wifi': (WIFI, 'wifiLog')}
+
+## Column headers. Calls use `timestamp` (not `date`) like current downloads
+## and like plot_calls_texts() expects.
+HEADERS = {'accel': ['timestamp', 'accuracy', 'x', 'y', 'z'],
+           'blue': ['timestamp', 'MAC', 'RSSI'],
+           'call': ['timestamp', 'hashed phone number', 'call type',
+                    'duration in seconds'],
+           'gps': ['time', 'latitude', 'longitude', 'altitude', 'accuracy'],
+           'id': ['patient id', 'MAC', 'phone_number', 'device_id'],
+           'app': ['THIS LINE IS A LOG FILE HEADER'],
+           'power': ['time', 'event'],
+           'survey_a': ['question id', 'question type', 'question text',
+                        'question answer options', 'answer'],
+           'survey_t': ['timestamp', 'question id', 'question type',
+                        'question text', 'question answer options', 'answer'],
+           'text': ['timestamp', 'hashed phone number', 'sent vs received',
+                    'message length', 'time sent'],
+           'wifi': ['hashed MAC', 'frequency', 'RSSI']}
+
+## Rows per hour at scale=1 (per scan for bluetooth and wifi)
+RATES = {'accel': 3600, 'blue': 8, 'call': .25, 'gps': 60, 'app': 20,
+         'power': 2, 'text': 1, 'wifi': 15}
+
+## Minutes between new files. Everything else gets one file per hour (and
+## surveys, voice recordings and identifiers are handled separately).
+FILE_MINUTES = {'blue': 5, 'wifi': 15}
+
+POWER_EVENTS = [
+    'Screen turned on', 'Screen turned off',
+    'Power connected', 'Power disconnected',
+    'Device Idle (Doze) state change signal received; device in idle state.',
+    'Device Idle (Doze) state change signal received; device not in idle '
+    'state.',
+    'Power Save Mode state change signal received; device in power save '
+    'state.',
+    'Power Save Mode change signal received; device not in power save state.']
+
+LOG_MESSAGES = ['bluetooth Failure. Device should have a MAC address.',
+                'Beiwe timer triggered: wifi log',
+                'Device Idle (Doze) state change signal received',
+                'starting accelerometer recording',
+                'GPS turned off', 'upload started', 'upload succeeded']
+
+CALL_TYPES = ['Incoming Call', 'Outgoing Call', 'Missed Call']
+
+SURVEY_QUESTIONS = [('radio_button', 'How are you feeling today?',
+                     'Great;Good;Okay;Bad'),
+                    ('slider', 'How well did you sleep?', '0-10'),
+                    ('free_response', 'Anything else to add?', '')]
+
+
+def _hashes(rng, n, tag):
+    """Returns n fake hashed identifiers (base64 SHA-256, like Beiwe's)"""
+    out = []
+    for i in range(n):
+        seed = '%s-%d-%d' % (tag, i, rng.randint(0, 2 ** 31 - 1))
+        digest = hashlib.sha256(seed.encode('utf-8')).digest()
+        out.append(base64.urlsafe_b64encode(digest).decode('ascii'))
+    return out
+
+
+def _java(dt):
+    """datetime (UTC) to Java time (milliseconds)"""
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+
+def _fname(folder, stream, dt, layout, ext='.csv'):
+    """Returns the path a file created at `dt` would be downloaded to"""
+    if layout == 'flat':
+        return os.path.join(folder,
+                            STREAM_NAMES[stream][1] + '_' +
+                            str(_java(dt)) + ext)
+    return os.path.join(folder, dt.strftime('%Y-%m-%d %H_%M_%S') + ext)
+
+
+def _write_csv(fname, header, lines, whitespace=False):
+    """Writes a header plus preformatted lines"""
+    if whitespace:
+        header = [' ' + h if i else h for i, h in enumerate(header)]
+    with open(fname, 'w') as f:
+        f.write(','.join(header) + '\n')
+        if len(lines):
+            f.write('\n'.join(lines))
+            f.write('\n')
+
+
+def _rows(stream, rng, t0, t1, scale, pools):
+    """Returns a list of csv lines (no header) for [t0, t1) in Java time"""
+    if stream in ('blue', 'wifi'):
+        ## One scan per file. Device frequency is Zipf-ish so rank_mac() has
+        ## something to find.
+        macs = pools['blue' if stream == 'blue' else 'wifi']
+        n = max(0, rng.poisson(RATES[stream] * scale))
+        seen = np.unique(np.minimum(rng.zipf(1.5, size=n), len(macs)) - 1)
+        rssi = rng.randint(-100, -40, size=len(seen))
+        if stream == 'blue':
+            return ['%d,%s,%d' % (t0, macs[i], r) for i, r in zip(seen, rssi)]
+        freq = np.where(rng.rand(len(seen)) < .7, 2412, 5180)
+        return ['%s,%d,%d' % (macs[i], f, r)
+                for i, f, r in zip(seen, freq, rssi)]
+
+    n = rng.poisson(RATES[stream] * scale * (t1 - t0) / 3600000.)
+    ts = np.sort(rng.randint(t0, t1, size=n)) if n else np.zeros(0, int)
+
+    if stream == 'accel':
+        ## Same-millisecond duplicates. Rare (~1300 / 1.4 million) in real data
+        dupes = rng.rand(n) < .001
+        dupes[0:1] = False
+        ts[1:][dupes[1:]] = ts[:-1][dupes[1:]]
+        xyz = np.clip(rng.normal(0, 4, size=(n, 3)) + [0, 0, 9.8], -20, 20)
+        return ['%d,3,%.6f,%.6f,%.6f' % (t, x, y, z)
+                for t, (x, y, z) in zip(ts, xyz)]
+
+    if stream == 'gps':
+        ## A random walk around home
+        walk = np.cumsum(rng.normal(0, .0002, size=(n, 2)), axis=0)
+        lat = pools['home'][0] + walk[:, 0]
+        lon = pools['home'][1] + walk[:, 1]
+        alt = rng.normal(20, 5, size=n)
+        acc = rng.uniform(3, 80, size=n)
+        return ['%d,%.7f,%.7f,%.3f,%.1f' % row
+                for row in zip(ts, lat, lon, alt, acc)]
+
+    if stream == 'call':
+        who = rng.randint(0, len(pools['phone']), size=n)
+        kind = rng.randint(0, 3, size=n)
+        dur = np.where(kind == 2, 0, rng.exponential(120, size=n).astype(int))
+        return ['%d,%s,%s,%d' % (t, pools['phone'][w], CALL_TYPES[k], d)
+                for t, w, k, d in zip(ts, who, kind, dur)]
+
+    if stream == 'text':
+        ## Duplicated texts (usually 3 or 4 identical rows), mostly when sent
+        lines = []
+        for t in ts:
+            sent = rng.rand() < .5
+            row = '%d,%s,%s,%d,%d' % (
+                t, pools['phone'][rng.randint(0, len(pools['phone']))],
+                'sent SMS' if sent else 'received SMS',
+                rng.randint(1, 160), t)
+            copies = 1
+            if rng.rand() < (.3 if sent else .1):
+                copies = rng.randint(3, 5)
+            lines.extend([row] * copies)
+        return lines
+
+    if stream == 'power':
+        ## Mostly screen on/off pairs with the occasional charger or Doze event
+        events = rng.choice(len(POWER_EVENTS), size=n,
+                            p=[.35, .35, .06, .06, .06, .06, .03, .03])
+        return ['%d,%s' % (t, POWER_EVENTS[e]) for t, e in zip(ts, events)]
+
+    if stream == 'app':
+        msgs = rng.randint(0, len(LOG_MESSAGES), size=n)
+        return ['%d %s' % (t, LOG_MESSAGES[m]) for t, m in zip(ts, msgs)]
+
+    raise ValueError("Unknown stream: " + stream)
+
+
+def _survey(stream, rng, t0):
+    """Lines for one survey answers/timings file submitted at t0"""
+    lines = []
+    t = t0
+    for qid, (qtype, text, options) in enumerate(SURVEY_QUESTIONS):
+        if qtype == 'radio_button':
+            answer = options.split(';')[rng.randint(0, 4)]
+        elif qtype == 'slider':
+            answer = str(rng.randint(0, 11))
+        else:
+            answer = ['', 'no', 'tired'][rng.randint(0, 3)]
+        row = ['q%d' % qid, qtype, text, options, answer]
+        t += rng.randint(2000, 30000)
+        if stream == 'survey_t':
+            row = [str(t)] + row
+        lines.append(','.join(row))
+    if stream == 'survey_t':
+        lines.append('%d,,,,,User hit submit' % (t + 1000))
+    return lines
+
+
+def _write_wav(fname, rng, seconds=1., rate=8000):
+    """Writes a small stereo 16-bit .wav (what convert_mp4() produces)"""
+    n = int(seconds * rate)
+    tone = np.sin(2 * np.pi * 220 * np.arange(n) / float(rate))
+    snd = (tone * 8000 + rng.normal(0, 500, size=n)).astype('<i2')
+    w = wave.open(fname, 'wb')
+    w.setnchannels(2)
+    w.setsampwidth(2)
+    w.setframerate(rate)
+    w.writeframes(np.column_stack((snd, snd)).tobytes())
+    w.close()
+
+
+def make_user(upath, start=None, days=1, scale=1., streams='all',
+              layout='download', empty_frac=.05, whitespace_frac=.05,
+              n_surveys=2, wav=True, user_id=None, seed=None):
+    """Writes a synthetic user directory and returns the list of files
+
+    Parameters
+    ----------
+    upath : directory of the user (created if necessary)
+    start : datetime (UTC) of the first file (default: 2015-05-05 00:00)
+    days : number of days of data
+    scale : multiplies the number of rows per file (see RATES); the number of
+        files only depends on `days`
+    streams : 'all' or a list of stream keys (see STREAM_NAMES)
+    layout : 'download' writes `upath/<stream folder>/<%Y-%m-%d %H_%M_%S>.csv`
+        like make_request(); 'flat' writes `upath/<prefix>_<timestamp>.csv`
+        like older downloads (and like describe_user() expects)
+    empty_frac : fraction of files that only contain the header
+    whitespace_frac : fraction of files with whitespace in their header
+    n_surveys : number of different surveys (one of each per day)
+    wav : if True, writes a converted .wav next to every voice .mp4
+    user_id : patient id written to the identifiers file
+    seed : seed for numpy.random.RandomState (same seed, same files)
+
+    Usage
+    -----
+    make_user('./synthetic/user1', days=7, scale=.1, seed=1)
+    accel_files = list_data_files(upath='./synthetic/user1', stream='accel')
+
+    Notes
+    -----
+    The voice recordings are not real .mp4 files -- they are placeholders so
+    list_audio_files() has something to find. The .wav files are real.
+
+    """
+    rng = np.random.RandomState(seed)
+    if start is None:
+        start = datetime.datetime(2015, 5, 5)
+    if streams == 'all':
+        streams = sorted(STREAM_NAMES)
+    if user_id is None:
+        user_id = os.path.basename(os.path.normpath(upath))
+
+    pools = {'blue': _hashes(rng, 200, 'blue'),
+             'wifi': _hashes(rng, 300, 'wifi'),
+             'phone': _hashes(rng, 25, 'phone'),
+             'survey': [''.join(rng.choice(list('0123456789abcdef'), 24))
+                        for _ in range(n_surveys)],
+             'home': (42.3355 + rng.normal(0, .01), -71.1 + rng.normal(0, .01))}
+
+    written = []
+    end = start + datetime.timedelta(days=days)
+    for stream in streams:
+        folder = upath if layout == 'flat' else os.path.join(
+            upath, STREAM_NAMES[stream][0])
+
+        if stream == 'id':
+            mkdir_p(folder)
+            fname = _fname(folder, stream, start, layout)
+            _write_csv(fname, HEADERS[stream],
+                       ['%s,%s,%s,%s' % (user_id, _hashes(rng, 1, 'mac')[0],
+                                         _hashes(rng, 1, 'number')[0],
+                                         '%016x' % rng.randint(0, 2 ** 31))])
+            written.append(fname)
+            continue
+
+        if stream in ('survey_a', 'survey_t', 'voice'):
+            ## Nested by survey ID, once a day per survey, mid-afternoon
+            for day in range(days):
+                for sid in pools['survey']:
+                    sfolder = folder if layout == 'flat' else os.path.join(
+                        folder, sid)
+                    mkdir_p(sfolder)
+                    dt = start + datetime.timedelta(
+                        days=day, hours=14, seconds=int(rng.randint(0, 7200)))
+                    if stream == 'voice':
+                        fname = _fname(sfolder, stream, dt, layout, '.mp4')
+                        with open(fname, 'wb') as f:
+                            f.write(b'\x00\x00\x00\x18ftypmp42' +
+                                    struct.pack('>I', 0) * 4)
+                        written.append(fname)
+                        if wav:
+                            _write_wav(fname[:-4] + '.wav', rng)
+                            written.append(fname[:-4] + '.wav')
+                        continue
+                    fname = _fname(sfolder, stream, dt, layout)
+                    _write_csv(fname, HEADERS[stream],
+                               _survey(stream, rng, _java(dt)))
+                    written.append(fname)
+            continue
+
+        mkdir_p(folder)
+        step = datetime.timedelta(minutes=FILE_MINUTES.get(stream, 60))
+        dt = start
+        while dt < end:
+            t0 = _java(dt)
+            t1 = _java(dt + step)
+            fname = _fname(folder, stream, dt, layout)
+            if rng.rand() < empty_frac:
+                lines = []
+            else:
+                lines = _rows(stream, rng, t0, t1, scale, pools)
+            _write_csv(fname, HEADERS[stream], lines,
+                       whitespace=rng.rand() < whitespace_frac)
+            written.append(fname)
+            dt += step
+
+    return written
+
+
+def make_study(root, n_users=3, seed=None, **kwargs):
+    """Writes `n_users` synthetic user directories under `root`
+
+    Parameters
+    ----------
+    root : study directory (created if necessary)
+    n_users : number of users
+    seed : base seed; user i gets seed + i
+    kwargs : passed to make_user()
+
+    Notes
+    -----
+    Returns a list of user directories. User IDs are 8 random lowercase
+    characters, like the real ones.
+
+    """
+    rng = np.random.RandomState(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz0123456789'))
+    upaths = []
+    for i in range(n_users):
+        user_id = ''.join(rng.choice(letters, size=8))
+        upath = os.path.join(root, user_id)
+        make_user(upath, user_id=user_id,
+                  seed=None if seed is None else seed + i, **kwargs)
+        upaths.append(upath)
+    return upaths
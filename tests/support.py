@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+    Makes the repository importable as `beiwedata` for the tests.
+
+    The repository is the package itself, so unless its parent folder is on
+    the path under that name, it's loaded from here. Import this before
+    anything from beiwedata.
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import beiwedata
+except ImportError:
+    if sys.version_info[0] == 2:
+        import imp
+        beiwedata = imp.load_module('beiwedata', None, ROOT,
+                                    ('', '', imp.PKG_DIRECTORY))
+    else:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(
+            'beiwedata', os.path.join(ROOT, '__init__.py'),
+            submodule_search_locations=[ROOT])
+        beiwedata = importlib.util.module_from_spec(spec)
+        sys.modules['beiwedata'] = beiwedata
+        spec.loader.exec_module(beiwedata)
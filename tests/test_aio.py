@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Tests of beiwedata.aio against a local mock server (Python 3 only)"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import support  # noqa: F401 (makes beiwedata importable)
+from beiwedata.download import make_request
+from beiwedata.mockserver import serve_mock
+
+
+def _files(folder):
+    """{relative path: bytes} of a download folder, without the registry"""
+    out = {}
+    for path, _, names in os.walk(folder):
+        for name in names:
+            if name != 'master_registry':
+                fname = os.path.join(path, name)
+                with open(fname, 'rb') as f:
+                    out[os.path.relpath(fname, folder)] = f.read()
+    return out
+
+
+@unittest.skipIf(sys.version_info < (3, 6), "beiwedata.aio needs Python 3")
+class AsyncClientTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = serve_mock(n_users=3, days=1, scale=.05, seed=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _run(self, coro):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_sync_users_matches_make_request(self):
+        from beiwedata import aio
+        s = self.server
+        plain = os.path.join(self.tmp, 'plain')
+        make_request(s.study_id, s.access_key, s.secret_key, folder=plain,
+                     base_url=s.url, verbose=False)
+        folder = os.path.join(self.tmp, 'async')
+        new = self._run(aio.sync_users(s.study_id, s.access_key,
+                                       s.secret_key, folder=folder,
+                                       base_url=s.url, concurrency=2))
+        root = s.studies[s.study_id]['root']
+        self.assertEqual(sorted(new), sorted(os.listdir(root)))
+        self.assertEqual(_files(folder), _files(plain))
+        with open(os.path.join(plain, 'master_registry')) as f:
+            expected = json.load(f)
+        with open(os.path.join(folder, 'master_registry')) as f:
+            self.assertEqual(json.load(f), expected)
+
+        ## Nothing is new the second time
+        again = self._run(aio.sync_users(s.study_id, s.access_key,
+                                         s.secret_key, folder=folder,
+                                         base_url=s.url))
+        self.assertEqual(sum(len(v) for v in again.values()), 0)
+
+    def test_download_without_store_over_links(self):
+        ## Files linked from a store are replaced, not written through
+        from beiwedata import aio
+        s = self.server
+        store = os.path.join(self.tmp, 'store')
+        a, b = os.path.join(self.tmp, 'a'), os.path.join(self.tmp, 'b')
+        for folder in (a, b):
+            self._run(aio.make_request(s.study_id, s.access_key,
+                                       s.secret_key, folder=folder,
+                                       base_url=s.url, store=store,
+                                       verbose=False))
+        os.remove(os.path.join(a, 'master_registry'))
+        self._run(aio.make_request(s.study_id, s.access_key, s.secret_key,
+                                   folder=a, base_url=s.url, verbose=False))
+        self.assertEqual(_files(a), _files(b))
+        for name in _files(a):
+            self.assertEqual(os.stat(os.path.join(a, name)).st_nlink, 1)
+
+    def test_bad_credentials(self):
+        from beiwedata import aio
+        from urllib.error import HTTPError
+        s = self.server
+        with self.assertRaises(HTTPError) as raised:
+            self._run(aio.make_request(s.study_id, 'nope', 'nope',
+                                       folder=self.tmp, base_url=s.url,
+                                       verbose=False))
+        self.assertEqual(raised.exception.code, 403)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Tests of beiwedata.align"""
+
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import support  # noqa: F401 (makes beiwedata importable)
+from beiwedata.align import align_streams
+from beiwedata.basic import import_df, list_data_files, make_timestamp
+from beiwedata.synthetic import make_user
+
+
+class AlignStreamsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        make_user(self.tmp, days=2, scale=.05, streams=['accel'], seed=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_first_last_match_resample(self):
+        ## Every bin spans many files, so file order matters
+        start, end = make_timestamp(2015, 5, 5), make_timestamp(2015, 5, 7)
+        grid = align_streams(self.tmp, {'accel': {'x': ['first', 'last',
+                                                        'mean']}},
+                             start, end, freq='D')
+        df = import_df(list_data_files(self.tmp, 'accel'), columns=['x'])
+        df = df.sort_values('timestamp', kind='mergesort')
+        daily = df['x'].resample('D')
+        for func in ('first', 'last', 'mean'):
+            np.testing.assert_allclose(grid['accel_x_' + func].values,
+                                       getattr(daily, func)().values)
+
+
+if __name__ == '__main__':
+    unittest.main()
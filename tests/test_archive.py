@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Tests of reading archived files by column (beiwedata.archive)"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+import support  # noqa: F401 (makes beiwedata importable)
+from beiwedata.archive import (archive_path, archive_user, member_info,
+                               read_data_csv, write_archive)
+from beiwedata.basic import list_data_files
+from beiwedata.synthetic import make_user
+
+
+class FloatColumnsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        rng = random.Random(1)
+        self.rows = [(1431039605018 + 250 * i, 3,
+                      '%.6f' % rng.uniform(-20, 20),
+                      '%.6f' % rng.uniform(-20, 20))
+                     for i in range(500)]
+        self.fname = os.path.join(self.tmp, '2015-05-05 00_00_00.csv')
+        with open(self.fname, 'w') as f:
+            f.write('timestamp,accuracy,x,y\n')
+            f.writelines('%d,%d,%s,%s\n' % row for row in self.rows)
+        self.expected = pd.read_csv(self.fname)
+        write_archive(archive_path(self.fname), [self.fname])
+        os.remove(self.fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_float_columns_read_by_column(self):
+        ## Fixed-decimal floats that read_csv()'s default parser may round
+        ## differently from float() still take the column path, and come
+        ## out as that parser rounds them
+        self.assertTrue(member_info(self.fname)[1]['frame'])
+        df = read_data_csv(self.fname, usecols=['timestamp', 'x'])
+        self.assertEqual(list(df.columns), ['timestamp', 'x'])
+        self.assertEqual(df['x'].tolist(), self.expected['x'].tolist())
+        self.assertEqual(df['timestamp'].tolist(), [r[0] for r in self.rows])
+
+
+class TransparencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        make_user(self.tmp, days=1, scale=.05, streams=['accel', 'gps'],
+                  seed=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_same_files_and_frames(self):
+        ## Exactly read_csv(), bit for bit, and in the same order
+        def read_all(flist, read):
+            return [read(f, usecols=u) for f in flist
+                    for u in (None, ['timestamp', 'x'], ['latitude'])
+                    if u is None or u[-1] in read(f, nrows=0).columns]
+        before = list_data_files(self.tmp)
+        frames = read_all(before, pd.read_csv)
+        archive_user(self.tmp)
+        self.assertEqual(list_data_files(self.tmp), before)
+        self.assertFalse(any(os.path.exists(f) for f in before))
+        archived = read_all(before, read_data_csv)
+        self.assertEqual(len(archived), len(frames))
+        for df, expected in zip(archived, frames):
+            pd.testing.assert_frame_equal(df, expected, check_exact=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""Tests of beiwedata.gps"""
+
+import unittest
+
+import numpy as np
+
+import support  # noqa: F401 (makes beiwedata importable)
+from beiwedata.gps import gps_density
+
+
+class DensityTest(unittest.TestCase):
+
+    def test_same_point_without_spacer(self):
+        ## Zero-width bounds used to divide by zero
+        for n in (1, 5):
+            counts, extent = gps_density([-71.1] * n, [42.3] * n, spacer=0,
+                                         bins=8)
+            self.assertEqual(counts.sum(), n)
+            self.assertTrue(np.isfinite(extent).all())
+            self.assertGreater(extent[1], extent[0])
+            self.assertGreater(extent[3], extent[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Tests of beiwedata.store and import_df() over hard-linked files"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import support  # noqa: F401 (makes beiwedata importable)
+from beiwedata.basic import import_df, make_timestamp
+from beiwedata.download import make_request
+from beiwedata.mockserver import serve_mock
+from beiwedata.store import (clear_parsed_cache, hash_file, link,
+                             object_path, put_bytes, put_file)
+
+WIFI = 'hashed MAC,frequency,RSSI\naa:bb,2412,-60\n'
+
+
+class LinkedFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = os.path.join(self.tmp, 'store')
+        folder = os.path.join(self.tmp, 'user', 'wifi')
+        os.makedirs(folder)
+        first = os.path.join(folder, '2015-05-05 00_00_00.csv')
+        with open(first, 'w') as f:
+            f.write(WIFI)
+        digest = put_file(self.store, first)
+        self.files = [link(self.store, digest, first),
+                      link(self.store, digest,
+                           os.path.join(folder, '2015-05-06 00_00_00.csv'))]
+        clear_parsed_cache()
+
+    def tearDown(self):
+        clear_parsed_cache()
+        shutil.rmtree(self.tmp)
+
+    def test_file_times_of_linked_files(self):
+        ## Same bytes, so parsed once, but each gets its own file time
+        self.assertEqual(os.stat(self.files[0]).st_ino,
+                         os.stat(self.files[1]).st_ino)
+        df = import_df(self.files, setindex=False)
+        self.assertEqual(list(df['timestamp']),
+                         [make_timestamp(2015, 5, 5),
+                          make_timestamp(2015, 5, 6)])
+
+    def test_window_of_linked_files(self):
+        ## The first file is cached by the first import
+        import_df(self.files)
+        df = import_df(self.files, start_ts=make_timestamp(2015, 5, 6))
+        self.assertEqual(len(df), 1)
+        self.assertEqual(df['timestamp'].iloc[0], make_timestamp(2015, 5, 6))
+
+
+class ReplaceLinkedFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = os.path.join(self.tmp, 'store')
+        self.a = os.path.join(self.tmp, 'a')
+        self.b = os.path.join(self.tmp, 'b')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_link_over_linked_file(self):
+        ## Re-linking a path never writes through to the object it linked
+        old = put_bytes(self.store, b'old\n')
+        new = put_bytes(self.store, b'new\n')
+        for folder in (self.a, self.b):
+            link(self.store, old, os.path.join(folder, 'f.csv'))
+        link(self.store, new, os.path.join(self.a, 'f.csv'))
+        with open(os.path.join(self.a, 'f.csv'), 'rb') as f:
+            self.assertEqual(f.read(), b'new\n')
+        with open(os.path.join(self.b, 'f.csv'), 'rb') as f:
+            self.assertEqual(f.read(), b'old\n')
+
+    def test_download_without_store_over_links(self):
+        ## Linked into two folders, then downloaded again into one of them
+        ## without the store: the other folder and the store keep their
+        ## files (and, not as root, the download doesn't hit EACCES)
+        with serve_mock(n_users=1, days=1, scale=.05, seed=1) as server:
+            def download(folder, store):
+                return make_request(server.study_id, server.access_key,
+                                    server.secret_key, folder=folder,
+                                    return_new=True, verbose=False,
+                                    base_url=server.url, store=store)
+            files = download(self.a, self.store)
+            download(self.b, self.store)
+            os.remove(os.path.join(self.a, 'master_registry'))
+            self.assertEqual(sorted(download(self.a, None)), sorted(files))
+        for name in files:
+            a, b = (os.path.join(folder, *name.split('/'))
+                    for folder in (self.a, self.b))
+            self.assertFalse(os.path.samefile(a, b))
+            self.assertEqual(os.stat(a).st_nlink, 1)
+            self.assertTrue(os.path.samefile(
+                b, object_path(self.store, hash_file(b))))
+
+
+if __name__ == '__main__':
+    unittest.main()